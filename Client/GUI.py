@@ -9,6 +9,7 @@ import tkinter.ttk as ttk
 
 from collections import defaultdict
 from datetime import datetime
+from socket_client import UploadError
 from tkinter import messagebox, simpledialog, filedialog
 
 
@@ -68,8 +69,9 @@ class MainWindow:
 
         # Define state variables, defaultdict creates element if it does not exist
         self.user = None
-        self.friends = defaultdict(lambda: {'name': '', 'messages': [], 'user': []})
-        self.chats = defaultdict(lambda: {'name': '', 'owner': '', 'messages': [], 'members': []})
+        # Messages are loaded a page at a time, 'loaded' once the latest page arrived and 'more' while older ones remain
+        self.friends = defaultdict(lambda: {'name': '', 'messages': [], 'user': [], 'loaded': False, 'more': True})
+        self.chats = defaultdict(lambda: {'name': '', 'owner': '', 'messages': [], 'members': [], 'loaded': False, 'more': True})
 
         # Main container to hold all other frames and widgets
         container = tk.Frame(self.window)
@@ -102,13 +104,23 @@ class MainWindow:
         "Adds new room data or updates existing ones"
         self.chats[roomid].update({'owner': ownerid, 'name': roomname})
 
-    def add_message(self, type, id, username, email, content, actualname, filename, created_at):
+    def conversation(self, type, id):
+        "Room data for public chats and friend data for private ones"
+        return self.chats[id] if type == 'public' else self.friends[id]
+
+    def add_message(self, type, id, username, email, content, actualname, filename, created_at, messageid=None):
         "Creates room data for public message and friend for private, and appends message data"
-        msg = [username, email, content, actualname, filename, created_at]
-        if type == 'public':
-            self.chats[id]['messages'].append(msg)
-        else:
-            self.friends[id]['messages'].append(msg)
+        msg = [username, email, content, actualname, filename, created_at, messageid]
+        self.conversation(type, id)['messages'].append(msg)
+
+    def add_history(self, type, id, messages, more):
+        "Prepends a page of older messages (newest first), returns the ones that were not known yet in order"
+        data = self.conversation(type, id)
+        known = {m[6] for m in data['messages']}
+        older = [list(m) for m in reversed(messages) if m[6] not in known]
+        data['messages'][:0] = older
+        data['loaded'], data['more'] = True, more
+        return older
 
     def add_member(self, roomid, userid, email, username):
         "Creates room data if not exists and appends member info"
@@ -292,7 +304,6 @@ class MainFrame(ChildFrame):
         self.controller.chats.clear()
         self.controller.friends.clear()
         self.socket.send_data('FETCH_ROOMS')
-        self.socket.send_data('FETCH_RECENT_CHATS')
         self.socket.send_data('FETCH_MEMBERS')
         self.socket.send_data('FETCH_FRIENDS')
 
@@ -341,9 +352,15 @@ class ChatFrame(ChildFrame):
         self.id = -1
         self.private = False
         self.attachment = None
+        self.loading = False # Waiting for a page of history
+        self.downloads = {} # filename -> file being written to
         self.make_widgets()
         self.socket.register_event('MESSAGE', self.new_message)
+        self.socket.register_event('HISTORY', self.history)
         self.socket.register_event('DOWNLOAD_FILE', self.download_file)
+        self.socket.register_event('FILE_START', self.file_start)
+        self.socket.register_event('FILE_CHUNK', self.file_chunk)
+        self.socket.register_event('FILE_END', self.file_end)
 
     def make_widgets(self):
         title_frame = tk.Frame(self, bd=3, relief=tk.RAISED)
@@ -355,6 +372,7 @@ class ChatFrame(ChildFrame):
 
         self.message_frame = ScrollableFrame(self, bg='light green', height=1)
         self.message_frame.grid(row=1, sticky='nsew')#.pack(fill=tk.BOTH, expand=True)
+        self.message_frame.scroll = self.scroll
 
         self.attachment_frame = tk.Frame(self)
         self.attachment_title = tk.Label(self.attachment_frame, text='')
@@ -379,12 +397,12 @@ class ChatFrame(ChildFrame):
             return
 
         filesize = os.fstat(file.fileno()).st_size
+        file.close()
         if filesize > 50 * (2**20):
             return messagebox.showerror('Error', 'Cannot send attachment greater than 50 MB') 
-        # Open file and store the data and filename
+        # Store the path, the file is streamed to the server when the message is sent
         filename = os.path.basename(file.name)
-        filedata = base64.b64encode(file.read()).decode()
-        self.attachment = [filename, filedata]
+        self.attachment = file.name
 
         self.attachment_frame.grid(row=2, sticky='nsew')
         self.attachment_title.config(text=f'{filename} ({format_filesize(filesize)})')
@@ -397,6 +415,29 @@ class ChatFrame(ChildFrame):
             save_file.write(filedata)
             save_file.close()
 
+    def download(self, filename, actualname):
+        "Asks where to save the attachment and then requests it in chunks"
+        name, extension = os.path.splitext(actualname)
+        save_file = filedialog.asksaveasfile(mode='wb', initialfile=name, defaultextension=extension, filetypes=(("All files", "*"),))
+        if save_file:
+            self.downloads[filename] = save_file
+            self.socket.send_data('DOWNLOAD_STREAM', filename=filename, actualname=actualname)
+
+    def file_start(self, body):
+        if body['filename'] not in self.downloads:
+            return
+        print(f"Downloading {body['actualname']} ({format_filesize(body['size'])})")
+
+    def file_chunk(self, body):
+        save_file = self.downloads.get(body['filename'])
+        if save_file:
+            save_file.write(body['data'])
+
+    def file_end(self, body):
+        save_file = self.downloads.pop(body['filename'], None)
+        if save_file:
+            save_file.close()
+
     def close_attachment(self):
         self.attachment = None
         self.attachment_frame.grid_forget()
@@ -406,18 +447,68 @@ class ChatFrame(ChildFrame):
         options_frame.load_chat(self.id)
         options_frame.tkraise()
     
-    def add_message(self, message):
-        created_at = datetime.fromisoformat(message[5]).strftime('%d-%m-%Y %H:%M')
+    def scroll(self, *args):
+        "Scrolls the messages with the scrollbar or the mouse wheel, older ones are loaded once the top is reached"
+        self.message_frame.canvas.yview(*args)
+        if self.message_frame.canvas.yview()[0] <= 0:
+            self.fetch_history()
+
+    def fetch_history(self):
+        "Requests the page before the oldest loaded message, or the latest page if nothing is loaded"
+        if self.loading or self.id == -1:
+            return
+        if self.data['loaded'] and not self.data['more']:
+            return
+
+        self.loading = True
+        before = self.data['messages'][0][6] if self.data['loaded'] and self.data['messages'] else None
+        self.socket.send_data('FETCH_HISTORY', type='private' if self.private else 'public', _id=self.id, before=before)
+
+    def history(self, body):
+        first_page = not self.controller.conversation(body['type'], body['_id'])['loaded']
+        older = self.controller.add_history(body['type'], body['_id'], body['messages'], body['more'])
+        if body['_id'] != self.id or (body['type'] == 'private') != self.private:
+            return
+
+        self.loading = False
+        if first_page:
+            self.load_chat(self.id, self.private)
+            return self.fill_view()
+
+        # Insert above the current messages, then scroll back to where the user was
+        height = self.message_frame.frame.winfo_height()
+        top = next(iter(self.message_frame.frame.winfo_children()), None)
+        self.message_frame.autoscroll = False
+        for message in reversed(older):
+            top = self.add_message(message, before=top)
+
+        self.message_frame.update_idletasks()
+        new_height = self.message_frame.frame.winfo_height()
+        self.message_frame.update_scrollbar()
+        self.message_frame.canvas.yview_moveto((new_height - height) / max(new_height, 1))
+        self.fill_view()
+
+    def fill_view(self):
+        "Loads older pages while the messages do not fill the view, there is nothing to scroll up to otherwise"
+        self.message_frame.update_idletasks()
+        if self.message_frame.frame.winfo_height() < self.message_frame.canvas.winfo_height():
+            self.fetch_history()
+
+    def add_message(self, message, before=None):
+        created_at = message[5]
+        if not isinstance(created_at, datetime):
+            created_at = datetime.fromisoformat(created_at) # json sends datetimes as strings
+        created_at = created_at.strftime('%d-%m-%Y %H:%M')
         if message[1] == self.controller.user[1]:
             bg, anchor = "#e0eee0", "e"
         else:
             bg, anchor = "#f0f8ff", "w"
 
         frame = tk.Frame(self.message_frame.frame, borderwidth=1, relief=tk.RAISED)
-        frame.pack(anchor=anchor, pady=5, padx=10)
+        frame.pack(anchor=anchor, pady=5, padx=10, before=before)
         tk.Label(frame, text=f'{message[1]} ~ {message[2]} [{created_at}]', bg=bg, font=FONT3, padx=5).pack(fill=tk.X, expand=True)
         if message[4]:
-            download_cmd = lambda: self.socket.send_data('DOWNLOAD_FILE', filename=message[4], actualname=message[3])
+            download_cmd = lambda: self.download(message[4], message[3])
             attachment_frame = tk.Frame(frame, padx=5, pady=5)
             attachment_frame.pack(fill=tk.X, expand=True)
 
@@ -425,10 +516,12 @@ class ChatFrame(ChildFrame):
             tk.Button(attachment_frame, text='Download', command=download_cmd).pack(side=tk.RIGHT, fill=tk.Y)
 
         tk.Message(frame, text=message[0], font=FONT4, bg=bg, anchor=anchor, width=350, padx=5).pack(anchor=anchor, fill=tk.BOTH, expand=True)
+        return frame
     
     def new_message(self, body):
         self.controller.add_message(*body)
-        if self.id == body[1]:
+        if self.id == body[1] and (body[0] == 'private') == self.private:
+            self.message_frame.autoscroll = True
             self.add_message(body[2:])
             self.message_frame.canvas.yview_moveto(1)
         else:
@@ -440,15 +533,27 @@ class ChatFrame(ChildFrame):
         if len(message) > 1024:
             messagebox.showerror('Max Length Exceeded', 'Message cannot be more than 1024 characters long')
         
-        if self.private:
-            self.socket.send_data('SEND_PRIVATE_MESSAGE', _id=self.id, content=message, attachment=self.attachment)
+        header = 'SEND_PRIVATE_MESSAGE' if self.private else 'SEND_MESSAGE'
+        if self.attachment:
+            asyncio.create_task(self.send_with_attachment(header, self.attachment, _id=self.id, content=message, attachment=None))
         else:
-            self.socket.send_data('SEND_MESSAGE', _id=self.id, content=message, attachment=self.attachment)
+            self.socket.send_data(header, _id=self.id, content=message, attachment=None)
         self.msg_entry.delete(0, tk.END)
         self.close_attachment()
 
+    async def send_with_attachment(self, header, path, **data):
+        "Uploads the attachment in chunks, then sends the message referring to it"
+        try:
+            data['upload'] = await self.socket.upload(path)
+        except (asyncio.TimeoutError, ConnectionError):
+            return messagebox.showerror('Upload Failed', f'Could not upload {os.path.basename(path)}, try again')
+        except UploadError as e:
+            return messagebox.showerror('Upload Failed', f'Could not upload {os.path.basename(path)}: {e}')
+        await self.socket.send(header, data)
+
     def load_chat(self, _id, private=False):
         self.message_frame.clear() # Reset Messages
+        self.message_frame.autoscroll = True
         self.attachment = None
         self.private = private
         self.id = _id
@@ -460,6 +565,10 @@ class ChatFrame(ChildFrame):
             self.option_btn.configure(state=tk.DISABLED)
 
         self.title.configure(text=self.data['name'])
+        self.loading = False
+        if not self.data['loaded']:
+            self.fetch_history() # Latest page, older ones load as the user scrolls up
+
         messages = self.data.get('messages')
         if messages:
             [self.add_message(m) for m in messages]
@@ -599,7 +708,6 @@ class RoomsFrame(ChildFrame):
         self.controller.add_room(*body)
         self.add_room(*body[:2])
 
-        self.socket.send_data('FETCH_RECENT_CHATS')
         self.socket.send_data('FETCH_MEMBERS')
     
     def leave_room(self, roomid):
@@ -828,6 +936,8 @@ class ProfileFrame(ChildFrame):
 
 class ScrollableFrame(tk.Frame):
     "Utility class that manages frames that can be scrolled and dynamically updates itself"
+    wheel_bound = False # The mouse wheel is bound once for every scrollable frame
+
     def __init__(self, parent=None, **kwargs):
         super().__init__(parent, **kwargs)
 
@@ -835,7 +945,8 @@ class ScrollableFrame(tk.Frame):
         # Create a vertical scrollbar, pack it to right
         self.canvas = tk.Canvas(self, bd=0, background=kwargs.get('bg', 'white'))
         self.frame = tk.Frame(self.canvas, background=kwargs.get('bg', 'white'))
-        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
+        self.scroll = self.canvas.yview # Takes the scrollbar's and the mouse wheel's yview arguments, replace it to react to scrolling
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=lambda *args: self.scroll(*args))
         self.canvas.configure(yscrollcommand=self.scrollbar.set)
 
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
@@ -844,8 +955,25 @@ class ScrollableFrame(tk.Frame):
         # Places the frame on the canvas
         # Update scroll region when any event is fired
         self.canvas_frame = self.canvas.create_window((4,4), window=self.frame, anchor="nw")
+        self.autoscroll = True # Keep the view at the bottom as the frame grows
         self.frame.bind("<Configure>", self.update_scrollbar)
         self.canvas.bind('<Configure>', self.resize_frame)
+        if not ScrollableFrame.wheel_bound:
+            for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'): # Windows and macOS, then X11
+                self.bind_all(sequence, ScrollableFrame.wheel, add='+')
+            ScrollableFrame.wheel_bound = True
+
+    @staticmethod
+    def wheel(event):
+        "Scrolls the scrollable frame under the pointer"
+        try:
+            widget = event.widget.winfo_containing(event.x_root, event.y_root)
+        except (AttributeError, KeyError, tk.TclError): # Not over one of our widgets
+            return
+        while widget is not None and not isinstance(widget, ScrollableFrame):
+            widget = widget.master
+        if widget is not None:
+            widget.scroll('scroll', -1 if event.num == 4 or event.delta > 0 else 1, 'units')
     
     def clear(self):
         "Deletes all items on the frame and resets the scrollbar"
@@ -861,5 +989,6 @@ class ScrollableFrame(tk.Frame):
     def update_scrollbar(self, event=None):
         "Update scroll region to cover whole canvas"
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-        self.canvas.yview_moveto(1)
+        if self.autoscroll:
+            self.canvas.yview_moveto(1)
 
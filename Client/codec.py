@@ -0,0 +1,162 @@
+"""
+Wire codecs for the framed protocol, shared by the client and the server
+
+Every frame is a 4 byte big endian length followed by a message encoded
+with one of these codecs. Connections start out with JSON, the client
+then offers the codecs it knows in a HELLO message and the server picks one.
+
+The client offers its compressors in HELLO as well. Once one is picked,
+either side may compress a frame larger than its threshold and sets the
+high bit of the length to say so, smaller frames are sent as they are.
+"""
+import base64
+import json
+import struct
+import zlib
+
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSED = 1 << 31 # Set in the length of compressed frames
+COMPRESS_THRESHOLD = 16 * 1024 # Smaller frames are not worth compressing
+MAX_FRAME_SIZE = COMPRESSED - 1 # Compressed frames may not expand beyond what the length could say
+
+
+class JSONCodec:
+    "Plain JSON, datetimes are sent as strings and bytes as tagged base64 strings"
+    name = 'json'
+    BYTES = '__bytes__'
+
+    def default(self, obj):
+        if isinstance(obj, (bytes, bytearray)):
+            return {self.BYTES: base64.b64encode(obj).decode()}
+        return str(obj)
+
+    def object_hook(self, obj):
+        if self.BYTES in obj:
+            return base64.b64decode(obj[self.BYTES])
+        return obj
+
+    def encode(self, message):
+        return json.dumps(message, default=self.default).encode('utf8')
+
+    def decode(self, data):
+        return json.loads(data.decode('utf8'), object_hook=self.object_hook)
+
+
+class MsgpackCodec:
+    "Compact binary codec with native bytes and datetimes, needs the msgpack package"
+    name = 'msgpack'
+    DATETIME = 1 # Extension type code
+
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            data = struct.pack('>HBBBBBI', obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second, obj.microsecond)
+            return msgpack.ExtType(self.DATETIME, data)
+        return str(obj)
+
+    def ext_hook(self, code, data):
+        if code == self.DATETIME:
+            return datetime(*struct.unpack('>HBBBBBI', data))
+        return msgpack.ExtType(code, data)
+
+    def encode(self, message):
+        return msgpack.packb(message, default=self.default)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, ext_hook=self.ext_hook)
+
+
+JSON = JSONCodec()
+
+# Available codecs, most preferred first
+CODECS = {JSON.name: JSON}
+if msgpack:
+    CODECS = {MsgpackCodec.name: MsgpackCodec(), **CODECS}
+
+
+def negotiate(offered):
+    "Picks the first codec offered by the other side that is available here"
+    return next((CODECS[name] for name in offered if name in CODECS), JSON)
+
+
+class ZlibCompressor:
+    "Deflate from the standard library"
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, limit=MAX_FRAME_SIZE):
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, limit)
+        if decompressor.unconsumed_tail:
+            raise ValueError('Compressed frame is too large')
+        return data
+
+
+class ZstdCompressor:
+    "Faster and smaller than deflate, needs the zstandard package"
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        self.level = level
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data, limit=MAX_FRAME_SIZE):
+        if zstandard.frame_content_size(data) > limit:
+            raise ValueError('Compressed frame is too large')
+        return self.decompressor.decompress(data, max_output_size=limit)
+
+
+# Available compressors with their default level, most preferred first
+COMPRESSORS = {ZlibCompressor.name: ZlibCompressor()}
+if zstandard:
+    COMPRESSORS = {ZstdCompressor.name: ZstdCompressor(), **COMPRESSORS}
+
+
+def compressor(name, level=None):
+    "The named compressor, at the given level or its default one"
+    return COMPRESSORS[name] if level is None else type(COMPRESSORS[name])(level)
+
+
+def negotiate_compressor(offered, available=COMPRESSORS):
+    "Picks the first compressor offered by the other side that is available here, None to send frames as they are"
+    return next((available[name] for name in offered if name in available), None)
+
+
+def pack(data, compressor=None, threshold=COMPRESS_THRESHOLD):
+    "Prefixes an encoded message with its length, compressing it first if it is large and that makes it smaller"
+    size = len(data)
+    if compressor and size >= threshold:
+        compressed = compressor.compress(data)
+        if len(compressed) < size:
+            data = compressed
+            size = len(data) | COMPRESSED
+    return size.to_bytes(4, byteorder='big') + data
+
+
+def unpack(size, data, compressor, limit=MAX_FRAME_SIZE):
+    "The encoded message of a frame, given the length it was sent with, compressed ones may expand up to limit bytes"
+    if size & COMPRESSED:
+        if compressor is None:
+            raise ValueError('Compressed frame before compression was negotiated')
+        return compressor.decompress(data, limit)
+    return data
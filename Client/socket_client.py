@@ -1,11 +1,35 @@
 import asyncio
-import json
+import hashlib
+import itertools
+import os
 import ssl
+import uuid
 
+import codec
 from collections import defaultdict
 
 
 RECONNECT_INTERVAL = 5
+CHUNK_SIZE = 64 * 1024 # Bytes per attachment chunk
+PRECHECK_TIMEOUT = 10 # Seconds to wait for the server to say if it has an attachment
+REQUEST_TIMEOUT = 30 # Default seconds to wait for the reply to a request
+
+
+def file_hash(path):
+    "Content hash the server names attachments by"
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadError(Exception):
+    "The server did not store an attachment, the message is the reason it gave"
+
 
 class Event(list):
     "Basically a list of functions"
@@ -16,7 +40,7 @@ class Event(list):
 
 class SocketClient:
     "Connects to server and handles data transfer"
-    def __init__(self, host, port):
+    def __init__(self, host, port, certfile='chatserver.crt', compressors=codec.COMPRESSORS, compress_threshold=codec.COMPRESS_THRESHOLD):
         self.host = host
         self.port = port
         self.reconnecting = True
@@ -24,24 +48,104 @@ class SocketClient:
         # Configure ssl connection (trust certificates and ignore hostnames)
         self.sslcontext = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
         self.sslcontext.check_hostname = False
-        self.sslcontext.load_verify_locations('chatserver.crt')
+        self.sslcontext.load_verify_locations(certfile)
 
         self.events = defaultdict(Event)
+        self.codec = codec.JSON
+        self.compressors = compressors # name -> compressor offered to the server, empty turns compression off
+        self.compress_threshold = compress_threshold
+        self.compressor = None
+        self.reader = None
+        self.writer = None
+        self.heartbeat = None # Seconds the server may stay silent before it is pinged, if it pings us too
+        self.last_heard = 0
+
+        # Requests waiting for their reply
+        self.request_ids = itertools.count(1)
+        self.pending = {} # request id -> future of (header, body)
 
     def send_data(self, header, **data):
-        "Helper function to asynchronously send data to server"
-        asyncio.create_task(self.send(header, data))
+        "Helper function to asynchronously send data to server, returns the task sending it"
+        return asyncio.create_task(self.send(header, data))
+
+    async def request(self, header, timeout=REQUEST_TIMEOUT, **data):
+        "Sends a request and returns the (header, body) of its reply, raises asyncio.TimeoutError or ConnectionError"
+        if not self.writer or self.writer.is_closing():
+            raise ConnectionResetError('Not connected')
+
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.send(header, data, request_id)
+            # Cancelling the caller cancels the wait, a reply arriving later is only passed to the events
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def fail_pending(self, error):
+        "Fails every request still waiting, their replies can no longer arrive"
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
 
     def register_event(self, eventname, func):
         "Creates an event if not exists and adds a listener"
         self.events[eventname].append(func)
 
+    async def wait_event(self, eventname, match=lambda body: True, timeout=None):
+        "Waits for the next event whose body matches"
+        future = asyncio.get_running_loop().create_future()
+        def listener(body):
+            if not future.done() and match(body):
+                future.set_result(body)
+
+        self.register_event(eventname, listener)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.events[eventname].remove(listener)
+
     async def start(self):
         "Starts a new connection to the server"
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.sslcontext)
         print(f'Connected to {self.host}:{self.port}')
+        await self.handshake()
         self.events['RECONNECT']()
-        await self.listen()
+        watchdog = asyncio.create_task(self.watchdog()) if self.heartbeat else None
+        try:
+            await self.listen()
+        finally:
+            if watchdog:
+                watchdog.cancel()
+
+    async def handshake(self):
+        "Offers our codecs and compressors to the server and switches to the ones it picks"
+        # Every connection starts with uncompressed json, servers without HELLO reply with an error
+        self.codec = codec.JSON
+        self.compressor = None
+        self.heartbeat = None
+        await self.send('HELLO', {'codecs': list(codec.CODECS), 'compressors': list(self.compressors), 'heartbeat': True})
+        header, body = await self.read()
+        if header == 'HELLO':
+            self.codec = codec.CODECS[body['codec']]
+            # Older servers do not compress or ping and leave these out
+            self.compressor = self.compressors.get(body.get('compressor'))
+            self.heartbeat = body.get('heartbeat')
+
+    async def watchdog(self):
+        "Pings the server once it has been silent for a heartbeat, drops the connection if it stays silent for another"
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            silent = loop.time() - self.last_heard
+            if silent > 2 * self.heartbeat:
+                print('Server stopped answering')
+                self.writer.transport.abort() # Ends listen, connect() then opens a new connection
+                return
+            if silent > self.heartbeat:
+                self.send_data('PING')
 
     async def connect(self):
         "Starting point - manages reconnection to server"
@@ -50,43 +154,87 @@ class SocketClient:
                 await self.start()
             except (OSError, ConnectionError, TimeoutError):
                 print('Connection Lost!')
+            self.fail_pending(ConnectionResetError('Connection lost'))
 
             await asyncio.sleep(RECONNECT_INTERVAL)
             print('Reconnecting...')
 
-    async def send(self, header, body={}):
+    async def send(self, header, body={}, request_id=None):
         "Sends a message to the server"
         if not self.writer:
             return
-        # Encode data in json, get the size and transmit the data
-        data = json.dumps({
+        # Encode data with the negotiated codec, compress it if it is large and transmit it with its size
+        message = {
             'header': header,
             'body': body
-        }).encode('utf8')
-        
-        size = len(data).to_bytes(4, byteorder='big')
-        
-        self.writer.writelines([size, data])
+        }
+        if request_id is not None:
+            message['id'] = request_id
+        data = codec.pack(self.codec.encode(message), self.compressor, self.compress_threshold)
+
+        self.writer.write(data)
         await self.writer.drain()
 
+    async def upload(self, path):
+        "Streams a file to the server in chunks unless it already has it, returns the upload id to attach to a message"
+        uploadid = uuid.uuid4().hex
+        size = os.path.getsize(path)
+        actualname = os.path.basename(path)
+
+        # Ask the server whether it already has this content
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, file_hash, path)
+        try:
+            header, reply = await self.request('HAS_ATTACHMENT', PRECHECK_TIMEOUT, uploadid=uploadid, hash=digest, size=size, actualname=actualname)
+            if header == 'HAS_ATTACHMENT' and reply['exists']:
+                return uploadid
+        except asyncio.TimeoutError:
+            pass # Older servers do not answer, upload it anyway
+
+        await self.send('UPLOAD_START', {'uploadid': uploadid, 'actualname': actualname, 'size': size})
+        with open(path, 'rb') as file:
+            while True:
+                chunk = await loop.run_in_executor(None, file.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                await self.send('UPLOAD_CHUNK', {'uploadid': uploadid, 'data': chunk})
+
+        # Wait until it is stored, so a message sent next can attach it. An upload the server
+        # rejected, at the start or while receiving it, gets an ERROR or only an ACK instead
+        header, reply = await self.request('UPLOAD_END', uploadid=uploadid)
+        if header != 'UPLOAD_DONE':
+            raise UploadError(reply.get('message') or 'The server did not store the attachment')
+        return uploadid
+
     async def read(self):
         "Receive message sent from server"
         # First get the size of data packet
         # Then read exactly that many bytes
-        # Decode json object and return header and body
-        size = await self.reader.readexactly(4)
-        data = await self.reader.readexactly(int.from_bytes(size, byteorder='big'))
-        data = json.loads(data.decode('utf8'))
-
+        # Decode it with the negotiated codec and return header and body
+        data = await self.read_message()
         return data.get('header'), data.get('body')
+
+    async def read_message(self):
+        size = int.from_bytes(await self.reader.readexactly(4), byteorder='big')
+        data = await self.reader.readexactly(size & codec.MAX_FRAME_SIZE)
+        self.last_heard = asyncio.get_running_loop().time()
+        return self.codec.decode(codec.unpack(size, data, self.compressor))
     
     async def listen(self):
         "Infinite loop to keep receiving messages from server and transmitting it to respective listeners"
         try:
             while True:
-                header, body = await self.read()
-                print(header)
-                
+                data = await self.read_message()
+                header, body = data.get('header'), data.get('body')
+
+                # The first reply to a request resolves it, every frame still goes to the listeners
+                future = self.pending.pop(data.get('id'), None)
+                if future and not future.done():
+                    future.set_result((header, body))
+
+                if header == 'PING':
+                    self.send_data('PONG')
+
                 if header in self.events:
                     self.events[header](body)
         except asyncio.IncompleteReadError:
@@ -0,0 +1,86 @@
+"""
+Storage backends for the connection pool
+
+database.py and migrations.py are written against DB-API cursors taking %s
+placeholders, so the same functions run on every backend. The few
+statements that differ are looked up by Session.dialect. A backend needs:
+
+    name - the dialect of its sessions
+    connect(**config) - opens a new connection and returns it as a Session
+"""
+import sqlite3
+
+from datetime import datetime
+
+try:
+    import mysql.connector
+except ImportError:
+    mysql = None
+
+
+SQLITE_BUSY_TIMEOUT = 30 # Seconds a connection waits for another one to finish writing
+
+# Store datetimes the way MySQL returns them, as naive local time
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+class Session:
+    "A pooled connection along with its prepared cursor"
+    def __init__(self, conn, cursor, dialect):
+        self.conn = conn
+        self.cursor = cursor
+        self.dialect = dialect
+
+
+class MySQLBackend:
+    "A MySQL server, needs the mysql-connector-python package"
+    name = 'mysql'
+
+    def connect(self, **config):
+        if mysql is None:
+            raise RuntimeError('The mysql backend needs the mysql-connector-python package')
+        conn = mysql.connector.connect(**config)
+        return Session(conn, conn.cursor(prepared=True), self.name)
+
+
+class SQLiteCursor:
+    "Takes %s placeholders like the MySQL cursor"
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace('%s', '?'), params)
+
+    def executemany(self, query, params):
+        self.cursor.executemany(query.replace('%s', '?'), params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class SQLiteBackend:
+    "A database file in WAL mode, needs no server and readers never wait for the writer"
+    name = 'sqlite'
+
+    def connect(self, database):
+        # Sessions move between the database threads, but only one uses a session at a time
+        conn = sqlite3.connect(database, timeout=SQLITE_BUSY_TIMEOUT, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL') # A power cut may lose the last commits, never corrupt the file
+        conn.execute('PRAGMA foreign_keys=ON') # Deletes cascade as they do on MySQL
+        return Session(conn, SQLiteCursor(conn.cursor()), self.name)
+
+
+BACKENDS = {backend.name: backend for backend in (MySQLBackend(), SQLiteBackend())}
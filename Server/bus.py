@@ -0,0 +1,120 @@
+"""
+Pub/sub buses that connect the worker processes of one server
+
+The server publishes an (event, args) pair for every delivery or state
+change that other workers have to apply as well, such as a message to a
+room whose members are connected to several workers. A bus needs:
+
+    start(handler)  - coroutine, handler(event, args) is then called for
+                      every event published by another worker
+    publish(event, args) - sends an event to every other worker, without blocking
+    close()
+"""
+import asyncio
+import logging
+import os
+import pickle
+
+import logs
+
+
+logger = logging.getLogger('chat.bus')
+
+
+class LocalBus:
+    "A single process server has nobody to tell"
+    async def start(self, handler):
+        pass
+
+    def publish(self, event, args):
+        pass
+
+    def close(self):
+        pass
+
+
+def pack(data):
+    return len(data).to_bytes(4, byteorder='big') + data
+
+
+async def read_frame(reader):
+    size = await reader.readexactly(4)
+    return await reader.readexactly(int.from_bytes(size, byteorder='big'))
+
+
+class UnixBus:
+    "Connects to a Broker on a local Unix socket, events are pickled since only our own workers can reach it"
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.reader_task = None
+
+        # Metrics
+        self.published = 0
+        self.received = 0
+
+    async def start(self, handler):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.create_task(self.read_loop(reader, handler))
+
+    async def read_loop(self, reader, handler):
+        try:
+            while True:
+                event, args = pickle.loads(await read_frame(reader))
+                self.received += 1
+                try:
+                    handler(event, args)
+                except Exception:
+                    logger.exception('Could not apply an event from the bus', extra={'event': event})
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            # Workers can no longer agree on rooms and users, stop rather than serve wrong data
+            logger.critical('Lost the connection to the bus broker', extra={'error': str(e)})
+            logs.stop()
+            os._exit(1)
+
+    def publish(self, event, args):
+        self.published += 1
+        self.writer.write(pack(pickle.dumps((event, args), protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class Broker:
+    "Forwards every frame a worker publishes to all of the other workers, in the order it was received"
+    def __init__(self, path):
+        self.path = path
+        self.workers = set() # StreamWriters of connected workers
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path) # Left over from a previous run
+        old_umask = os.umask(0o177) # Only this user may connect
+        try:
+            self.server = await asyncio.start_unix_server(self.handle, self.path)
+        finally:
+            os.umask(old_umask)
+
+    async def handle(self, reader, writer):
+        self.workers.add(writer)
+        try:
+            while True:
+                frame = pack(await read_frame(reader))
+                for worker in self.workers:
+                    if worker is not writer:
+                        worker.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+
+    def close(self):
+        self.server.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
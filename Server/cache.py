@@ -0,0 +1,90 @@
+import time
+
+from collections import OrderedDict
+
+
+class Cache:
+    "In memory read-through cache, least recently used entries are evicted past max_size and entries expire after ttl seconds"
+    def __init__(self, name, max_size=1024, ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl # None keeps entries until they are evicted or invalidated
+        self.entries = OrderedDict() # key -> (expires, value), least recently used first
+
+        # Bumped by every invalidation, a load that started before one may have read old data
+        self.generation = 0
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        "Returns (found, value)"
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        expires, value = entry
+        if expires is not None and expires < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return False, None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def fetch(self, key, load, *args):
+        "Returns the cached value, or awaits load(*args) and caches what it returns unless that is None"
+        found, value = self.get(key)
+        if found:
+            return value
+
+        generation = self.generation
+        value = await load(*args)
+        if value is not None and generation == self.generation:
+            self.put(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        "Forgets the given keys, call it after every write that changes them"
+        self.generation += 1
+        for key in keys:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_where(self, predicate):
+        "Forgets every entry for which predicate(key, value) is true, for writes that touch many keys"
+        self.invalidate(*[key for key, (_, value) in self.entries.items() if predicate(key, value)])
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
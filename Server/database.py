@@ -1,103 +1,82 @@
-import hashlib
 import base64
-import os
-import uuid
+import files
+import logging
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
-def encrypt_password(password):
-    salt = os.urandom(16)
-    hashed = hashlib.sha512(password.encode('utf8')+salt).digest()
-    return base64.b64encode(salt + hashed) # 108 chars fixed
+logger = logging.getLogger('chat.database')
 
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
 
-def compare_password(raw, encrypted):
-    try:
-        decoded = base64.b64decode(encrypted)
-        salt, password = decoded[:16], decoded[16:] # Get salt and sha512 password
+# Statements that differ between backends, by session dialect.
+# Records an attachment, adding refs to the references of an existing one
+UPSERT_ATTACHMENT = {
+    'mysql': """
+INSERT INTO attachments (filename, size, refs, last_used) VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE refs = refs + VALUES(refs), last_used = VALUES(last_used)""",
+    'sqlite': """
+INSERT INTO attachments (filename, size, refs, last_used) VALUES (%s, %s, %s, %s)
+ON CONFLICT (filename) DO UPDATE SET refs = refs + excluded.refs, last_used = excluded.last_used"""
+}
 
-        hashed = hashlib.sha512(raw.encode('utf8')+salt).digest() # hash input with same salt
-        return hashed == password
-    except Exception as e:
-        return False
 
+# Password hashing happens in passwords.py, out of the database threads.
+# These only read and store the hashes
 
-def store_file(filedata):
-    filename = uuid.uuid4().hex
-    with open(f'./uploads/{filename}', 'wb') as file:
-        filedata = base64.b64decode(filedata.encode())
-        file.write(filedata)
-    return filename
-
-
-def change_password(server, user, oldpass, newpass):
-    server.cursor.execute("SELECT password FROM users WHERE userid=%s", (user[0],))
-    hashed = server.cursor.fetchone()
-    if hashed and compare_password(oldpass, hashed[0]):
-        hashed_pass = encrypt_password(newpass)
-        server.cursor.execute("UPDATE users SET password=%s WHERE userid=%s", (hashed_pass, user[0]))
-        server.conn.commit()
-        return 'INFO', {'message': 'Password Updated!'}
-    else:
-        return 'ERROR', {'message': 'Invalid password'}
+
+def fetch_login(session, email):
+    "The user row followed by the stored password hash"
+    session.cursor.execute("SELECT userid, email, username, phone, address, password FROM users WHERE email=%s", (email,))
+    return session.cursor.fetchone()
 
 
-def register_user(server, email, username, password):
+def fetch_password(session, userid):
+    session.cursor.execute("SELECT password FROM users WHERE userid=%s", (userid,))
+    hashed = session.cursor.fetchone()
+    return hashed[0] if hashed else None
+
+
+def set_password(session, userid, hashed):
+    session.cursor.execute("UPDATE users SET password=%s WHERE userid=%s", (hashed, userid))
+
+
+def register_user(session, email, username, hashed):
     try:
-        hashed = encrypt_password(password)
-        server.cursor.execute("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)", (username,email,hashed))
-        server.conn.commit()
+        session.cursor.execute("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)", (username,email,hashed))
         return True
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return False
-    
-def login_user(server, email, password):
-    server.cursor.execute("SELECT password FROM users WHERE email=%s", (email,))
-    hashed = server.cursor.fetchone()
-    if hashed and compare_password(password, hashed[0]):
-        # Enter actual query here..
-        server.cursor.execute("SELECT userid, email, username, phone, address FROM users WHERE email=%s", (email,))
-        return True, server.cursor.fetchone()
-    else:
-        return False, None
 
 
-def delete_account(server, user, password):
-    server.cursor.execute("SELECT password FROM users WHERE userid=%s", (user[0],))
-    hashed = server.cursor.fetchone()
-    if hashed and compare_password(password, hashed[0]):
-        server.cursor.execute("DELETE FROM users WHERE userid=%s", (user[0],))
-        server.conn.commit()
-        return True
-    else:
-        return False
+def delete_account(session, user):
+    session.cursor.execute("DELETE FROM users WHERE userid=%s", (user[0],))
 
 
-def update_profile(server, user, username, phone, address):
+def update_profile(session, user, username, phone, address):
     try:
-        server.cursor.execute("UPDATE users SET username=%s, phone=%s, address=%s WHERE userid=%s", (username, phone, address, user[0]))
-        server.conn.commit()
+        session.cursor.execute("UPDATE users SET username=%s, phone=%s, address=%s WHERE userid=%s", (username, phone, address, user[0]))
         return 'INFO', {'message': 'Profile Successfully Updated!'}
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return 'ERROR', {'message': 'Could not update profile information'}
 
 
-def fetch_rooms(server, user):
-    server.cursor.execute("""
+def fetch_rooms(session, user):
+    session.cursor.execute("""
 SELECT rooms.roomid, roomname, ownerid FROM 
   rooms, room_members
 WHERE
   room_members.roomid = rooms.roomid
   AND room_members.userid = %s;""", [user[0]])
 
-    return server.cursor.fetchall()
+    return session.cursor.fetchall()
 
 
-def fetch_members(server, user, body):
-    server.cursor.execute("""
+def fetch_members(session, user, body):
+    session.cursor.execute("""
 SELECT r2.roomid, users.userid, email, username
 FROM room_members r1 JOIN room_members r2 ON 
   r2.roomid = r1.roomid
@@ -106,145 +85,226 @@ JOIN users ON
 WHERE 
   r1.userid=%s AND r2.userid != %s""", (user[0], user[0]))
 
-    return server.cursor.fetchall()
+    return session.cursor.fetchall()
 
 
-def fetch_recent_chats(server, user, body):
-    server.cursor.execute("""
-SELECT 'public', m.roomid, content, email, username, actualname, filename, created_at FROM
+def fetch_recent_chats(session, user, body):
+    session.cursor.execute("""
+SELECT 'public', m.roomid, content, email, username, actualname, filename, created_at, messageid FROM
   messages m, users, room_members rm
 WHERE
   m.author = users.userid AND
   m.roomid = rm.roomid AND rm.userid = %s
 UNION 
-SELECT 'private', f.id, content, email, username, actualname, filename, created_at FROM
+SELECT 'private', f.id, content, email, username, actualname, filename, created_at, messageid FROM
+  messages m, users, friends f
+WHERE
+  m.author = users.userid AND m.friendid = f.id AND f.userid1=%s
+UNION
+SELECT 'private', f.id, content, email, username, actualname, filename, created_at, messageid FROM
   messages m, users, friends f
 WHERE
-  m.author = users.userid AND m.friendid = f.id AND
-  (f.userid1=%s OR f.userid2=%s)
+  m.author = users.userid AND m.friendid = f.id AND f.userid2=%s
 ORDER BY created_at DESC;""", [user[0]]*3)
 
-    return server.cursor.fetchall()
+    return session.cursor.fetchall()
+
+
+def fetch_history(session, user, type, _id, before=None, limit=HISTORY_PAGE_SIZE):
+    "One page of a conversation, newest first, older pages are fetched with the oldest messageid as the cursor"
+    limit = max(1, min(int(limit), MAX_HISTORY_PAGE_SIZE))
+    before = before or 2**31 # Past the largest INT messageid
+    if type == 'public':
+        session.cursor.execute("""
+SELECT content, email, username, actualname, filename, created_at, messageid FROM
+  messages m JOIN users ON users.userid = m.author
+WHERE
+  m.roomid = %s AND m.messageid < %s
+  AND EXISTS (SELECT 1 FROM room_members WHERE roomid = %s AND userid = %s)
+ORDER BY m.messageid DESC LIMIT %s;""", (_id, before, _id, user[0], limit + 1))
+    else:
+        session.cursor.execute("""
+SELECT content, email, username, actualname, filename, created_at, messageid FROM
+  messages m JOIN users ON users.userid = m.author
+WHERE
+  m.friendid = %s AND m.messageid < %s
+  AND EXISTS (SELECT 1 FROM friends WHERE id = %s AND (userid1 = %s OR userid2 = %s))
+ORDER BY m.messageid DESC LIMIT %s;""", (_id, before, _id, user[0], user[0], limit + 1))
+
+    messages = session.cursor.fetchall()
+    return messages[:limit], len(messages) > limit
 
 
-def add_message(server, user, _id, content, attachment, private=False):
+def insert_message(session, user, _id, content, attachment=None, private=False, stored=None):
+    "Inserts a message and returns it as it is sent to clients, errors are left to the caller"
     now = datetime.now()
-    if attachment:
+    if stored:
+        actualname, filename, size = stored # Already streamed to the uploads folder
+    elif attachment:
         actualname, filedata = attachment
-        filename = store_file(filedata)
+        filedata = base64.b64decode(filedata.encode())
+        filename, size = files.store(filedata), len(filedata)
     else:
         filename, actualname = None, None
 
+    if private:
+        query = "INSERT INTO messages (friendid, author, content, actualname, filename, created_at) VALUES (%s, %s, %s, %s, %s, %s)"
+    else:
+        query = "INSERT INTO messages (roomid, author, content, actualname, filename, created_at) VALUES (%s, %s, %s, %s, %s, %s)"
+
+    session.cursor.execute(query, (_id, user[0], content, actualname, filename, now))
+    messageid = session.cursor.lastrowid
+    if filename:
+        session.cursor.execute(UPSERT_ATTACHMENT[session.dialect], (filename, size, 1, now))
+    return [_id, content, user[1], user[2], actualname, filename, now, messageid]
+
+
+def add_message(session, user, **message):
     try:
-        if private:
-            query = "INSERT INTO messages (friendid, author, content, actualname, filename, created_at) VALUES (%s, %s, %s, %s, %s, %s)"
-        else:
-            query = "INSERT INTO messages (roomid, author, content, actualname, filename, created_at) VALUES (%s, %s, %s, %s, %s, %s)"
-
-        server.cursor.execute(query, (_id, user[0], content, actualname, filename, now))
-        server.conn.commit()
-        return [_id, content, user[1], user[2], actualname, filename, now]
+        return insert_message(session, user, **message)
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return False
 
 
-def create_room(server, user, roomname, members):
+def add_messages(session, messages):
+    "Inserts a batch of (user, message) pairs in one transaction, any failure rolls back the whole batch"
+    return [insert_message(session, user, **message) for user, message in messages]
+
+
+def add_attachment(session, filename, size):
+    "Records a finished upload, it is unreferenced until a message uses it"
+    session.cursor.execute(UPSERT_ATTACHMENT[session.dialect], (filename, size, 0, datetime.now()))
+
+
+def has_attachment(session, filename, size):
+    "Whether the attachment is stored, touching it so the collector keeps it for another grace period"
+    session.cursor.execute("UPDATE attachments SET last_used=%s WHERE filename=%s AND size=%s", (datetime.now(), filename, size))
+    session.cursor.execute("SELECT 1 FROM attachments WHERE filename=%s AND size=%s", (filename, size))
+    return session.cursor.fetchone() is not None
+
+
+def collect_attachments(session, grace):
+    "Recounts references to every attachment, returns the file names of the unused ones older than grace seconds"
+    # Messages also disappear through ON DELETE CASCADE, so the counts are rebuilt rather than decremented
+    session.cursor.execute("""
+UPDATE attachments SET refs = (SELECT COUNT(*) FROM messages WHERE messages.filename = attachments.filename);""")
+    session.cursor.execute("""
+SELECT filename FROM attachments
+WHERE refs = 0 AND last_used < %s;""", (datetime.now() - timedelta(seconds=grace),))
+    return [r[0] for r in session.cursor.fetchall()]
+
+
+def delete_attachment(session, filename, grace):
+    "Deletes an attachment and its file if it is still unused and untouched for grace seconds, returns whether it did"
+    session.cursor.execute("DELETE FROM attachments WHERE filename=%s AND refs = 0 AND last_used < %s",
+                           (filename, datetime.now() - timedelta(seconds=grace)))
+    if session.cursor.rowcount == 0:
+        return False # Sent, checked for or uploaded again since it was collected
+    # Removed before the deletion commits, an upload of the same content waits on the row until then and stores the file again
+    files.remove(filename)
+    return True
+
+
+def create_room(session, user, roomname, members):
     try:
-        server.cursor.execute("INSERT INTO rooms (roomname, ownerid) VALUES (%s, %s)", (roomname, user[0]))
-        roomid = server.cursor.lastrowid
+        session.cursor.execute("INSERT INTO rooms (roomname, ownerid) VALUES (%s, %s)", (roomname, user[0]))
+        roomid = session.cursor.lastrowid
         
         val = [(userid, roomid) for userid in members]
-        server.cursor.executemany("INSERT INTO room_members (userid, roomid) VALUES (%s, %s)", val)
-        server.conn.commit()
+        session.cursor.executemany("INSERT INTO room_members (userid, roomid) VALUES (%s, %s)", val)
         return roomid, roomname, user[0]
     except Exception as e:
-        print(e)
-        server.conn.rollback()
+        logger.warning(e)
+        session.conn.rollback()
         return False
 
 
-def invite_member(server, user, roomid, email):
-    server.cursor.execute('SELECT userid, email, username FROM users WHERE email=%s', (email,))
-    member = server.cursor.fetchone()
-    if not member:
-        return 'ERROR', {'message': 'Email ID not found'}
-
+def invite_member(session, user, roomid, member):
+    "Adds the member, a (userid, email, username) row from fetch_user, to the room"
     try:
-        server.cursor.execute("INSERT INTO room_members (userid, roomid) VALUES (%s, %s)", (member[0], roomid))
-        server.conn.commit()
+        session.cursor.execute("INSERT INTO room_members (userid, roomid) VALUES (%s, %s)", (member[0], roomid))
         return 'MEMBER_JOIN', member
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return 'ERROR', {'message': 'This user is already in the room'}
 
 
-def leave_member(server, user, memberid, roomid):
+def leave_member(session, user, memberid, roomid):
     try:
-        server.cursor.execute("DELETE FROM room_members WHERE userid=%s AND roomid=%s", (memberid, roomid))
-        server.conn.commit()
+        session.cursor.execute("DELETE FROM room_members WHERE userid=%s AND roomid=%s", (memberid, roomid))
         return True
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return False
 
-def delete_room(server, user, roomid):
+def delete_room(session, user, roomid):
     try:
-        server.cursor.execute("DELETE FROM rooms WHERE roomid=%s AND ownerid=%s", (roomid,user[0]))
-        server.conn.commit()
+        session.cursor.execute("DELETE FROM rooms WHERE roomid=%s AND ownerid=%s", (roomid,user[0]))
         return True
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return False
 
-def fetch_friends(server, user):
-    server.cursor.execute("""
-SELECT f.id, u.userid, email, username FROM 
-  friends f, users u
-WHERE
-  f.userid2 = u.userid AND f.userid1 = %s
-  OR f.userid1 = u.userid AND f.userid2 = %s;
+def fetch_friends(session, user):
+    session.cursor.execute("""
+SELECT f.id, u.userid, email, username FROM
+  friends f JOIN users u ON f.userid2 = u.userid
+WHERE f.userid1 = %s
+UNION ALL
+SELECT f.id, u.userid, email, username FROM
+  friends f JOIN users u ON f.userid1 = u.userid
+WHERE f.userid2 = %s;
 """, (user[0], user[0]))
 
-    return server.cursor.fetchall()
+    return session.cursor.fetchall()
 
 
-def add_friend(server, user, email):
+def add_friend(session, user, friend):
+    "Befriends a (userid, email, username) row from fetch_user"
     # Make sure userid1 < userid2, so we know how the record was inserted
-    server.cursor.execute("SELECT userid, email, username FROM users WHERE email=%s", (email,))
-    friend = server.cursor.fetchone()
-    if not friend:
-        return 'ERROR', {'message': 'Email ID not found!'}
-
     user1, user2 = sorted([user[0], friend[0]])
     try:
-        server.cursor.execute("INSERT INTO friends (userid1, userid2) VALUES (%s, %s)", (user1, user2))
-        server.conn.commit()
-        return 'ADD_FRIEND', (server.cursor.lastrowid, *friend)
+        session.cursor.execute("INSERT INTO friends (userid1, userid2) VALUES (%s, %s)", (user1, user2))
+        return 'ADD_FRIEND', (session.cursor.lastrowid, *friend)
     except Exception as e:
-        print(e)
-        server.conn.rollback()
+        logger.warning(e)
+        session.conn.rollback()
         return 'ERROR', {'message': 'You already have that user as a friend'}
 
 
-def remove_friend(server, user, fid, fuser):
+def remove_friend(session, user, fid, fuser):
     user1, user2 = sorted([user[0], fuser])
     try:
-        server.cursor.execute("DELETE FROM friends WHERE id=%s AND userid1=%s AND userid2=%s", (fid, user1, user2))
-        server.conn.commit()
+        session.cursor.execute("DELETE FROM friends WHERE id=%s AND userid1=%s AND userid2=%s", (fid, user1, user2))
+        if session.cursor.rowcount == 0:
+            return 'ERROR', {'message': 'You are not friends with that user'}
         return 'REMOVE_FRIEND', fid
     except Exception as e:
-        print(e)
+        logger.warning(e)
         return 'ERROR', {'message': 'hm'}
 
-def fetch_user(server, user, email):
-    server.cursor.execute('SELECT userid, email, username FROM users WHERE email=%s', (email,))
-    res = server.cursor.fetchone()
-    if not res:
-        return 'ERROR', {'message': 'This email ID doesnt exist'}
-    else:
-        return 'FETCH_USER', res
-
-def fetch_single_room(server, roomid):
-    server.cursor.execute('SELECT * FROM rooms WHERE roomid=%s', (roomid,))
-    return server.cursor.fetchone()
+def fetch_user(session, email):
+    "The (userid, email, username) row for an email id, None if nobody has it"
+    session.cursor.execute('SELECT userid, email, username FROM users WHERE email=%s', (email,))
+    return session.cursor.fetchone()
+
+def fetch_single_room(session, roomid):
+    session.cursor.execute('SELECT * FROM rooms WHERE roomid=%s', (roomid,))
+    return session.cursor.fetchone()
+
+
+# The reads run on every login and chat switch, as (function, args, kwargs) querying as
+# HOT_USER. tests/test_query_plans.py checks that they use indexes and
+# benchmarks/micro.py times them, both against databases where that user exists
+HOT_USER = [1, 'user@example.com', 'user']
+HOT_QUERIES = [
+    (fetch_rooms, (HOT_USER,), {}),
+    (fetch_members, (HOT_USER, {}), {}),
+    (fetch_friends, (HOT_USER,), {}),
+    (fetch_recent_chats, (HOT_USER, {}), {}),
+    (fetch_history, (HOT_USER, 'public', 1), {'before': 1000}),
+    (fetch_history, (HOT_USER, 'private', 1), {'before': 1000}),
+    (fetch_user, (HOT_USER[1],), {}),
+    (fetch_single_room, (1,), {})
+]
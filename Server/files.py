@@ -0,0 +1,139 @@
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import uuid
+
+
+UPLOAD_DIR = 'uploads'
+CHUNK_SIZE = 64 * 1024 # Bytes per UPLOAD_CHUNK / FILE_CHUNK frame
+MAX_UPLOAD_SIZE = 50 * (2**20)
+MAX_PENDING_UPLOADS = 8 # Per connection, finished uploads count until they are sent
+
+# Stored files are named after a 16 byte blake2b digest of their content,
+# the same length as the uuid4 names used before, so identical attachments are stored once
+FILENAME_REGEX = re.compile(r"^[0-9a-f]{32}$")
+
+
+def path(filename):
+    "Path of a stored attachment, rejects anything that is not a stored file name"
+    if not isinstance(filename, str) or not FILENAME_REGEX.match(filename):
+        raise ValueError(f'Invalid file name {filename!r}')
+    return os.path.join(UPLOAD_DIR, filename)
+
+
+def new_hash():
+    "The content hash that names stored files, clients must compute the same one"
+    return hashlib.blake2b(digest_size=16)
+
+
+def store(data):
+    "Stores bytes under their content hash, returns the file name"
+    digest = new_hash()
+    digest.update(data)
+    filename = digest.hexdigest()
+    if not os.path.exists(path(filename)):
+        partpath = os.path.join(UPLOAD_DIR, uuid.uuid4().hex + '.part')
+        with open(partpath, 'wb') as file:
+            file.write(data)
+        os.replace(partpath, path(filename))
+    return filename
+
+
+def read_base64(filename):
+    "A stored file base64 encoded, blocking so it is run in the executor"
+    with open(path(filename), 'rb') as file:
+        return base64.b64encode(file.read()).decode()
+
+
+def remove(filename):
+    "Deletes a stored file, if it is still there"
+    try:
+        os.remove(path(filename))
+    except OSError:
+        pass
+
+
+async def run(func, *args):
+    "Runs blocking file io in the default executor"
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+class Stored:
+    "An attachment the server already has, it can be sent without uploading it again"
+    complete = True
+
+    def __init__(self, actualname, filename, size):
+        self.actualname = actualname
+        self.filename = filename
+        self.size = size
+
+    def abort(self):
+        pass
+
+
+class Upload:
+    "An attachment being received in chunks, written straight to a temporary file"
+    def __init__(self, actualname, size):
+        if not 0 <= size <= MAX_UPLOAD_SIZE:
+            raise ValueError('Cannot send attachment greater than 50 MB')
+
+        self.actualname = actualname
+        self.size = size
+        self.received = 0
+        self.complete = False
+        self.filename = None # Known once every chunk has been hashed
+        self.hash = new_hash()
+        self.partpath = os.path.join(UPLOAD_DIR, uuid.uuid4().hex + '.part')
+        self.file = open(self.partpath, 'wb')
+
+    def write_chunk(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    async def write(self, data):
+        "Appends a chunk, fails if the client sends more than it announced"
+        self.received += len(data)
+        if self.received > self.size:
+            raise ValueError('Received more data than announced')
+        await run(self.write_chunk, data)
+
+    def finish(self):
+        "Closes the file once every byte arrived, returns the file name it is stored under"
+        self.file.close()
+        if self.received != self.size:
+            self.abort()
+            raise ValueError('Upload is incomplete')
+        self.filename = self.hash.hexdigest()
+        return self.filename
+
+    async def store(self):
+        "Moves the finished file into place, unless the same content is already stored"
+        if await run(os.path.exists, path(self.filename)):
+            self.abort() # Same content is already stored
+        else:
+            await run(os.replace, self.partpath, path(self.filename))
+        self.complete = True
+
+    def abort(self):
+        "Throws away the partial file, finished files are left for the attachment collector since others may share them"
+        self.file.close()
+        try:
+            os.remove(self.partpath)
+        except OSError:
+            pass
+
+
+async def read_chunks(filename):
+    "Yields a stored file in chunks without loading it into memory"
+    file = await run(open, path(filename), 'rb')
+    try:
+        while True:
+            chunk = await run(file.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        file.close()
@@ -0,0 +1,73 @@
+"""
+Logging for the server
+
+Records are put on a queue by the event loop and written by a background
+thread, so a slow terminal or disk never blocks serving clients. Extra
+fields passed with extra={...} are appended as key=value pairs.
+
+Requests are logged on the 'chat.requests' logger, only when it is enabled
+and then only for a sampled fraction of each route.
+"""
+import logging
+import logging.handlers
+import queue
+import random
+
+
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+REQUEST_SAMPLE_RATE = 0 # Fraction of requests logged, 0 turns request logging off
+REQUEST_SAMPLE_RATES = {'UPLOAD_CHUNK': 0.01} # Per route overrides, applied while request logging is on
+
+requests = logging.getLogger('chat.requests')
+listener = None
+sample_rates = {}
+default_rate = 0
+
+# Attributes every record has, anything else came in through extra
+STANDARD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class FieldsFormatter(logging.Formatter):
+    "Formats the message followed by its extra fields as key=value"
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = ' '.join(f'{key}={value!r}' for key, value in record.__dict__.items() if key not in STANDARD_FIELDS)
+        return f'{message} {fields}' if fields else message
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    "Queues records as they are, so even formatting happens on the writer thread"
+    def prepare(self, record):
+        return record
+
+
+def setup(level=LOG_LEVEL, request_rate=REQUEST_SAMPLE_RATE, rates=REQUEST_SAMPLE_RATES):
+    "Routes every record through a queue to a writer thread, returns the started listener"
+    global default_rate, listener
+    default_rate = request_rate
+    sample_rates.clear()
+    sample_rates.update(rates)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(FieldsFormatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(listener.queue)]
+    root.setLevel(level)
+    requests.setLevel(logging.INFO if request_rate else logging.WARNING)
+    listener.start()
+    return listener
+
+
+def stop():
+    "Writes out whatever is still queued, call it before the process exits"
+    if listener:
+        listener.stop()
+
+
+def log_request(route, **fields):
+    "Logs a sampled fraction of requests, costs one level check when request logging is off"
+    if requests.isEnabledFor(logging.INFO) and random.random() < sample_rates.get(route, default_rate):
+        requests.info(route, extra=fields)
@@ -1,89 +1,283 @@
+import argparse
 import asyncio
+import logging
+import multiprocessing
 import os
+import time
 
-import mysql.connector
-from socket_server import SocketServer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import codec
+import database as db
+import files
+import logs
+import metrics
+import migrations
+from bus import Broker, UnixBus
+from cache import Cache
+from message_writer import MessageWriter
+from pool import ConnectionPool
+from socket_server import OUTBOUND_QUEUE_SIZE, OVERFLOW_POLICIES, SocketServer
+
+
+DB_BACKEND = 'mysql' # or 'sqlite', which keeps everything in a local file and needs no database server
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'root',
+    'password': '24P@$#42',
+    'database': 'chatdb'
+}
+SQLITE_CONFIG = {
+    'database': 'chatdb.sqlite3' # Path of the database file
+}
+DB_POOL_SIZE = 8 # Number of connections, also the number of queries that can run in parallel
+DB_POOL_TIMEOUT = 30 # Seconds to wait for a free connection before giving up
+
+HASH_WORKERS = os.cpu_count() # Processes hashing passwords, so logins never stall the event loop, split between workers
+
+BUS_PATH = 'chatserver.sock' # Unix socket connecting the workers when there are several
+
+ADMIN_HOST = '127.0.0.1' # Prometheus metrics are served on http://ADMIN_HOST:ADMIN_PORT/metrics
+ADMIN_PORT = 9555 # Workers use the following ports, one each
+ADMIN_EMAILS = set() # Users allowed to request STATS
+
+MESSAGE_BATCH_SIZE = 64 # Messages inserted per commit at most
+MESSAGE_BATCH_DELAY = 0.005 # Seconds a message waits for others to share its commit
+
+OVERFLOW_POLICY = 'drop' # What happens to frames for a client whose outbound queue is full, one of OVERFLOW_POLICIES
+
+CACHE_SIZE = 4096 # Entries kept per cache
+CACHE_TTL = 5 * 60 # Seconds before a cached row is read again, in case something else changed it
+
+COMPRESSION = list(codec.COMPRESSORS) # Compressors clients may pick for large frames, [] sends every frame as it is
+COMPRESSION_LEVEL = None # None uses each compressor's default
+COMPRESS_THRESHOLD = codec.COMPRESS_THRESHOLD # Bytes an encoded frame needs before it is compressed
+
+ATTACHMENT_GC_INTERVAL = 6 * 60 * 60 # Seconds between sweeps for unused attachments
+ATTACHMENT_GC_GRACE = 60 * 60 # Unsent uploads are kept at least this long
+
+
+logger = logging.getLogger('chat.server')
 
 
 class Server(SocketServer):
-    "Basically gives it the sql connection"
-    def __init__(self, host, port, conn, cursor):
-        super().__init__(host, port)
-        
-        self.conn = conn
-        self.cursor = cursor
-
-# Ensure uploads folder exists
-if not os.path.exists('uploads'):
-    os.makedirs('uploads')
-
-# Start mysql connection
-conn = mysql.connector.connect(
-    host='localhost',
-    user='root',
-    password='24P@$#42',
-    database='chatdb'
-)
-
-cursor = conn.cursor(prepared=True)
-print("Connected to MySQL server")
-
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-  userid INT PRIMARY KEY AUTO_INCREMENT,
-  username VARCHAR(30) UNIQUE NOT NULL,
-  email VARCHAR(254) UNIQUE NOT NULL,
-  phone INT(9),
-  address VARCHAR(100),
-  password CHAR(108)
-);""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS rooms (
-  roomid INT PRIMARY KEY AUTO_INCREMENT,
-  roomname VARCHAR(30),
-  ownerid INT,
-  FOREIGN KEY (ownerid) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
-);""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS room_members (
-  userid INT,
-  roomid INT,
-  PRIMARY KEY (userid, roomid),
-  FOREIGN KEY (userid) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE,
-  FOREIGN KEY (roomid) REFERENCES rooms (roomid) ON DELETE CASCADE ON UPDATE CASCADE
-);""")
-
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS friends (
-  id INT PRIMARY KEY AUTO_INCREMENT,
-  userid1 INT,
-  userid2 INT,
-  UNIQUE (userid1, userid2),
-  FOREIGN KEY (userid1) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE,
-  FOREIGN KEY (userid2) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
-);""")
-
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS messages (
-  messageid INT PRIMARY KEY AUTO_INCREMENT,
-  roomid INT,
-  friendid INT,
-  author INT,
-  content VARCHAR(1024),
-  filename CHAR(32),
-  actualname VARCHAR(255),
-  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-  FOREIGN KEY (roomid) REFERENCES rooms (roomid) ON DELETE CASCADE ON UPDATE CASCADE,
-  FOREIGN KEY (friendid) REFERENCES friends (id) ON DELETE CASCADE ON UPDATE CASCADE,
-  FOREIGN KEY (author) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
-);""")
-
-
-# Run server asynchronously
-server = Server('0.0.0.0', 5555, conn, cursor)
-asyncio.run(server.connect())
+    "Basically gives it the sql connection pool"
+    def __init__(self, host, port, pool, bus=None, reuse_port=False, hash_workers=HASH_WORKERS, collect=True, admin_port=ADMIN_PORT,
+                 compressors=codec.COMPRESSORS, queue_size=OUTBOUND_QUEUE_SIZE, overflow=OVERFLOW_POLICY):
+        super().__init__(host, port, queue_size=queue_size, overflow=overflow, bus=bus, reuse_port=reuse_port,
+                         compressors=compressors, compress_threshold=COMPRESS_THRESHOLD)
+        self.collect = collect # Only one worker sweeps attachments
+        self.admin_port = admin_port # None serves no metrics endpoint
+        self.admins = ADMIN_EMAILS
+
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix='db')
+        self.writer = MessageWriter(self, MESSAGE_BATCH_SIZE, MESSAGE_BATCH_DELAY)
+        # Spawned rather than forked, the database threads may be running already
+        self.hasher = ProcessPoolExecutor(max_workers=hash_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        # Rarely changing rows, the on_<event> handlers below invalidate them on every worker
+        self.user_cache = Cache('users', CACHE_SIZE, CACHE_TTL) # email -> (userid, email, username)
+        self.room_cache = Cache('room', CACHE_SIZE, CACHE_TTL) # roomid -> (roomid, roomname, ownerid)
+        self.rooms_cache = Cache('rooms', CACHE_SIZE, CACHE_TTL) # userid -> rooms of that user
+        self.friends_cache = Cache('friends', CACHE_SIZE, CACHE_TTL) # userid -> friends of that user
+
+    def transaction(self, func, *args, **kwargs):
+        "Checks out a connection and runs the function inside its own transaction"
+        with self.pool.session() as session:
+            return func(session, *args, **kwargs)
+
+    async def query(self, func, *args, **kwargs):
+        "Runs a blocking database function in the executor, so the event loop keeps serving other clients"
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, partial(self.transaction, func, *args, **kwargs))
+        finally:
+            metrics.DB_SECONDS.observe(time.perf_counter() - start, func.__name__)
+
+    def cache_stats(self):
+        return {cache.name: cache.stats() for cache in (self.user_cache, self.room_cache, self.rooms_cache, self.friends_cache)}
+
+    def collect_metrics(self):
+        super().collect_metrics()
+        pool = self.pool.stats()
+        metrics.POOL_IN_USE.set(pool['in_use'])
+        metrics.POOL_WAITING.set(pool['waiting'])
+        metrics.POOL_WAIT_SECONDS.set(pool['wait_total'])
+        metrics.POOL_TIMEOUTS.set(pool['timeouts'])
+        metrics.MESSAGE_BATCHES.set(self.writer.batches)
+        metrics.BATCHED_MESSAGES.set(self.writer.messages)
+        for cache in (self.user_cache, self.room_cache, self.rooms_cache, self.friends_cache):
+            metrics.CACHE_HITS.set(cache.hits, cache.name)
+            metrics.CACHE_MISSES.set(cache.misses, cache.name)
+
+    def stats(self):
+        "Everything the STATS route reports"
+        return {
+            'metrics': metrics.snapshot(),
+            'pool': self.pool.stats(),
+            'writer': self.writer.stats(),
+            'caches': self.cache_stats(),
+            'sockets': self.socket_stats()
+        }
+
+    def on_update_profile(self, user):
+        "Drops cached rows that show the user's profile"
+        super().on_update_profile(user)
+        self.user_cache.invalidate(user[1])
+        self.friends_cache.invalidate_where(lambda userid, friends: any(f[1] == user[0] for f in friends))
+
+    def on_delete_user(self, user):
+        super().on_delete_user(user)
+        self.on_update_profile(user)
+        self.friends_cache.invalidate(user[0])
+        self.rooms_cache.invalidate(user[0])
+
+        # Rooms the user owned are deleted along with the account
+        self.room_cache.invalidate_where(lambda roomid, room: room[2] == user[0])
+        self.rooms_cache.invalidate_where(lambda userid, rooms: any(r[2] == user[0] for r in rooms))
+
+    def on_friendship(self, fid, userid1, userid2):
+        super().on_friendship(fid, userid1, userid2)
+        self.friends_cache.invalidate(userid1, userid2)
+
+    def on_unfriend(self, fid, userid1, userid2):
+        super().on_unfriend(fid, userid1, userid2)
+        self.friends_cache.invalidate(userid1, userid2)
+
+    def on_create_room(self, members, room):
+        self.rooms_cache.invalidate(*members)
+        super().on_create_room(members, room)
+
+    def on_invite(self, userid, roomid):
+        self.rooms_cache.invalidate(userid)
+        super().on_invite(userid, roomid)
+
+    def on_remove_member(self, userid, roomid):
+        self.rooms_cache.invalidate(userid)
+        super().on_remove_member(userid, roomid)
+
+    def on_delete_room(self, roomid):
+        self.room_cache.invalidate(roomid)
+        self.rooms_cache.invalidate_where(lambda userid, rooms: any(r[0] == roomid for r in rooms))
+        super().on_delete_room(roomid)
+
+    async def compute(self, func, *args):
+        "Runs a cpu heavy function such as password hashing in the process pool"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.hasher, func, *args)
+
+    async def collect_attachments(self):
+        "Periodically deletes stored attachments that no message refers to anymore"
+        while True:
+            try:
+                unused = await self.query(db.collect_attachments, ATTACHMENT_GC_GRACE)
+                for filename in unused:
+                    await self.query(db.delete_attachment, filename, ATTACHMENT_GC_GRACE)
+            except Exception:
+                logger.exception('Could not collect attachments')
+            await asyncio.sleep(ATTACHMENT_GC_INTERVAL)
+
+    async def connect(self):
+        if self.collect:
+            self.collector = asyncio.create_task(self.collect_attachments())
+        self.lag_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+        if self.admin_port:
+            self.admin = await metrics.serve(ADMIN_HOST, self.admin_port)
+            logger.info('Serving metrics', extra={'url': f'http://{ADMIN_HOST}:{self.admin_port}/metrics'})
+        await super().connect()
+
+
+def db_config(backend, database=None):
+    "Connection settings for the backend, with another database (or file for sqlite) if one is given"
+    config = SQLITE_CONFIG if backend == 'sqlite' else DB_CONFIG
+    return {**config, 'database': database or config['database']}
+
+
+def compressors(args):
+    "The compressors picked on the command line, at the level picked there"
+    return {name: codec.compressor(name, args.compression_level) for name in args.compression}
+
+
+def worker(args, index):
+    "Runs one of several server processes, each with its own connection pool"
+    logs.setup(args.log_level, args.log_requests)
+    pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, args.backend, **db_config(args.backend, args.database))
+    server = Server(args.host, args.port, pool, bus=UnixBus(args.bus), reuse_port=True,
+                    hash_workers=max(1, HASH_WORKERS // args.workers), collect=index == 0,
+                    admin_port=args.admin_port and args.admin_port + index, compressors=compressors(args),
+                    queue_size=args.queue_size, overflow=args.overflow)
+    try:
+        asyncio.run(server.connect())
+    finally:
+        logs.stop()
+
+
+async def supervise(args):
+    "Starts the bus broker and the workers, the kernel spreads new connections between them"
+    broker = Broker(args.bus)
+    await broker.start()
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=worker, args=(args, i), name=f'worker-{i}') for i in range(args.workers)]
+    for process in workers:
+        process.start()
+
+    loop = asyncio.get_running_loop()
+    try:
+        for process in workers:
+            await loop.run_in_executor(None, process.join)
+    finally:
+        for process in workers:
+            process.terminate()
+        broker.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--backend', choices=('mysql', 'sqlite'), default=DB_BACKEND)
+    parser.add_argument('--database', help='database name, or file for sqlite, instead of the configured one')
+    parser.add_argument('--workers', type=int, default=1, help='processes sharing the port, 1 serves everything from this process')
+    parser.add_argument('--bus', default=BUS_PATH, help='unix socket the workers publish to each other on')
+    parser.add_argument('--admin-port', type=int, default=ADMIN_PORT, help='local port serving /metrics, 0 turns it off')
+    parser.add_argument('--compression', type=lambda names: [name for name in names.split(',') if name != 'none'], default=COMPRESSION,
+                        help=f'comma separated compressors clients may pick from {list(codec.COMPRESSORS)}, none turns it off')
+    parser.add_argument('--compression-level', type=int, default=COMPRESSION_LEVEL)
+    parser.add_argument('--queue-size', type=int, default=OUTBOUND_QUEUE_SIZE, help='frames that may wait to be written to a single client')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help='what happens to frames for a client whose queue is full: drop them, coalesce by dropping the oldest, or disconnect')
+    parser.add_argument('--log-level', default=logs.LOG_LEVEL)
+    parser.add_argument('--log-requests', type=float, default=logs.REQUEST_SAMPLE_RATE, help='fraction of requests to log, 0 logs none')
+    args = parser.parse_args()
+    unknown = set(args.compression) - set(codec.COMPRESSORS)
+    if unknown:
+        parser.error(f'compressors not available here: {", ".join(unknown)}')
+    logs.setup(args.log_level, args.log_requests)
+
+    # Ensure uploads folder exists
+    if not os.path.exists(files.UPLOAD_DIR):
+        os.makedirs(files.UPLOAD_DIR)
+
+    # Start the connection pool and bring the schema up to date
+    pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, args.backend, **db_config(args.backend, args.database))
+    with pool.session() as session:
+        logger.info('Connected to the database', extra={'backend': args.backend, 'schema_version': migrations.migrate(session)})
+
+    # Run server asynchronously
+    try:
+        if args.workers > 1:
+            asyncio.run(supervise(args))
+        else:
+            server = Server(args.host, args.port, pool, admin_port=args.admin_port, compressors=compressors(args),
+                            queue_size=args.queue_size, overflow=args.overflow)
+            asyncio.run(server.connect())
+    finally:
+        logs.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+
+from collections import Counter
+
+import database as db
+
+
+logger = logging.getLogger('chat.messages')
+
+
+class MessageWriter:
+    "Gathers messages sent around the same time and inserts each batch with a single commit"
+    def __init__(self, server, max_size=64, max_delay=0.005):
+        self.server = server
+        self.max_size = max_size # Messages per batch
+        self.max_delay = max_delay # Seconds the first message of a batch waits for others
+
+        self.pending = [] # (user, message, future)
+        self.timer = None
+        self.lock = None # One batch is written at a time, so ids follow send order, created by the first write
+        self.tasks = set()
+
+        # Metrics
+        self.batches = 0
+        self.messages = 0
+        self.fallbacks = 0
+        self.sizes = Counter() # Batch size rounded up to a power of 2 -> number of batches
+
+    async def add(self, user, **message):
+        "Queues a message for the next batch, returns the stored message or False like db.add_message"
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((user, message, future))
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        "Starts writing everything gathered so far"
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.write(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def write(self, batch):
+        if self.lock is None:
+            # Python 3.8 and 3.9 bind a lock to the loop current when it is created,
+            # which is not the one asyncio.run starts when the server is built before it
+            self.lock = asyncio.Lock()
+
+        results = []
+        try:
+            async with self.lock:
+                self.batches += 1
+                self.messages += len(batch)
+                self.sizes[1 << (len(batch) - 1).bit_length()] += 1
+
+                try:
+                    results = await self.server.query(db.add_messages, [(user, message) for user, message, _ in batch])
+                except Exception as e:
+                    # Something in the batch failed and it was rolled back,
+                    # retry one message per transaction so only the bad ones fail
+                    logger.warning('Message batch failed, retrying individually', extra={'size': len(batch), 'error': str(e)})
+                    self.fallbacks += 1
+                    results = []
+                    for user, message, _ in batch:
+                        try:
+                            results.append(await self.server.query(db.add_message, user, **message))
+                        except Exception:
+                            logger.exception('Message was not stored')
+                            results.append(False)
+        except Exception:
+            logger.exception('Message batch was not written', extra={'size': len(batch)})
+        finally:
+            # Whatever happened, nobody is left waiting on a message that got no result
+            results = list(results) + [False] * (len(batch) - len(results))
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            'max_size': self.max_size,
+            'max_delay': self.max_delay,
+            'pending': len(self.pending),
+            'batches': self.batches,
+            'messages': self.messages,
+            'fallbacks': self.fallbacks,
+            'sizes': dict(sorted(self.sizes.items()))
+        }
@@ -0,0 +1,204 @@
+"""
+In memory metrics for the server
+
+Metrics register themselves in REGISTRY when they are created. The admin
+endpoint renders them in the Prometheus text format and the STATS route
+sends a snapshot. Values owned by other objects, like the pool or the
+caches, are copied in by the functions in COLLECTORS right before either.
+"""
+import asyncio
+import bisect
+import time
+
+from collections import defaultdict
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+LOOP_LAG_INTERVAL = 0.25 # Seconds between event loop lag samples
+
+REGISTRY = []
+COLLECTORS = [] # Functions updating metrics from other objects before they are read
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    "Only ever goes up, except when set from a count kept elsewhere"
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(float) # label values -> value
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] += amount
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def render(self):
+        return [f'{self.name}{format_labels(self.labels, labels)} {value}' for labels, value in self.values.items()]
+
+    def snapshot(self):
+        return {','.join(map(str, labels)): value for labels, value in self.values.items()}
+
+
+class Gauge(Counter):
+    "A value that goes up and down"
+    kind = 'gauge'
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram:
+    "Counts observations into buckets, so latencies can be summed up without keeping every sample"
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = {} # label values -> count per bucket, the last one past the largest bound
+        self.sums = defaultdict(float)
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def clear(self):
+        self.counts.clear()
+        self.sums.clear()
+
+    def quantile(self, counts, q):
+        "Upper bound of the bucket the quantile falls in"
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = []
+        for labels, counts in self.counts.items():
+            seen = 0
+            for bound, count in zip(self.buckets, counts):
+                seen += count
+                le = format_labels(self.labels, labels, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{le} {seen}')
+            total = seen + counts[-1]
+            le = format_labels(self.labels, labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {self.sums[labels]}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {total}')
+        return lines
+
+    def snapshot(self):
+        snapshot = {}
+        for labels, counts in self.counts.items():
+            total = sum(counts)
+            snapshot[','.join(map(str, labels))] = {
+                'count': total,
+                'avg': self.sums[labels] / total if total else 0,
+                'p50': self.quantile(counts, 0.5),
+                'p99': self.quantile(counts, 0.99)
+            }
+        return snapshot
+
+
+REQUEST_SECONDS = Histogram('chat_request_seconds', 'Time spent handling a request', ('route',))
+REQUEST_ERRORS = Counter('chat_request_errors_total', 'Requests that raised', ('route',))
+DB_SECONDS = Histogram('chat_db_seconds', 'Time a database function took, including the wait for a connection', ('function',))
+
+CONNECTIONS = Gauge('chat_connections', 'Open client connections')
+USERS = Gauge('chat_users', 'Users logged in on at least one connection')
+ROOMS = Gauge('chat_rooms', 'Rooms with at least one connected member')
+ROOM_MEMBERS = Histogram('chat_room_members', 'Connected sockets per room', buckets=SIZE_BUCKETS)
+
+FRAMES_IN = Counter('chat_frames_in_total', 'Frames read from clients')
+BYTES_IN = Counter('chat_bytes_in_total', 'Bytes read from clients')
+FRAMES_OUT = Counter('chat_frames_out_total', 'Frames written to clients')
+BYTES_OUT = Counter('chat_bytes_out_total', 'Bytes written to clients')
+FRAMES_DROPPED = Counter('chat_frames_dropped_total', 'Frames that did not fit in an outbound queue')
+REAPED = Counter('chat_reaped_connections_total', 'Connections closed for not responding, by what they were doing', ('reason',))
+QUEUED_FRAMES = Gauge('chat_queued_frames', 'Frames waiting in outbound queues')
+
+LOOP_LAG = Histogram('chat_loop_lag_seconds', 'How late the event loop ran a timer')
+
+# Copied from the objects that count them
+POOL_IN_USE = Gauge('chat_db_connections_in_use', 'Database connections checked out')
+POOL_WAITING = Gauge('chat_db_connections_waiting', 'Threads waiting for a database connection')
+POOL_WAIT_SECONDS = Counter('chat_db_wait_seconds_total', 'Time spent waiting for a database connection')
+POOL_TIMEOUTS = Counter('chat_db_wait_timeouts_total', 'Waits for a database connection that timed out')
+MESSAGE_BATCHES = Counter('chat_message_batches_total', 'Commits of batched messages')
+BATCHED_MESSAGES = Counter('chat_batched_messages_total', 'Messages written in batches')
+CACHE_HITS = Counter('chat_cache_hits_total', 'Cache lookups that found an entry', ('cache',))
+CACHE_MISSES = Counter('chat_cache_misses_total', 'Cache lookups that went to the database', ('cache',))
+BUS_PUBLISHED = Counter('chat_bus_published_total', 'Events published to the other workers')
+BUS_RECEIVED = Counter('chat_bus_received_total', 'Events received from the other workers')
+
+
+def collect():
+    for collector in COLLECTORS:
+        collector()
+
+
+def render():
+    "Every metric in the Prometheus text format"
+    collect()
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    collect()
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    "Measures how much later than asked the loop wakes up, anything blocking it shows up here"
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0, time.perf_counter() - start - interval))
+
+
+async def handle_scrape(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        if request.startswith(b'GET /metrics '):
+            status, body = '200 OK', render()
+        else:
+            status, body = '404 Not Found', 'Only /metrics is served here\n'
+        body = body.encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    "Serves GET /metrics on the admin port, keep it bound to localhost"
+    return await asyncio.start_server(handle_scrape, host, port)
@@ -0,0 +1,200 @@
+import logging
+
+
+logger = logging.getLogger('chat.migrations')
+
+
+# (version, description, statements), applied in order and recorded in schema_version.
+# Statements only some backends understand are given per session dialect.
+# Never edit a migration that has shipped, add a new one instead
+MIGRATIONS = [
+    (1, 'Initial schema', {'mysql': [
+"""
+CREATE TABLE IF NOT EXISTS users (
+  userid INT PRIMARY KEY AUTO_INCREMENT,
+  username VARCHAR(30) UNIQUE NOT NULL,
+  email VARCHAR(254) UNIQUE NOT NULL,
+  phone INT(9),
+  address VARCHAR(100),
+  password CHAR(108)
+);""",
+"""
+CREATE TABLE IF NOT EXISTS rooms (
+  roomid INT PRIMARY KEY AUTO_INCREMENT,
+  roomname VARCHAR(30),
+  ownerid INT,
+  FOREIGN KEY (ownerid) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS room_members (
+  userid INT,
+  roomid INT,
+  PRIMARY KEY (userid, roomid),
+  FOREIGN KEY (userid) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (roomid) REFERENCES rooms (roomid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS friends (
+  id INT PRIMARY KEY AUTO_INCREMENT,
+  userid1 INT,
+  userid2 INT,
+  UNIQUE (userid1, userid2),
+  FOREIGN KEY (userid1) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (userid2) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS messages (
+  messageid INT PRIMARY KEY AUTO_INCREMENT,
+  roomid INT,
+  friendid INT,
+  author INT,
+  content VARCHAR(1024),
+  filename CHAR(32),
+  actualname VARCHAR(255),
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (roomid) REFERENCES rooms (roomid) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (friendid) REFERENCES friends (id) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (author) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS attachments (
+  filename CHAR(32) PRIMARY KEY,
+  size BIGINT NOT NULL,
+  refs INT NOT NULL DEFAULT 0,
+  last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);"""
+    ], 'sqlite': [
+"""
+CREATE TABLE IF NOT EXISTS users (
+  userid INTEGER PRIMARY KEY AUTOINCREMENT,
+  username VARCHAR(30) COLLATE NOCASE UNIQUE NOT NULL,
+  email VARCHAR(254) COLLATE NOCASE UNIQUE NOT NULL,
+  phone INT,
+  address VARCHAR(100),
+  password VARCHAR(255)
+);""",
+"""
+CREATE TABLE IF NOT EXISTS rooms (
+  roomid INTEGER PRIMARY KEY AUTOINCREMENT,
+  roomname VARCHAR(30),
+  ownerid INT,
+  FOREIGN KEY (ownerid) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS room_members (
+  userid INT,
+  roomid INT,
+  PRIMARY KEY (userid, roomid),
+  FOREIGN KEY (userid) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (roomid) REFERENCES rooms (roomid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS friends (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  userid1 INT,
+  userid2 INT,
+  UNIQUE (userid1, userid2),
+  FOREIGN KEY (userid1) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (userid2) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS messages (
+  messageid INTEGER PRIMARY KEY AUTOINCREMENT,
+  roomid INT,
+  friendid INT,
+  author INT,
+  content VARCHAR(1024),
+  filename CHAR(32),
+  actualname VARCHAR(255),
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (roomid) REFERENCES rooms (roomid) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (friendid) REFERENCES friends (id) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (author) REFERENCES users (userid) ON DELETE CASCADE ON UPDATE CASCADE
+);""",
+"""
+CREATE TABLE IF NOT EXISTS attachments (
+  filename CHAR(32) PRIMARY KEY,
+  size BIGINT NOT NULL,
+  refs INT NOT NULL DEFAULT 0,
+  last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);"""
+    ]}),
+    (2, 'Indexes for message history, friend lookups and attachment recounts', [
+        "CREATE INDEX messages_room_created ON messages (roomid, created_at)",
+        "CREATE INDEX messages_friend_created ON messages (friendid, created_at)",
+        "CREATE INDEX messages_filename ON messages (filename)",
+        "CREATE INDEX friends_user2 ON friends (userid2, userid1)"
+    ]),
+    (3, 'Room for longer password hashes', {
+        'mysql': ["ALTER TABLE users MODIFY password VARCHAR(255)"],
+        'sqlite': [] # Created that way
+    }),
+    (4, 'Indexes MySQL creates for foreign keys by itself, so cascading deletes do not scan', {
+        'mysql': [],
+        'sqlite': [
+            "CREATE INDEX rooms_owner ON rooms (ownerid)",
+            "CREATE INDEX room_members_room ON room_members (roomid)",
+            "CREATE INDEX messages_author ON messages (author)"
+        ]
+    }),
+    (5, 'History indexes in the order pages are read, so a page does not sort the conversation', {
+        # The new indexes come first, MySQL needs one on roomid and friendid for their foreign keys
+        'mysql': [
+            "CREATE INDEX messages_room_message ON messages (roomid, messageid)",
+            "CREATE INDEX messages_friend_message ON messages (friendid, messageid)",
+            "DROP INDEX messages_room_created ON messages",
+            "DROP INDEX messages_friend_created ON messages"
+        ],
+        'sqlite': [
+            "CREATE INDEX messages_room_message ON messages (roomid, messageid)",
+            "CREATE INDEX messages_friend_message ON messages (friendid, messageid)",
+            "DROP INDEX messages_room_created",
+            "DROP INDEX messages_friend_created"
+        ]
+    })
+]
+
+
+def schema_version(session):
+    "The latest applied migration, 0 for a new database"
+    session.cursor.execute("""
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INT PRIMARY KEY,
+  description VARCHAR(100),
+  applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);""")
+    session.cursor.execute("SELECT MAX(version) FROM schema_version")
+    return session.cursor.fetchone()[0] or 0
+
+
+def migrate(session):
+    "Applies every migration newer than the recorded schema version"
+    current = schema_version(session)
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+
+        logger.info('Applying migration', extra={'version': version, 'description': description})
+        if isinstance(statements, dict):
+            statements = statements[session.dialect]
+        for statement in statements:
+            session.cursor.execute(statement)
+        session.cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+        session.conn.commit()
+    return MIGRATIONS[-1][0]
+
+
+if __name__ == '__main__':
+    # python migrations.py
+    # Migrates the database of the configured DB_BACKEND without starting the server
+    import logs
+    from main import DB_BACKEND, db_config
+    from pool import ConnectionPool
+
+    logs.setup()
+    try:
+        pool = ConnectionPool(1, backend=DB_BACKEND, **db_config(DB_BACKEND))
+        with pool.session() as session:
+            print('Schema version', migrate(session))
+    finally:
+        logs.stop()
@@ -0,0 +1,70 @@
+import base64
+import hashlib
+import hmac
+import os
+
+
+# Key derivation used for new and upgraded hashes, 'scrypt' or 'pbkdf2'
+KDF = 'scrypt'
+SCRYPT_PARAMS = {'n': 2**14, 'r': 8, 'p': 1}
+PBKDF2_PARAMS = {'i': 600000}
+
+# Hashes look like $scrypt$n=16384,r=8,p=1$<salt>$<key>, older ones are
+# base64(salt + sha512(password + salt)) and get rehashed on the next login
+
+
+def encode_params(params):
+    return ','.join(f'{k}={v}' for k, v in params.items())
+
+
+def derive(kdf, password, salt, params):
+    if kdf == 'scrypt':
+        return hashlib.scrypt(password, salt=salt, n=params['n'], r=params['r'], p=params['p'], maxmem=2**26, dklen=32)
+    elif kdf == 'pbkdf2':
+        return hashlib.pbkdf2_hmac('sha256', password, salt, params['i'], dklen=32)
+    raise ValueError(f'Unknown kdf {kdf!r}')
+
+
+def current_params(kdf):
+    return SCRYPT_PARAMS if kdf == 'scrypt' else PBKDF2_PARAMS
+
+
+def hash_password(password, kdf=KDF):
+    "Hashes a password with a new salt, slow on purpose so run it in a process pool"
+    salt = os.urandom(16)
+    params = current_params(kdf)
+    key = derive(kdf, password.encode('utf8'), salt, params)
+    return '$'.join(['', kdf, encode_params(params), base64.b64encode(salt).decode(), base64.b64encode(key).decode()])
+
+
+def verify_legacy(password, encoded):
+    decoded = base64.b64decode(encoded)
+    salt, hashed = decoded[:16], decoded[16:] # Get salt and sha512 password
+    return hmac.compare_digest(hashlib.sha512(password + salt).digest(), hashed)
+
+
+def verify_password(password, encoded):
+    "Checks a password against a stored hash of either format, slow on purpose so run it in a process pool"
+    try:
+        if isinstance(encoded, (bytes, bytearray)):
+            encoded = encoded.decode()
+        encoded = encoded.strip()
+        password = password.encode('utf8')
+
+        if not encoded.startswith('$'):
+            return verify_legacy(password, encoded)
+
+        _, kdf, params, salt, key = encoded.split('$')
+        params = {k: int(v) for k, v in (p.split('=') for p in params.split(','))}
+        derived = derive(kdf, password, base64.b64decode(salt), params)
+        return hmac.compare_digest(derived, base64.b64decode(key))
+    except Exception:
+        return False
+
+
+def needs_rehash(encoded, kdf=KDF):
+    "Whether a stored hash uses an older format, kdf or parameters than configured"
+    if isinstance(encoded, (bytes, bytearray)):
+        encoded = encoded.decode()
+    parts = encoded.strip().split('$')
+    return len(parts) != 5 or parts[1] != kdf or parts[2] != encode_params(current_params(kdf))
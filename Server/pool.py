@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+
+from contextlib import contextmanager
+
+from backends import BACKENDS
+
+
+class PoolError(Exception):
+    pass
+
+
+class ConnectionPool:
+    "Fixed size pool of database connections, each request checks one out for a single transaction"
+    def __init__(self, size=8, timeout=None, backend='mysql', **config):
+        self.size = size
+        self.timeout = timeout
+        self.backend = BACKENDS[backend] # Name of one of backends.BACKENDS
+        self.config = config
+
+        # Idle sessions, None marks a slot whose connection has to be (re)opened
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+
+        # Metrics, only updated while holding the lock
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def connect(self):
+        "Opens a new connection"
+        return self.backend.connect(**self.config)
+
+    def checkout(self):
+        "Waits for an idle session, opening a new connection for empty slots"
+        start = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+
+        try:
+            session = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self.lock:
+                self.timeouts += 1
+            raise PoolError(f'No connection available after {self.timeout}s')
+        finally:
+            waited = time.perf_counter() - start
+            with self.lock:
+                self.waiting -= 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+        try:
+            session = session or self.connect()
+        except Exception:
+            self.idle.put(None) # Give the slot back, the next checkout retries
+            raise
+
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+        return session
+
+    def release(self, session):
+        "Returns a session to the pool"
+        with self.lock:
+            self.in_use -= 1
+        self.idle.put(session)
+
+    @contextmanager
+    def session(self):
+        "Checks out a session for one transaction, commits if the block succeeds and rolls back if it raises"
+        session = self.checkout()
+        try:
+            yield session
+            session.conn.commit()
+        except Exception:
+            try:
+                session.conn.rollback()
+            except Exception:
+                # Connection is broken, drop it so the slot reconnects on next checkout
+                session = None
+            raise
+        finally:
+            self.release(session)
+
+    def stats(self):
+        "Snapshot of the pool metrics"
+        with self.lock:
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max
+            }
@@ -1,12 +1,64 @@
-import base64
+import codec
 import database as db
+import files
+import os
+import passwords
+
+
+async def hello(socket, server, body):
+    "Negotiates the wire codec and compressor, the reply still uses the old ones and every frame after it the new ones"
+    chosen = codec.negotiate(body.get('codecs', []))
+    compressor = codec.negotiate_compressor(body.get('compressors', []), server.compressors)
+    await socket.send('HELLO', {
+        'codec': chosen.name,
+        'compressor': compressor and compressor.name,
+        'heartbeat': server.heartbeat_interval
+    })
+    socket.codec = chosen
+    socket.compressor = compressor
+    socket.heartbeat = bool(body.get('heartbeat')) # Older clients do not answer PINGs
+
+
+async def ping(socket, server, body):
+    "Lets a client check that the server is still there"
+    await socket.send('PONG', {})
+
+
+async def pong(socket, server, body):
+    "Answer to our PING, reading it was all that was needed"
+
+
+async def verify_password(server, userid, password, hashed):
+    "Checks the password in the process pool, hashes in an older format are upgraded once it matches"
+    if not hashed or not await server.compute(passwords.verify_password, password, hashed):
+        return False
+
+    if passwords.needs_rehash(hashed):
+        hashed = await server.compute(passwords.hash_password, password)
+        await server.query(db.set_password, userid, hashed)
+    return True
+
+
+async def cached_user(server, email):
+    "The (userid, email, username) row for an email id, None if nobody has it"
+    return await server.user_cache.fetch(email, server.query, db.fetch_user, email)
+
+
+async def load_friends(server, user):
+    "Fetches the friends of a user and remembers who is in each friendship, so private messages need no lookup"
+    friends = await server.friends_cache.fetch(user[0], server.query, db.fetch_friends, user)
+    for fid, userid, email, username in friends:
+        server.add_friendship(fid, user[0], userid)
+    return friends
 
 
 async def login(socket, server, body):
     "Handle login requests"
-    success, user = db.login_user(server, **body)
-    if success:
-        socket.user = list(user)
+    row = await server.query(db.fetch_login, body.get('email'))
+    if row and await verify_password(server, row[0], body.get('password'), row[5]):
+        user = row[:5]
+        server.add_user(socket, list(user))
+        await load_friends(server, user)
         await socket.send('LOGIN', {'message': 'Login success!!', 'user': user})
     else:
         await socket.send('LOGIN', {'error': True, 'message': 'Invalid email id or password'})
@@ -14,7 +66,8 @@ async def login(socket, server, body):
 
 async def register(socket, server, body):
     "Register the user"
-    if db.register_user(server, **body):
+    hashed = await server.compute(passwords.hash_password, body.get('password'))
+    if await server.query(db.register_user, body.get('email'), body.get('username'), hashed):
         await socket.send('REGISTER', {'message': 'Registration successful!'})
     else:
         await socket.send('REGISTER', {'error': True, 'message': 'Registration was not successful'})
@@ -22,20 +75,29 @@ async def register(socket, server, body):
 
 async def logout(socket, server, body):
     "Logs the user out, leaves all rooms"
-    socket.user = None
     server.leave_all_rooms(socket)
+    server.remove_user(socket)
     await socket.send('LOGOUT', {})
 
 
 async def change_password(socket, server, body):
     "Change password, error if old password is invlaid"
-    h, b = db.change_password(server, socket.user, **body)
-    await socket.send(h, b)
+    userid = socket.user[0]
+    hashed = await server.query(db.fetch_password, userid)
+    if await verify_password(server, userid, body.get('oldpass'), hashed):
+        hashed = await server.compute(passwords.hash_password, body.get('newpass'))
+        await server.query(db.set_password, userid, hashed)
+        await socket.send('INFO', {'message': 'Password Updated!'})
+    else:
+        await socket.send('ERROR', {'message': 'Invalid password'})
 
 
 async def delete_account(socket, server, body):
     "Deletes the account if exists"
-    if db.delete_account(server, socket.user, **body):
+    hashed = await server.query(db.fetch_password, socket.user[0])
+    if await server.compute(passwords.verify_password, body.get('password'), hashed or ''):
+        await server.query(db.delete_account, socket.user)
+        server.publish('delete_user', list(socket.user))
         await socket.send('INFO', {'message': 'Account successfully deleted'})
         await logout(socket, server, body)
     else:
@@ -43,58 +105,98 @@ async def delete_account(socket, server, body):
 
 
 async def update_profile(socket, server, body):
-    h,b = db.update_profile(server, socket.user, **body)
+    h,b = await server.query(db.update_profile, socket.user, **body)
     await socket.send(h, b)
     if h != 'ERROR':
-        socket.user[2:] = [body.get('username'), body.get('phone'), body.get('address')]
-        print(socket.user)
+        server.publish('update_profile', socket.user[:2] + [body.get('username'), body.get('phone'), body.get('address')])
 
 
 async def fetch_user(socket, server, body):
     "Fetch any user from the database with their email id"
-    h,b = db.fetch_user(server, socket.user, **body)
-    await socket.send(h, b)
+    user = await cached_user(server, body.get('email'))
+    if user:
+        await socket.send('FETCH_USER', user)
+    else:
+        await socket.send('ERROR', {'message': 'This email ID doesnt exist'})
 
 
 async def fetch_recent_chats(socket, server, body):
     "Fetch all messages from all rooms and private chats this user is in, ordered by their date of creation"
-    recent = db.fetch_recent_chats(server, socket.user, body)
+    recent = await server.query(db.fetch_recent_chats, socket.user, body)
     await socket.send('RECENT_CHATS', recent)
 
 
+async def fetch_history(socket, server, body):
+    "Fetch one page of messages from a room or private chat, newest first"
+    messages, more = await server.query(db.fetch_history, socket.user, **body)
+    await socket.send('HISTORY', {
+        'type': body.get('type'),
+        '_id': body.get('_id'),
+        'before': body.get('before'),
+        'messages': messages,
+        'more': more
+    })
+
+
 async def fetch_members(socket, server, body):
     "Fetch data of all members from all rooms"
-    members = db.fetch_members(server, socket.user, body)
+    members = await server.query(db.fetch_members, socket.user, body)
     await socket.send('FETCH_MEMBERS', members)
         
 
 async def fetch_friends(socket, server, body):
     "Fetch data of all chats"
-    friends = db.fetch_friends(server, socket.user, **body)
+    friends = await load_friends(server, socket.user)
     await socket.send('FETCH_FRIENDS', friends)
 
 
 async def add_friend(socket, server, body):
     "Adds a friend and sends the request to the other user"
-    h, data = db.add_friend(server, socket.user, **body)
-    await socket.send(h, data)
-    if h != 'ERROR':
-        b = [data[0], *socket.user]
-        await server.send_to(data[1], h, b)
+    friend = await cached_user(server, body.get('email'))
+    if not friend:
+        return await socket.send('ERROR', {'message': 'Email ID not found!'})
+
+    h, data = await server.query(db.add_friend, socket.user, friend)
+    if h == 'ERROR':
+        return await socket.send(h, data)
+
+    server.publish('friendship', data[0], socket.user[0], friend[0])
+    await server.send_to(socket.user[0], h, data) # Every device of the user
+    b = [data[0], *socket.user]
+    await server.send_to(data[1], h, b)
 
 
 async def remove_friend(socket, server, body):
     "Remove a friend and sends the data to the other user"
-    h, data = db.remove_friend(server, socket.user, **body)
-    await socket.send(h, data)
-    if h != 'ERROR':
-        friend = body.get('fuser')
-        await server.send_to(friend, h, data)
+    h, data = await server.query(db.remove_friend, socket.user, **body)
+    if h == 'ERROR':
+        return await socket.send(h, data)
+
+    friend = body.get('fuser')
+    server.publish('unfriend', body.get('fid'), socket.user[0], friend)
+    await server.send_to(socket.user[0], h, data)
+    await server.send_to(friend, h, data)
+
+
+def take_upload(socket, body):
+    "Replaces the upload id in a message with the stored file, False if the upload is not finished"
+    uploadid = body.pop('upload', None)
+    if uploadid is None:
+        return True
+
+    upload = socket.uploads.get(uploadid)
+    if not upload or not upload.complete:
+        return False
+    del socket.uploads[uploadid]
+    body['stored'] = (upload.actualname, upload.filename, upload.size)
+    return True
 
 
 async def send_message(socket, server, body):
     "Sends a message to a chat room"
-    message = db.add_message(server, socket.user, **body)
+    if not take_upload(socket, body):
+        return await socket.send('ERROR', {'message': 'Attachment was not uploaded'})
+    message = await server.writer.add(socket.user, **body)
     if message:
         await server.send_room(body['_id'], 'MESSAGE', ['public'] + message)
     else:
@@ -103,30 +205,111 @@ async def send_message(socket, server, body):
 
 async def send_private_message(socket, server, body):
     "Sends a private message to a friend"
-    message = db.add_message(server, socket.user, private=True, **body)
+    friend = server.friend_of(body.get('_id'), socket.user[0])
+    if friend is None:
+        return await socket.send('ERROR', {'message': 'You are not friends with that user'})
+    if not take_upload(socket, body):
+        return await socket.send('ERROR', {'message': 'Attachment was not uploaded'})
+    message = await server.writer.add(socket.user, private=True, **body)
     if message:
-        server.cursor.execute("SELECT IF(userid1=%s, userid2, userid1) FROM friends WHERE id=%s;", (socket.user[0], body.get('_id')))
-        friend = server.cursor.fetchone()
-
-        await server.send_to(friend[0], 'MESSAGE', ['private'] + message)
-        await socket.send('MESSAGE', ['private'] + message)
+        await server.send_to(friend, 'MESSAGE', ['private'] + message)
+        await server.send_to(socket.user[0], 'MESSAGE', ['private'] + message) # Every device of the sender shows it too
     else:
         await socket.send('ERROR', {'message': 'Message was not sent!'})
 
 
 async def download_file(socket, server, body):
+    "Sends a whole attachment base64 encoded in one reply, for older clients, newer ones use DOWNLOAD_STREAM"
+    filename, actualname = body.get('filename'), body.get('actualname')
+    try:
+        filedata = await files.run(files.read_base64, filename)
+    except (OSError, ValueError):
+        return await socket.send('ERROR', {'message': f'File "{actualname}" does not exist anymore. Ask the author to resend the attachment'})
+    await socket.send('DOWNLOAD_FILE', [actualname, filedata])
+
+
+async def upload_start(socket, server, body):
+    "Starts receiving an attachment in chunks"
+    uploadid = body.get('uploadid')
+    if uploadid in socket.uploads:
+        socket.uploads.pop(uploadid).abort()
+    if len(socket.uploads) >= files.MAX_PENDING_UPLOADS:
+        return await socket.send('ERROR', {'message': 'Too many attachments are being uploaded at once'})
+    try:
+        socket.uploads[uploadid] = files.Upload(body.get('actualname'), int(body.get('size')))
+    except (TypeError, ValueError) as e:
+        await socket.send('ERROR', {'message': f'Could not upload attachment: {e}'})
+
+
+async def upload_chunk(socket, server, body):
+    "Appends a chunk of raw bytes to an upload in progress"
+    uploadid = body.get('uploadid')
+    upload = socket.uploads.get(uploadid)
+    if not upload or upload.complete:
+        return # Already rejected, the error was sent when that happened
+
+    try:
+        await upload.write(body.get('data'))
+    except (TypeError, ValueError) as e:
+        socket.uploads.pop(uploadid).abort()
+        await socket.send('ERROR', {'message': f'Could not upload attachment: {e}'})
+
+
+async def upload_end(socket, server, body):
+    "Finishes an upload, its id can then be attached to a message"
+    uploadid = body.get('uploadid')
+    upload = socket.uploads.get(uploadid)
+    if not upload or upload.complete:
+        return
+
+    try:
+        filename = upload.finish()
+    except ValueError as e:
+        socket.uploads.pop(uploadid)
+        return await socket.send('ERROR', {'message': f'Could not upload attachment: {e}'})
+
+    # Recorded before the file is moved into place, so the collector either leaves it
+    # alone or has already removed the old copy that the file then replaces
+    await server.query(db.add_attachment, filename, upload.size)
+    await upload.store()
+    await socket.send('UPLOAD_DONE', {'uploadid': uploadid, 'filename': filename})
+
+
+async def has_attachment(socket, server, body):
+    "Checks for content the server already stores, so the client can skip uploading it"
+    uploadid, filename, size = body.get('uploadid'), body.get('hash'), body.get('size')
+    try:
+        # Touches the row first, the collector then keeps the file until the message is sent
+        exists = await server.query(db.has_attachment, filename, size) and await files.run(os.path.exists, files.path(filename))
+    except ValueError:
+        exists = False
+
+    # Treat it as a finished upload, so it is sent the same way
+    if exists and uploadid not in socket.uploads and len(socket.uploads) < files.MAX_PENDING_UPLOADS:
+        socket.uploads[uploadid] = files.Stored(body.get('actualname'), filename, size)
+    else:
+        exists = False
+    await socket.send('HAS_ATTACHMENT', {'uploadid': uploadid, 'exists': exists})
+
+
+async def download_stream(socket, server, body):
+    "Sends an attachment back as a sequence of raw chunks"
     filename, actualname = body.get('filename'), body.get('actualname')
     try:
-        with open(f'./uploads/{filename}', 'rb') as file:
-            filedata = base64.b64encode(file.read()).decode()
-            await socket.send('DOWNLOAD_FILE', [actualname, filedata])
-    except:
-        await socket.send('ERROR', {'message': f'File "{actualname}" does not exist anymore. Ask the author to resend the attachment'})
+        size = await files.run(os.path.getsize, files.path(filename))
+    except (OSError, ValueError):
+        return await socket.send('ERROR', {'message': f'File "{actualname}" does not exist anymore. Ask the author to resend the attachment'})
+
+    # Wait for room in the queue between chunks, so a slow client never holds the whole file in memory
+    await socket.push('FILE_START', {'filename': filename, 'actualname': actualname, 'size': size})
+    async for chunk in files.read_chunks(filename):
+        await socket.push('FILE_CHUNK', {'filename': filename, 'data': chunk})
+    await socket.push('FILE_END', {'filename': filename})
 
 
 async def create_room(socket, server, body):
     "Creates a room with the given list of members, and sends join data to all members"
-    room = db.create_room(server, socket.user, **body)
+    room = await server.query(db.create_room, socket.user, **body)
     if room:
         await server.create_room(body['members'], room)
     else:
@@ -135,17 +318,21 @@ async def create_room(socket, server, body):
 
 async def fetch_rooms(socket, server, body):
     "Fetch all rooms this user is in and joins in them"
-    rooms = db.fetch_rooms(server, socket.user)
+    rooms = await server.rooms_cache.fetch(socket.user[0], server.query, db.fetch_rooms, socket.user)
     [server.join_room(socket, r[0]) for r in rooms] # Join all rooms this user is in
     await socket.send('FETCH_ROOMS', rooms)
 
 
 async def invite_member(socket, server, body):
     "Invite a user to a room based on their email id and send them the room data"
-    h,b = db.invite_member(server, socket.user, **body)
+    member = await cached_user(server, body.get('email'))
+    if not member:
+        return await socket.send('ERROR', {'message': 'Email ID not found'})
+
+    roomid = body['roomid']
+    h,b = await server.query(db.invite_member, socket.user, roomid, member)
     if h != 'ERROR':
-        roomid = body['roomid']
-        room = db.fetch_single_room(server, roomid)
+        room = await server.room_cache.fetch(roomid, server.query, db.fetch_single_room, roomid)
         await server.send_to(b[0], 'JOIN_ROOM', room)
 
         server.invite_to_room(b[0], roomid)
@@ -156,10 +343,10 @@ async def invite_member(socket, server, body):
 
 async def leave_member(socket, server, body):
     "Leaves the specified room, sends leave message to all other members"
-    if db.leave_member(server, socket.user, **body):
+    if await server.query(db.leave_member, socket.user, **body):
         roomid = body['roomid']
         await socket.send('LEAVE_ROOM', roomid)
-        server.leave_room(socket, roomid)
+        server.remove_from_room(socket.user[0], roomid)
         await server.send_room(roomid, 'MEMBER_LEAVE', (roomid, socket.user[0]))
     else:
         await socket.send('ERROR', {'message': 'You are not a member of this room'})
@@ -167,29 +354,77 @@ async def leave_member(socket, server, body):
 
 async def kick_member(socket, server, body):
     "Kicks a member from a room and send them the data"
-    if db.leave_member(server, socket.user, **body):
+    if await server.query(db.leave_member, socket.user, **body):
         memberid, roomid = body['memberid'], body['roomid']
         await server.send_to(memberid, 'LEAVE_ROOM', roomid)
         await server.send_room(roomid, 'MEMBER_LEAVE', (roomid, memberid))
-
-        socket2 = server.find_socket(memberid)
-        if socket2:
-            server.leave_room(socket2, roomid)
+        server.remove_from_room(memberid, roomid)
     else:
         await socket.send("ERROR", {'message': "Could not kick that member"})
 
 
 async def delete_room(socket, server, body):
     "Deletes the room if the user is the owner"
-    if db.delete_room(server, socket.user, **body):
+    if await server.query(db.delete_room, socket.user, **body):
         roomid = body['roomid']
         await server.send_room(roomid, 'LEAVE_ROOM', roomid)
-        server.rooms.pop(roomid, None)
+        server.delete_room(roomid)
     else:
         await socket.send('ERROR', {'message': 'Could not delete the room'})
 
 
+async def stats(socket, server, body):
+    "Server metrics, for admins only"
+    if socket.user[1] not in server.admins:
+        return await socket.send('ERROR', {'message': 'Unauthorised User'})
+    await socket.send('STATS', server.stats())
+
+
+def message_keys(chat):
+    "Messages to one chat keep their order, and wait for the upload they attach"
+    def keys(body):
+        keys = [(chat, body.get('_id'))]
+        if body.get('upload') is not None:
+            keys.append(('upload', body['upload']))
+        return keys
+    return keys
+
+
+def upload_keys(body):
+    return [('upload', body.get('uploadid'))]
+
+
+def room_keys(body):
+    return [('room', body.get('roomid'))]
+
+
+def profile_keys(body):
+    return [('profile',)]
+
+
+# Requests sent with an id run concurrently, except that requests sharing a
+# key run in the order they were sent and barriers wait for everything before them
+BARRIERS = {'HELLO', 'LOGIN', 'LOGOUT', 'DELETE_ACCOUNT', 'QUIT'}
+ORDER_BY = {
+    'SEND_MESSAGE': message_keys('room'),
+    'SEND_PRIVATE_MESSAGE': message_keys('friend'),
+    'HAS_ATTACHMENT': upload_keys,
+    'UPLOAD_START': upload_keys,
+    'UPLOAD_CHUNK': upload_keys,
+    'UPLOAD_END': upload_keys,
+    'INVITE_MEMBER': room_keys,
+    'LEAVE_MEMBER': room_keys,
+    'KICK_MEMBER': room_keys,
+    'DELETE_ROOM': room_keys,
+    'UPDATE_PROFILE': profile_keys,
+    'CHANGE_PASSWORD': profile_keys
+}
+
+
 ROUTES = {
+    'HELLO': hello,
+    'PING': ping,
+    'PONG': pong,
     'LOGIN': login,
     'REGISTER': register,
     'LOGOUT': logout,
@@ -198,6 +433,7 @@ ROUTES = {
     'UPDATE_PROFILE': update_profile,
     'FETCH_USER': fetch_user,
     'FETCH_RECENT_CHATS': fetch_recent_chats,
+    'FETCH_HISTORY': fetch_history,
     'FETCH_MEMBERS': fetch_members,
     'FETCH_FRIENDS': fetch_friends,
     'ADD_FRIEND': add_friend,
@@ -205,10 +441,16 @@ ROUTES = {
     'SEND_MESSAGE': send_message,
     'SEND_PRIVATE_MESSAGE': send_private_message,
     'DOWNLOAD_FILE': download_file,
+    'HAS_ATTACHMENT': has_attachment,
+    'UPLOAD_START': upload_start,
+    'UPLOAD_CHUNK': upload_chunk,
+    'UPLOAD_END': upload_end,
+    'DOWNLOAD_STREAM': download_stream,
     'CREATE_ROOM': create_room,
     'FETCH_ROOMS': fetch_rooms,
     'INVITE_MEMBER': invite_member,
     'LEAVE_MEMBER': leave_member,
     'KICK_MEMBER': kick_member,
-    'DELETE_ROOM': delete_room
+    'DELETE_ROOM': delete_room,
+    'STATS': stats
 }
@@ -1,85 +1,323 @@
 import asyncio
-import json
+import contextvars
+import logging
 import ssl
+import time
 
+import codec
+import logs
+import metrics
+from bus import LocalBus
 from collections import defaultdict
-from routes import ROUTES
+from routes import BARRIERS, ORDER_BY, ROUTES
 
 
+OUTBOUND_QUEUE_SIZE = 256 # Max frames waiting to be written to a single client
+STREAM_QUEUE_SIZE = 8 # Max download chunks waiting, kept apart so a download never crowds out messages
+OVERFLOW_POLICIES = ('drop', 'coalesce', 'disconnect')
+MAX_IN_FLIGHT = 16 # Requests with an id a single client can have running at once
+MAX_REQUEST_SIZE = 4 * 2**20 # Bytes a compressed client message may have, before or after decompressing, upload chunks are 64 KB
+MAX_FRAME_LENGTH = 70 * 2**20 # Bytes an uncompressed one may have, older clients send attachments of up to 50 MB base64 encoded
+SKIP_CHUNK_SIZE = 64 * 1024 # Bytes read at a time from a frame that is too large to keep
+
+# Connections that stop responding are closed by a sweep every REAP_INTERVAL seconds,
+# depending on what they were doing
+REAP_INTERVAL = 5
+HANDSHAKE_TIMEOUT = 10 # Seconds a new connection has for its TLS handshake and its first frame
+FRAME_TIMEOUT = 30 # Seconds the rest of a frame may take once its length arrived
+HEARTBEAT_INTERVAL = 30 # Seconds of silence before a client is sent a PING
+HEARTBEAT_TIMEOUT = 30 # Seconds a client has to answer a PING
+IDLE_TIMEOUT = 30 * 60 # Seconds of silence allowed from older clients that do not answer PINGs
+WRITE_TIMEOUT = 60 # Seconds a write may wait for the client to read
+CLOSE_TIMEOUT = 5 # Seconds a client that quits has to read the replies still queued for it
+
+logger = logging.getLogger('chat.socket')
+
+# The request being handled by the current task, replies to it carry its id
+current_request = contextvars.ContextVar('current_request', default=None)
+
 class SocketServer:
     "Main server, handles incoming connections and manages rooms"
-    def __init__(self, host, port):
+    def __init__(self, host, port, queue_size=OUTBOUND_QUEUE_SIZE, overflow='drop', bus=None, reuse_port=False, max_in_flight=MAX_IN_FLIGHT,
+                 compressors=codec.COMPRESSORS, compress_threshold=codec.COMPRESS_THRESHOLD):
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port # Lets worker processes share the listening port
+        self.bus = bus or LocalBus() # Tells the other workers about deliveries and room changes
 
-        self.sockets = []
-        self.rooms = defaultdict(list)
+        # What to do when a client's outbound queue is full:
+        # drop - discard the new frame, coalesce - discard the oldest queued frame
+        # so the client catches up with the latest ones, disconnect - close the client
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}')
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.max_in_flight = max_in_flight
+        self.compressors = compressors # name -> compressor clients may pick, empty turns compression off
+        self.compress_threshold = compress_threshold # Bytes a frame needs before it is compressed
 
-    def find_socket(self, userid):
-        "Returns the first socket with the given user id"
-        for s in self.sockets:
-            if s.user and s.user[0] == userid:
-                return s
+        self.sockets = set()
+        self.users = defaultdict(set) # userid -> all live sockets that user is logged in on
+        self.rooms = defaultdict(set) # roomid -> sockets in that room
+        self.friendships = {} # friend id -> (userid1, userid2), while either user is logged in here
+        self.user_friendships = defaultdict(set) # userid -> friend ids of that user in friendships
+        self.heartbeat_interval = HEARTBEAT_INTERVAL # Also told to clients in HELLO, they ping a server silent for longer
+        self.reaper = None
+
+    def collect_metrics(self):
+        metrics.CONNECTIONS.set(len(self.sockets))
+        metrics.USERS.set(len(self.users))
+        metrics.ROOMS.set(len(self.rooms))
+        metrics.ROOM_MEMBERS.clear()
+        for members in self.rooms.values():
+            metrics.ROOM_MEMBERS.observe(len(members))
+        metrics.QUEUED_FRAMES.set(sum(socket.queued() for socket in self.sockets))
+        metrics.BUS_PUBLISHED.set(getattr(self.bus, 'published', 0))
+        metrics.BUS_RECEIVED.set(getattr(self.bus, 'received', 0))
+
+    def socket_stats(self, limit=20):
+        "The sockets that were sent the most"
+        busiest = sorted(self.sockets, key=lambda socket: socket.bytes_out, reverse=True)[:limit]
+        return [{
+            'addr': socket.addr,
+            'user': socket.user[1] if socket.user else None,
+            'frames_out': socket.frames_out,
+            'bytes_out': socket.bytes_out,
+            'queued': socket.queued(),
+            'dropped': socket.dropped
+        } for socket in busiest]
+
+    def add_user(self, socket, user):
+        "Logs the socket in as the given user and indexes it by user id"
+        if socket.user:
+            self.remove_user(socket)
+        socket.user = user
+        self.users[user[0]].add(socket)
+
+    def remove_user(self, socket):
+        "Logs the socket out and removes it from the user index"
+        if not socket.user:
+            return
+        userid = socket.user[0]
+        self.users[userid].discard(socket)
+        if not self.users[userid]:
+            del self.users[userid]
+            self.forget_friendships(userid)
+        socket.user = None
+
+    def find_sockets(self, userid):
+        "Returns every socket the given user is logged in on"
+        return tuple(self.users.get(userid, ()))
+
+    def publish(self, event, *args):
+        "Applies an event on this worker and every other one, on_<event> handles it"
+        self.apply(event, args)
+        self.bus.publish(event, args)
+
+    def apply(self, event, args):
+        getattr(self, 'on_' + event)(*args)
+
+    def add_friendship(self, fid, userid1, userid2):
+        self.friendships[fid] = (userid1, userid2)
+        self.user_friendships[userid1].add(fid)
+        self.user_friendships[userid2].add(fid)
+
+    def remove_friendship(self, fid):
+        for userid in self.friendships.pop(fid, ()):
+            fids = self.user_friendships.get(userid)
+            if fids is not None:
+                fids.discard(fid)
+                if not fids:
+                    del self.user_friendships[userid]
+
+    def forget_friendships(self, userid):
+        "Drops the friendships of a user who left, except those of friends still logged in here"
+        for fid in tuple(self.user_friendships.get(userid, ())):
+            if not any(user in self.users for user in self.friendships[fid]):
+                self.remove_friendship(fid)
+
+    def on_friendship(self, fid, userid1, userid2):
+        if userid1 in self.users or userid2 in self.users: # Other workers only need it for their own users
+            self.add_friendship(fid, userid1, userid2)
+
+    def on_unfriend(self, fid, userid1, userid2):
+        self.remove_friendship(fid)
+
+    def on_update_profile(self, user):
+        "Updates the user on every socket they are logged in on, new messages carry the new username"
+        for socket in self.find_sockets(user[0]):
+            socket.user[2:] = user[2:]
+
+    def on_delete_user(self, user):
+        "Forgets every friendship of a deleted user"
+        for fid in tuple(self.user_friendships.get(user[0], ())):
+            self.remove_friendship(fid)
+
+    def friend_of(self, fid, userid):
+        "The other user of the friendship, None unless the given user is part of it"
+        pair = self.friendships.get(fid)
+        if not pair or userid not in pair:
+            return None
+        return pair[1] if pair[0] == userid else pair[0]
 
     def join_room(self, socket, roomid):
-        "Appends the socket to the room"
-        if socket not in self.rooms[roomid]:
-            self.rooms[roomid].append(socket)
+        "Adds the socket to the room"
+        self.rooms[roomid].add(socket)
+        socket.rooms.add(roomid)
 
     def leave_all_rooms(self, socket):
         "Make the socket leave all rooms"
-        [room.remove(socket) for room in self.rooms if socket in self.rooms]
+        for roomid in tuple(socket.rooms):
+            self.leave_room(socket, roomid)
 
     def leave_room(self, socket, roomid):
-        "Makes a socket leave a room"
-        if not socket:
+        "Makes a socket leave a room, the room is forgotten once empty"
+        socket.rooms.discard(roomid)
+        members = self.rooms.get(roomid)
+        if members is None:
             return
-        self.rooms[roomid].remove(socket)
-    
+        members.discard(socket)
+        if not members:
+            del self.rooms[roomid]
+
+    def delete_room(self, roomid):
+        "Removes the room along with all of its members, on every worker"
+        self.publish('delete_room', roomid)
+
+    def on_delete_room(self, roomid):
+        for socket in self.rooms.pop(roomid, ()):
+            socket.rooms.discard(roomid)
+
     def invite_to_room(self, userid, roomid):
-        "Finds the socket and makes it join the room"
-        socket = next((s for s in self.sockets if s.user and s.user[0] == userid), None)
-        if socket:
-            self.rooms[roomid].append(socket)
-    
+        "Makes every socket of the user join the room"
+        self.publish('invite', userid, roomid)
+
+    def on_invite(self, userid, roomid):
+        for socket in self.find_sockets(userid):
+            self.join_room(socket, roomid)
+
+    def remove_from_room(self, userid, roomid):
+        "Makes every socket of the user leave the room"
+        self.publish('remove_member', userid, roomid)
+
+    def on_remove_member(self, userid, roomid):
+        for socket in self.find_sockets(userid):
+            self.leave_room(socket, roomid)
+
     async def send_to(self, userid, header, body):
-        "Sends a message to particular user if connected"
-        socket = next((s for s in self.sockets if s.user and s.user[0] == userid), None)
-        if socket:
-            await socket.send(header, body)
+        "Sends a message to every device of a particular user if connected"
+        self.publish('send_to', userid, header, body)
+
+    def on_send_to(self, userid, header, body):
+        frame = Frame(header, body)
+        for socket in self.find_sockets(userid):
+            socket.enqueue(frame)
 
     async def create_room(self, members, room):
-        for s in self.sockets:
-            if s.user and s.user[0] in members:
+        self.publish('create_room', members, room)
+
+    def on_create_room(self, members, room):
+        frame = Frame('JOIN_ROOM', room)
+        for userid in members:
+            for s in self.find_sockets(userid):
                 self.join_room(s, room[0])
-                await s.send('JOIN_ROOM', room)
+                s.enqueue(frame)
+
+    def disconnect(self, socket):
+        "Forgets a closed socket"
+        self.sockets.discard(socket)
+        self.remove_user(socket)
+        self.leave_all_rooms(socket)
+
+    async def reap(self):
+        "Periodically closes connections that stopped sending, stalled in the middle of a frame or stopped reading"
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            now = loop.time()
+            for socket in list(self.sockets):
+                reason = socket.check(now)
+                if reason:
+                    socket.reap(reason)
 
     async def connect(self):
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.load_cert_chain(certfile="chatserver.crt", keyfile="chatserver.key")
-        self.server = await asyncio.start_server(self.listen, self.host, self.port, ssl=context)
+        await self.bus.start(self.apply)
+        # Registered only while serving, so servers that never serve or have stopped are not kept alive by metrics
+        metrics.COLLECTORS.append(self.collect_metrics)
+        self.reaper = asyncio.create_task(self.reap())
+        try:
+            self.server = await asyncio.start_server(self.listen, self.host, self.port, ssl=context, reuse_port=self.reuse_port or None,
+                                                     ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
 
-        print(f'Serving on {self.host}:{self.port}')
-        async with self.server:
-            await self.server.serve_forever()
+            logger.info('Serving', extra={'host': self.host, 'port': self.port})
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            metrics.COLLECTORS.remove(self.collect_metrics)
+            self.reaper.cancel()
 
     async def send_room(self, roomid, header, body):
-        for s in self.rooms.get(roomid, []):
-            await s.send(header, body)
+        "Queues the message for every member, slow members only delay themselves"
+        self.publish('send_room', roomid, header, body)
+
+    def on_send_room(self, roomid, header, body):
+        frame = Frame(header, body)
+        for s in self.rooms.get(roomid, ()):
+            s.enqueue(frame)
 
     async def sendall(self, header, body):
+        self.publish('sendall', header, body)
+
+    def on_sendall(self, header, body):
+        frame = Frame(header, body)
         for s in self.sockets:
-            await s.send(header, body)
+            s.enqueue(frame)
 
     async def listen(self, reader, writer):
         "Initialise new socket instance upon connection"
         socket = Socket(self, reader, writer)
-        print("\nConnection from:", socket.addr)
-        self.sockets.append(socket)
+        logger.info('Connection opened', extra={'addr': socket.addr})
+        self.sockets.add(socket)
 
         await socket.listen()
 
 
+class Request:
+    "A request sent with an id, the client matches replies to it by that id"
+    __slots__ = ('id', 'replied')
+
+    def __init__(self, id):
+        self.id = id
+        self.replied = False
+
+
+class Frame:
+    "A message that is encoded once per codec and compressor, the same bytes are written to every socket it is queued on"
+    __slots__ = ('header', 'body', 'id', 'encoded')
+
+    def __init__(self, header, body, id=None):
+        self.header = header
+        self.body = body
+        self.id = id # Id of the request this replies to, broadcasts have none
+        self.encoded = {} # (codec name, compressor name) -> length prefixed frame
+
+    def encode(self, wire, compressor=None, threshold=codec.COMPRESS_THRESHOLD):
+        "The length prefixed frame for the given codec and compressor, encoded on first use"
+        key = (wire.name, compressor and compressor.name)
+        data = self.encoded.get(key)
+        if data is None:
+            message = {
+                'header': self.header,
+                'body': self.body
+            }
+            if self.id is not None:
+                message['id'] = self.id
+            data = self.encoded[key] = codec.pack(wire.encode(message), compressor, threshold)
+        return data
+
+
 class Socket:
     "Manages communication to a particular client"
     def __init__(self, server: SocketServer, reader, writer):
@@ -88,52 +326,293 @@ class Socket:
         self.writer = writer
         self.addr = writer.get_extra_info('peername')
         self.user = None # [userid, email, username]
+        self.rooms = set() # roomids this socket has joined
+        self.codec = codec.JSON # Until the client negotiates another one with HELLO
+        self.compressor = None # Frames are sent as they are unless the client asks otherwise in HELLO
+        self.uploads = {} # uploadid -> files.Upload, until it is attached to a message
+
+        # Frames are queued here and written by a dedicated task
+        self.closed = False
+        self.stopping = False # The writer ends once the queues are empty
+        self.dropped = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.outbox = asyncio.Queue(server.queue_size)
+        self.stream = asyncio.Queue(STREAM_QUEUE_SIZE) # Download frames, which wait for room instead of overflowing
+        self.pending = asyncio.Event() # Set when either queue has frames for the writer
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+        # Requests with an id run as tasks, the ones sharing an ordering key one after another
+        self.in_flight = asyncio.Semaphore(server.max_in_flight)
+        self.tasks = set()
+        self.chains = {} # ordering key -> task of the latest request with that key
+
+        # Loop times of what the connection is doing, checked by the server's reaper
+        self.loop = asyncio.get_running_loop()
+        self.frames_in = 0
+        self.idle_since = None # Waiting for the next frame since
+        self.frame_started = None # Reading the rest of a frame since
+        self.write_started = None # Waiting for the client to read what was written since
+        self.pinged = None # Sent a PING that was not answered yet
+        self.heartbeat = False # The client answers PINGs, it says so in HELLO
+
+    def reply_frame(self, header, body):
+        "A frame carrying the id of the request being handled, if it has one"
+        request = current_request.get()
+        if request is None:
+            return Frame(header, body)
+        request.replied = True
+        return Frame(header, body, request.id)
+
+    def post(self, header, body):
+        "Queues a message without waiting for it to be written"
+        self.enqueue(self.reply_frame(header, body))
+
+    def enqueue(self, frame):
+        "Encodes the frame with this socket's codec and queues it, applying the overflow policy if the queue is full"
+        if self.closed:
+            return
+        data = frame.encode(self.codec, self.compressor, self.server.compress_threshold)
+        try:
+            self.outbox.put_nowait(data)
+            self.pending.set()
+            return
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.FRAMES_DROPPED.inc()
+
+        if self.server.overflow == 'coalesce':
+            self.outbox.get_nowait()
+            self.outbox.put_nowait(data)
+            self.pending.set()
+        elif self.server.overflow == 'disconnect':
+            logger.warning('Outbound queue full, disconnecting', extra={'addr': self.addr})
+            self.close()
 
     async def send(self, header, body):
-        data = json.dumps({
-            'header': header,
-            'body': body
-        }, default=str).encode('utf8')
-        
-        size = len(data).to_bytes(4, byteorder='big')
-        
-        self.writer.writelines([size, data])
-        await self.writer.drain()
+        "Sends a reply to this client"
+        self.post(header, body)
+
+    async def push(self, header, body):
+        "Queues a frame of a stream, waiting for room in the stream queue instead of applying the overflow policy"
+        if self.closed:
+            raise ConnectionResetError('Socket is closed')
+        await self.stream.put(self.reply_frame(header, body).encode(self.codec, self.compressor, self.server.compress_threshold))
+        self.pending.set()
+
+    def queued(self):
+        "Frames waiting to be written"
+        return self.outbox.qsize() + self.stream.qsize()
+
+    async def write_loop(self):
+        "Writes queued frames, everything queued since the last drain goes out in one write"
+        try:
+            while True:
+                if not self.queued():
+                    if self.stopping:
+                        return
+                    await self.pending.wait()
+                self.pending.clear()
+                frames = []
+                for queue in (self.outbox, self.stream):
+                    while not queue.empty():
+                        frames.append(queue.get_nowait())
+                if not frames:
+                    continue
+
+                self.writer.writelines(frames)
+                size = sum(map(len, frames))
+                self.frames_out += len(frames)
+                self.bytes_out += size
+                metrics.FRAMES_OUT.inc(amount=len(frames))
+                metrics.BYTES_OUT.inc(amount=size)
+                self.write_started = self.loop.time()
+                await self.writer.drain()
+                self.write_started = None
+        except ConnectionError as e:
+            logger.info('Write failed', extra={'addr': self.addr, 'error': str(e)})
+            self.close()
+        except Exception:
+            # Nothing would write for this socket any more, so it is closed rather than left to fill its queues
+            logger.exception('Writer failed', extra={'addr': self.addr})
+            self.close()
+
+    async def flush(self, timeout=CLOSE_TIMEOUT):
+        "Lets the writer send everything queued before a clean close, for up to timeout seconds"
+        self.stopping = True
+        self.pending.set()
+        await asyncio.wait([self.writer_task], timeout=timeout)
+
+    def close(self):
+        "Stops sending and closes the connection, which also ends the read loop"
+        self.closed = True
+        self.writer_task.cancel()
+        self.writer.close()
+
+        # Empty the queues so anything waiting in push wakes up and sees the socket is closed
+        for queue in (self.outbox, self.stream):
+            while not queue.empty():
+                queue.get_nowait()
+
+    def check(self, now):
+        "Returns why the connection should be closed, if it should, sends a PING once a client has been silent for a while"
+        if self.closed:
+            return None # Already on its way out
+        if self.frame_started is not None and now - self.frame_started > FRAME_TIMEOUT:
+            return 'frame'
+        if self.write_started is not None and now - self.write_started > WRITE_TIMEOUT:
+            return 'write'
+        if self.idle_since is None or self.tasks or self.queued() or self.write_started is not None:
+            return None # Busy, the client is heard from again once its requests and our writes are done
+
+        silent = now - self.idle_since
+        if self.frames_in == 0:
+            return 'handshake' if silent > HANDSHAKE_TIMEOUT else None
+        if not self.heartbeat:
+            return 'idle' if silent > IDLE_TIMEOUT else None
+        if self.pinged is not None:
+            return 'heartbeat' if now - self.pinged > HEARTBEAT_TIMEOUT else None
+        if silent > self.server.heartbeat_interval:
+            self.pinged = now
+            self.post('PING', {})
+        return None
+
+    def reap(self, reason):
+        "Drops a connection that stopped responding, the read loop then ends and cleans up after it"
+        metrics.REAPED.inc(reason)
+        logger.info('Reaping connection', extra={'addr': self.addr, 'reason': reason})
+        self.writer.transport.abort() # Closing would wait to flush to a client that is gone
+        self.close()
 
     async def read(self):
-        size = await self.reader.readexactly(4)
-        data = await self.reader.readexactly(int.from_bytes(size, byteorder='big'))
-        data = json.loads(data.decode('utf8'))
+        "Reads the next frame, one that is too large is skipped and answered with an ERROR"
+        while True:
+            self.idle_since = self.loop.time()
+            # The frame is timed from its first byte, a client stalling within the length is not idle
+            first = await self.reader.readexactly(1)
+            self.idle_since, self.frame_started = None, self.loop.time()
+            size = int.from_bytes(first + await self.reader.readexactly(3), byteorder='big')
+            length = size & codec.MAX_FRAME_SIZE
+            if length > (MAX_REQUEST_SIZE if size & codec.COMPRESSED else MAX_FRAME_LENGTH):
+                await self.skip(length)
+                data, error = None, f'Frame of {length} bytes is too large'
+            else:
+                data, error = await self.reader.readexactly(length), None
+            self.frame_started = self.pinged = None
+            self.frames_in += 1
+            metrics.FRAMES_IN.inc()
+            metrics.BYTES_IN.inc(amount=4 + length)
+
+            if data is not None:
+                try:
+                    data = self.codec.decode(codec.unpack(size, data, self.compressor, MAX_REQUEST_SIZE))
+                    return data.get('id'), data.get('header'), data.get('body')
+                except ValueError as e: # Too large once decompressed, or not a message in the negotiated codec
+                    error = str(e)
+            logger.warning('Frame rejected', extra={'addr': self.addr, 'error': error})
+            self.post('ERROR', {'message': error})
 
-        return data.get('header'), data.get('body')
+    async def skip(self, length):
+        "Reads past the rest of a frame without keeping it, so the next one can be read"
+        while length:
+            chunk = await self.reader.readexactly(min(length, SKIP_CHUNK_SIZE))
+            length -= len(chunk)
+            self.frame_started = self.loop.time() # Only a client that stops sending is stalled
 
     async def handle_request(self, header, body):  
         if header == 'QUIT':
             return True
 
-        login_not_required = ['LOGIN', 'REGISTER', 'QUIT']
+        login_not_required = ['HELLO', 'LOGIN', 'REGISTER', 'QUIT', 'PING', 'PONG']
         if header not in login_not_required and not self.user:
             return await self.send('ERROR', {'message': 'Unauthorised User'})
 
         if header in ROUTES:
-            await ROUTES[header](self, self.server, body)
+            start = time.perf_counter()
+            try:
+                await ROUTES[header](self, self.server, body)
+            except Exception:
+                metrics.REQUEST_ERRORS.inc(header)
+                raise
+            finally:
+                metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, header)
+
+    async def dispatch(self, request_id, header, body):
+        "Handles requests without an id in order, the rest concurrently, returns True once the client quits"
+        if request_id is None:
+            if self.tasks:
+                await asyncio.wait(self.tasks) # Older clients expect every request to finish before the next
+            return await self.handle_request(header, body)
+
+        if header in BARRIERS:
+            # Wait for everything before it, HELLO for one changes how the next frame is read
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+            return await self.handle(Request(request_id), header, body, ())
+
+        await self.in_flight.acquire() # Stops reading from a client that has too many requests running
+        keys = ORDER_BY[header](body) if header in ORDER_BY else ()
+        previous = [self.chains[key] for key in keys if key in self.chains]
+        task = asyncio.create_task(self.handle(Request(request_id), header, body, previous))
+        self.tasks.add(task)
+        task.add_done_callback(self.request_done)
+        for key in keys:
+            self.chains[key] = task
+        if keys:
+            task.add_done_callback(lambda task: self.forget_chains(task, keys))
+
+    def request_done(self, task):
+        self.tasks.discard(task)
+        self.in_flight.release()
+
+    def forget_chains(self, task, keys):
+        for key in keys:
+            if self.chains.get(key) is task:
+                del self.chains[key]
+
+    async def handle(self, request, header, body, previous):
+        "Handles a request with an id, every one of them gets at least one reply"
+        if previous:
+            await asyncio.wait(previous) # Same room or upload, keep the order they were sent in
+        token = current_request.set(request)
+        try:
+            finish = await self.handle_request(header, body)
+        except Exception:
+            logger.exception('Request failed', extra={'addr': self.addr, 'route': header})
+            self.post('ERROR', {'message': f'{header} failed'})
+            finish = False
+
+        if not request.replied and not finish:
+            self.post('ACK', {}) # The client is waiting on this id
+        current_request.reset(token)
+        return finish
 
     async def listen(self):
+        finish = False
         while True:
             try:
-                header, body = await self.read()
-                print(self.addr, header)
-                finish = await self.handle_request(header, body)
+                request_id, header, body = await self.read()
+                logs.log_request(header, addr=self.addr, id=request_id)
+                finish = await self.dispatch(request_id, header, body)
                 if finish:
-                    print(self.addr, 'Connection Closed')
+                    logger.info('Connection closed', extra={'addr': self.addr})
                     break
             except (asyncio.IncompleteReadError, ConnectionError) as e:
-                print(self.addr, "Disconnected due to error\n", e)
+                logger.info('Disconnected', extra={'addr': self.addr, 'error': str(e) or type(e).__name__})
                 break
-            except Exception as e:
-                print(f'\nError at {self.addr}:\n', e)
+            except Exception:
+                logger.exception('Request failed', extra={'addr': self.addr})
 
-        self.server.sockets.remove(self)
-        self.writer.close()
-        await self.writer.wait_closed()
+        self.server.disconnect(self)
+        if finish:
+            await self.flush() # The client quit, it still reads what was queued before that
+        self.close()
+        for task in self.tasks:
+            task.cancel()
+        for upload in self.uploads.values():
+            upload.abort()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
 
@@ -0,0 +1,79 @@
+"""
+Measures CPU time spent per room broadcast as the room grows
+
+Compares encoding the message once for the whole room against encoding
+it separately for every member, which is what send_room used to do.
+Run from anywhere: python benchmarks/broadcast.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+from socket_server import Frame, Socket, SocketServer
+
+
+ROOM_SIZES = (1, 10, 50, 100, 500, 1000)
+BROADCASTS = 200
+
+
+class NullWriter:
+    "Stands in for a StreamWriter, throws away everything written"
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 0)
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def message(roomid):
+    "A typical MESSAGE body"
+    return ['public', roomid, 'Hello there, how is everyone doing today?', 'user@example.com', 'username', None, None, datetime.now()]
+
+
+async def encode_once(server, roomid, body):
+    await server.send_room(roomid, 'MESSAGE', body)
+
+
+async def encode_each(server, roomid, body):
+    for s in server.rooms.get(roomid, ()):
+        s.enqueue(Frame('MESSAGE', body))
+
+
+async def measure(size, broadcast):
+    "Returns the CPU time per broadcast in microseconds, including writing out every frame"
+    server = SocketServer('localhost', 0, queue_size=BROADCASTS + 1)
+    sockets = [Socket(server, None, NullWriter()) for _ in range(size)]
+    for s in sockets:
+        server.join_room(s, 1)
+
+    start = time.process_time()
+    for _ in range(BROADCASTS):
+        await broadcast(server, 1, message(1))
+    while any(not s.outbox.empty() for s in sockets):
+        await asyncio.sleep(0)
+    elapsed = time.process_time() - start
+
+    [s.close() for s in sockets]
+    return elapsed / BROADCASTS * 1e6
+
+
+async def main():
+    print(f"{'members':>8} {'once (us)':>12} {'each (us)':>12} {'speedup':>8}")
+    for size in ROOM_SIZES:
+        once = await measure(size, encode_once)
+        each = await measure(size, encode_each)
+        print(f'{size:>8} {once:>12.1f} {each:>12.1f} {each / once:>7.1f}x')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,415 @@
+"""
+End to end load test, simulated users chatting through a real server
+
+Starts the server from a temporary folder with a throwaway MySQL database,
+or SQLite file with --backend sqlite, or uses a running one with --connect host:port. Every simulated user
+registers, logs in and joins a room, then sends messages at random, some
+with attachments, until the run ends. Reports how long messages took to
+reach each member of the room, throughput and the server's CPU and memory.
+
+Run from anywhere: python benchmarks/load.py --users 500 --duration 60
+The server needs Server/chatserver.key as usual, and psutil is needed for
+resource usage. Thousands of users need as many file descriptors, the
+soft limit is raised to the hard one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVER_DIR = os.path.join(ROOT, 'Server')
+CLIENT_DIR = os.path.join(ROOT, 'Client')
+sys.path.insert(0, CLIENT_DIR)
+from socket_client import SocketClient
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+PASSWORD = 'load test password'
+SETUP_CONCURRENCY = 32 # Users registering or logging in at once, the server hashes every password
+STARTUP_TIMEOUT = 60 # Seconds to wait for a spawned server to accept connections
+ATTACHMENT_SIZES = (16 * 1024, 256 * 1024, 2 * 2**20)
+LAG_INTERVAL = 0.1 # Seconds between samples of this process' own event loop lag
+
+
+def summary(values, scale=1000):
+    "Count and percentiles, in milliseconds by default"
+    values = sorted(values)
+    def percentile(q):
+        return values[min(len(values) - 1, int(q * len(values)))] * scale if values else None
+
+    return {
+        'count': len(values),
+        'p50': percentile(0.5),
+        'p99': percentile(0.99),
+        'p999': percentile(0.999),
+        'max': percentile(1)
+    }
+
+
+class Results:
+    "Everything measured during a run"
+    def __init__(self):
+        self.latencies = {} # request name -> seconds until its reply
+        self.deliveries = [] # seconds from sending a message to each member receiving it
+        self.expected = 0 # Deliveries that should have happened
+        self.errors = {}
+        self.lag = []
+
+    def observe(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class SimulatedUser(SocketClient):
+    "A headless client, scripted instead of driven by the GUI"
+    def __init__(self, host, port, run, index, results):
+        super().__init__(host, port, os.path.join(CLIENT_DIR, 'chatserver.crt'))
+        self.index = index
+        self.email = f'load-{run}-{index}@load.test'
+        self.username = f'l{run}{index}'
+        self.results = results
+        self.rooms = []
+        self.register_event('MESSAGE', self.on_message)
+        self.register_event('JOIN_ROOM', lambda room: self.rooms.append(room[0]))
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.sslcontext)
+        await self.handshake()
+        self.listener = asyncio.create_task(self.listen())
+
+    async def timed(self, name, header, **data):
+        "Sends a request, records how long the reply took and returns it"
+        start = time.perf_counter()
+        header, body = await self.request(header, **data)
+        self.results.observe(name, time.perf_counter() - start)
+        if header == 'ERROR' or (isinstance(body, dict) and body.get('error')):
+            self.results.error(name)
+        return header, body
+
+    async def login(self):
+        await self.timed('register', 'REGISTER', email=self.email, username=self.username, password=PASSWORD)
+        header, body = await self.timed('login', 'LOGIN', email=self.email, password=PASSWORD)
+        if body.get('error'):
+            raise RuntimeError(f'{self.email} could not log in: {body["message"]}')
+        self.userid = body['user'][0]
+
+    def on_message(self, body):
+        # ['public', roomid, content, email, username, actualname, filename, created_at, messageid]
+        content = body[2]
+        if content.startswith('load:'):
+            self.results.deliveries.append(time.perf_counter() - float(content.split(':')[2]))
+
+    async def chat(self, until, rate, members, attachments, attachment_rate):
+        "Sends messages at random intervals averaging rate per second"
+        roomid = self.rooms[0]
+        sent = 0
+        while True:
+            await asyncio.sleep(max(0, min(random.expovariate(rate), until - time.perf_counter())))
+            if time.perf_counter() >= until:
+                break
+
+            data = {'_id': roomid, 'attachment': None}
+            if attachments and random.random() < attachment_rate:
+                start = time.perf_counter()
+                data['upload'] = await self.upload(random.choice(attachments))
+                self.results.observe('upload', time.perf_counter() - start)
+
+            sent += 1
+            data['content'] = f'load:{self.index}:{time.perf_counter()}:{sent}'
+            header, body = await self.timed('send', 'SEND_MESSAGE', **data)
+            if header != 'ERROR':
+                self.results.expected += members
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+        if getattr(self, 'listener', None):
+            self.listener.cancel()
+
+
+async def monitor_lag(results):
+    "This process' own loop lag, if it is high the generator and not the server is the bottleneck"
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        results.lag.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+class ResourceMonitor:
+    "Samples CPU time and memory of the server process and all of its workers"
+    def __init__(self, pid):
+        self.process = psutil.Process(pid) if psutil and pid else None
+        self.peak_rss = 0
+
+    def processes(self):
+        try:
+            return [self.process] + self.process.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    def cpu(self):
+        total = 0
+        for process in self.processes():
+            try:
+                times = process.cpu_times()
+                total += times.user + times.system
+            except psutil.Error:
+                pass
+        return total
+
+    def sample(self):
+        rss = 0
+        for process in self.processes():
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def mysql_connection():
+    import mysql.connector
+    sys.path.insert(0, SERVER_DIR)
+    from main import DB_CONFIG
+    return mysql.connector.connect(**{key: value for key, value in DB_CONFIG.items() if key != 'database'})
+
+
+def execute(statement):
+    conn = mysql_connection()
+    try:
+        conn.cursor().execute(statement)
+    finally:
+        conn.close()
+
+
+class SpawnedServer:
+    "The server running from a temporary folder, so uploads, the bus socket and a sqlite database are thrown away with it"
+    def __init__(self, workers, backend):
+        self.workers = workers
+        self.backend = backend
+        self.port = free_port()
+        self.folder = tempfile.mkdtemp(prefix='chat-load-')
+        if backend == 'sqlite':
+            self.database = os.path.join(self.folder, 'chat.sqlite3')
+        else:
+            self.database = f'chat_load_{uuid.uuid4().hex[:8]}'
+        self.process = None
+
+    async def start(self):
+        for name in ('chatserver.crt', 'chatserver.key'):
+            shutil.copy(os.path.join(SERVER_DIR, name), self.folder)
+        if self.backend == 'mysql':
+            execute(f'CREATE DATABASE {self.database}')
+
+        self.process = subprocess.Popen([
+            sys.executable, os.path.join(SERVER_DIR, 'main.py'),
+            '--host', '127.0.0.1', '--port', str(self.port), '--backend', self.backend, '--database', self.database,
+            '--workers', str(self.workers), '--admin-port', '0', '--log-level', 'WARNING'
+        ], cwd=self.folder)
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited with {self.process.returncode}')
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.2)
+        raise RuntimeError('Server did not start in time')
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        try:
+            if self.backend == 'mysql':
+                execute(f'DROP DATABASE IF EXISTS {self.database}')
+        finally:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+async def gather_limited(limit, coroutines):
+    semaphore = asyncio.Semaphore(limit)
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+    return await asyncio.gather(*map(run, coroutines))
+
+
+def make_attachments(folder, count=8):
+    "A few files of different sizes, users pick from them so some uploads are deduplicated"
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f'attachment{i}.bin')
+        with open(path, 'wb') as file:
+            file.write(os.urandom(ATTACHMENT_SIZES[i % len(ATTACHMENT_SIZES)]))
+        paths.append(path)
+    return paths
+
+
+async def run(args, host, port, pid):
+    results = Results()
+    run_id = uuid.uuid4().hex[:6]
+    users = [SimulatedUser(host, port, run_id, i, results) for i in range(args.users)]
+    lag = asyncio.create_task(monitor_lag(results))
+    folder = tempfile.mkdtemp(prefix='chat-load-files-')
+    try:
+        start = time.perf_counter()
+        await gather_limited(SETUP_CONCURRENCY, [user.open() for user in users])
+        await gather_limited(SETUP_CONCURRENCY, [user.login() for user in users])
+
+        # User i joins room i % rooms, its first member creates it
+        rooms = [users[r::args.rooms] for r in range(min(args.rooms, args.users))]
+        await asyncio.gather(*[
+            members[0].timed('create_room', 'CREATE_ROOM', roomname=f'load {r}', members=[u.userid for u in members])
+            for r, members in enumerate(rooms)
+        ])
+        while any(not user.rooms for user in users):
+            await asyncio.sleep(0.05)
+        setup = time.perf_counter() - start
+
+        attachments = make_attachments(folder) if args.attachment_rate else []
+        monitor = ResourceMonitor(pid)
+        sampler = asyncio.create_task(monitor.run()) if monitor.process else None
+        cpu_start = monitor.cpu() if monitor.process else 0
+
+        start = time.perf_counter()
+        until = start + args.duration
+        await asyncio.gather(*[
+            user.chat(until, args.rate, len(members), attachments, args.attachment_rate)
+            for members in rooms for user in members
+        ])
+        elapsed = time.perf_counter() - start
+        cpu = monitor.cpu() - cpu_start if monitor.process else 0
+        await asyncio.sleep(args.drain) # Let the last messages arrive
+
+        server = None
+        if monitor.process:
+            sampler.cancel()
+            server = {'cpu_seconds': cpu, 'cpu_percent': cpu / elapsed * 100, 'peak_rss_mb': monitor.peak_rss / 2**20}
+    finally:
+        lag.cancel()
+        await asyncio.gather(*[user.close() for user in users])
+        shutil.rmtree(folder, ignore_errors=True)
+
+    sent = len(results.latencies.get('send', []))
+    return {
+        'users': args.users,
+        'rooms': len(rooms),
+        'setup_seconds': setup,
+        'duration_seconds': elapsed,
+        'messages_sent': sent,
+        'messages_per_second': sent / elapsed,
+        'deliveries': len(results.deliveries),
+        'deliveries_expected': results.expected,
+        'deliveries_per_second': len(results.deliveries) / elapsed,
+        'delivery_ms': summary(results.deliveries),
+        'request_ms': {name: summary(values) for name, values in results.latencies.items()},
+        'errors': results.errors,
+        'generator_lag_ms': summary(results.lag),
+        'server': server
+    }
+
+
+def report(results):
+    def row(name, s):
+        if not s['count']:
+            return f'{name:<14} {0:>8}'
+        return f"{name:<14} {s['count']:>8} {s['p50']:>9.1f} {s['p99']:>9.1f} {s['p999']:>9.1f} {s['max']:>9.1f}"
+
+    print(f"{results['users']} users in {results['rooms']} rooms, set up in {results['setup_seconds']:.1f}s")
+    print(f"{results['messages_sent']} messages in {results['duration_seconds']:.1f}s, "
+          f"{results['messages_per_second']:.0f}/s sent, {results['deliveries_per_second']:.0f}/s delivered")
+    lost = results['deliveries_expected'] - results['deliveries']
+    print(f"{results['deliveries']} of {results['deliveries_expected']} deliveries arrived ({lost} missing)\n")
+
+    print(f"{'ms':<14} {'count':>8} {'p50':>9} {'p99':>9} {'p999':>9} {'max':>9}")
+    print(row('delivery', results['delivery_ms']))
+    for name, s in results['request_ms'].items():
+        print(row(name, s))
+    print(row('generator lag', results['generator_lag_ms']))
+
+    if results['errors']:
+        print('\nErrors:', ', '.join(f'{name} {count}' for name, count in results['errors'].items()))
+    if results['server']:
+        server = results['server']
+        print(f"\nServer: {server['cpu_seconds']:.1f} CPU seconds ({server['cpu_percent']:.0f}% of one core), "
+              f"peak RSS {server['peak_rss_mb']:.0f} MB")
+    elif not psutil:
+        print('\nInstall psutil to report server CPU and memory')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless chat load test')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of chatting')
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per user per second')
+    parser.add_argument('--attachment-rate', type=float, default=0.01, help='fraction of messages with an attachment')
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for deliveries after the last message')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the spawned server')
+    parser.add_argument('--backend', choices=('mysql', 'sqlite'), default='mysql', help='database of the spawned server')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='use a running server instead of spawning one')
+    parser.add_argument('--pid', type=int, help='process id of the running server, for resource usage')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except ValueError:
+        pass # Keep the soft limit where the hard one cannot be used as is
+
+    async def start():
+        if args.connect:
+            host, port = args.connect.rsplit(':', 1)
+            return await run(args, host, int(port), args.pid)
+
+        server = SpawnedServer(args.workers, args.backend)
+        try:
+            await server.start()
+            return await run(args, '127.0.0.1', server.port, server.process.pid)
+        finally:
+            server.stop()
+
+    results = asyncio.run(start())
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
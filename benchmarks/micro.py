@@ -0,0 +1,410 @@
+"""
+Micro benchmarks for the hot paths, compared against a baseline recorded on the same machine
+
+Times framing, the codecs, room fan-out and the hot database.py queries
+one at a time, each as the median of several repeats. Record a baseline
+with --save before changing socket_server.py or database.py, then run
+again with the change: the run fails if a case got slower than both its
+threshold and the noise measured between its repeats allow.
+
+Run from anywhere: python benchmarks/micro.py [--only framing,codec] [--save]
+Database cases seed a throwaway database of every backend at every size
+in DATASET_SIZES, MySQL ones are skipped when it cannot be reached. The
+baseline is a local file, it is never committed since timings only compare
+on the machine and python they were recorded with.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from datetime import datetime, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'Server'))
+import codec
+import database as db
+from broadcast import NullWriter
+from socket_server import Frame, Socket, SocketServer
+
+
+BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+# A case regressed when it is this much slower than its baseline. Medians of the unchanged tree
+# moved by up to 30% between runs, database ones by up to 50% as they depend on caches and disks
+THRESHOLD = 0.5
+THRESHOLDS = {'db': 1.0} # Per group overrides
+NOISE_MARGIN = 2 # Nor may it be slower than this many times the spread of the repeats of both runs
+REPEATS = 7
+MIN_TIME = 0.2 # Seconds a single repeat should take at least, the number of runs grows until it does
+
+RECENT_CHATS_SIZES = (50, 1000)
+ROOM_SIZES = (10, 100, 1000)
+DB_BACKENDS = ('mysql', 'sqlite')
+DATASET_SIZES = (1000, 10000, 100000) # Messages in the seeded database, with a tenth as many users
+ROOMS_PER_USER = 3
+FRIENDS_PER_USER = 5
+PRIVATE_SHARE = 0.2 # Fraction of the seeded messages sent between friends
+
+CASES = [] # (group, name, run), run(number) returns the seconds number operations took
+
+
+def case(group, name):
+    def register(run):
+        CASES.append((group, f'{group}.{name}', run))
+        return run
+    return register
+
+
+def chat_message(roomid=1, messageid=1):
+    "A typical MESSAGE body, also a RECENT_CHATS row without its type"
+    return [roomid, 'Hello there, how is everyone doing today?', 'user@example.com', 'username', None, None, datetime.now(), messageid]
+
+
+def recent_chats(size):
+    "A RECENT_CHATS body as fetch_recent_chats returns it, every tenth message has an attachment"
+    rows = []
+    for i in range(size):
+        row = ['public', *chat_message(i % 20, i)]
+        if i % 10 == 0:
+            row[5:7] = ['holiday.jpg', uuid.uuid4().hex]
+        rows.append(row)
+    return rows
+
+
+# Framing
+
+def framing_cases():
+    @case('framing', 'send')
+    async def send(number):
+        "Queues a MESSAGE on one socket and writes it out"
+        server = SocketServer('localhost', 0, queue_size=number + 1)
+        socket = Socket(server, None, NullWriter())
+        body = chat_message()
+        start = time.perf_counter()
+        for _ in range(number):
+            await socket.send('MESSAGE', body)
+        while not socket.outbox.empty():
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        socket.close()
+        return elapsed
+
+    @case('framing', 'read')
+    async def read(number):
+        "Reads and decodes a MESSAGE from the stream"
+        server = SocketServer('localhost', 0)
+        reader = asyncio.StreamReader()
+        data = Frame('SEND_MESSAGE', chat_message(), 1).encode(codec.JSON)
+        reader.feed_data(data * number)
+        socket = Socket(server, reader, NullWriter())
+        start = time.perf_counter()
+        for _ in range(number):
+            await socket.read()
+        elapsed = time.perf_counter() - start
+        socket.close()
+        return elapsed
+
+
+# Codecs
+
+def codec_cases():
+    for name, wire in codec.CODECS.items():
+        for size in RECENT_CHATS_SIZES:
+            register_codec(name, wire, size)
+    for name, compressor in codec.COMPRESSORS.items():
+        register_compressor(name, compressor, RECENT_CHATS_SIZES[-1])
+
+
+def register_codec(name, wire, size):
+    message = {'header': 'RECENT_CHATS', 'body': recent_chats(size)}
+    data = wire.encode(message)
+
+    @case('codec', f'{name}_encode[{size}]')
+    def encode(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            wire.encode(message)
+        return time.perf_counter() - start
+
+    @case('codec', f'{name}_decode[{size}]')
+    def decode(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            wire.decode(data)
+        return time.perf_counter() - start
+
+
+def register_compressor(name, compressor, size):
+    "Compressing the largest RECENT_CHATS frame, as it would be sent and read over a connection that negotiated it"
+    data = codec.JSON.encode({'header': 'RECENT_CHATS', 'body': recent_chats(size)})
+    packed = codec.pack(data, compressor)
+
+    @case('codec', f'{name}_compress[{size}]')
+    def compress(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            codec.pack(data, compressor)
+        return time.perf_counter() - start
+
+    @case('codec', f'{name}_decompress[{size}]')
+    def decompress(number):
+        size, body = int.from_bytes(packed[:4], byteorder='big'), packed[4:]
+        start = time.perf_counter()
+        for _ in range(number):
+            codec.unpack(size, body, compressor)
+        return time.perf_counter() - start
+
+
+# Fan-out
+
+def fanout_cases():
+    for size in ROOM_SIZES:
+        register_fanout(size)
+
+
+def register_fanout(size):
+    @case('fanout', f'send_room[{size}]')
+    async def send_room(number):
+        "One MESSAGE to every member of a room, until it is written to all of them"
+        server = SocketServer('localhost', 0, queue_size=number + 1)
+        sockets = [Socket(server, None, NullWriter()) for _ in range(size)]
+        for s in sockets:
+            server.join_room(s, 1)
+        body = chat_message()
+        start = time.perf_counter()
+        for _ in range(number):
+            await server.send_room(1, 'MESSAGE', body)
+        while any(not s.outbox.empty() for s in sockets):
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        [s.close() for s in sockets]
+        return elapsed
+
+
+# Database
+
+def execute(statement):
+    "Runs a statement outside of any database, for creating and dropping the throwaway ones"
+    import mysql.connector
+    from main import DB_CONFIG
+    conn = mysql.connector.connect(**{key: value for key, value in DB_CONFIG.items() if key != 'database'})
+    try:
+        conn.cursor().execute(statement)
+    finally:
+        conn.close()
+
+
+def seed(session, messages):
+    "Fills a migrated database, user 1 is HOT_USER so the hot queries find its rooms, friends and messages"
+    users = max(messages // 10, FRIENDS_PER_USER + 1)
+    rooms = max(users // 10, ROOMS_PER_USER)
+    rng = random.Random(messages)
+    # The prepared MySQL cursor would insert row by row
+    cursor = session.conn.cursor() if session.dialect == 'mysql' else session.cursor
+
+    cursor.executemany("INSERT INTO users (userid, username, email, password) VALUES (%s, %s, %s, %s)", [
+        (userid, f'user{userid}', db.HOT_USER[1] if userid == 1 else f'user{userid}@example.com', 'x')
+        for userid in range(1, users + 1)
+    ])
+    cursor.executemany("INSERT INTO rooms (roomid, roomname, ownerid) VALUES (%s, %s, %s)", [
+        (roomid, f'room{roomid}', rng.randint(1, users)) for roomid in range(1, rooms + 1)
+    ])
+    members = {(userid, roomid) for userid in range(1, users + 1) for roomid in rng.sample(range(1, rooms + 1), ROOMS_PER_USER)}
+    cursor.executemany("INSERT INTO room_members (userid, roomid) VALUES (%s, %s)", sorted(members))
+    friends = {tuple(sorted((userid, (userid + i) % users + 1))) for userid in range(1, users + 1) for i in range(FRIENDS_PER_USER)}
+    friends = sorted(pair for pair in friends if pair[0] != pair[1])
+    cursor.executemany("INSERT INTO friends (id, userid1, userid2) VALUES (%s, %s, %s)", [(fid, *pair) for fid, pair in enumerate(friends, 1)])
+
+    members = sorted(members)
+    start = datetime.now() - timedelta(seconds=messages)
+    rows = []
+    for messageid in range(1, messages + 1):
+        if rng.random() < PRIVATE_SHARE:
+            fid = rng.randint(1, len(friends))
+            author, roomid, friendid = rng.choice(friends[fid - 1]), None, fid
+        else:
+            author, roomid = rng.choice(members)
+            friendid = None
+        rows.append((messageid, roomid, friendid, author, 'Hello there, how is everyone doing today?', start + timedelta(seconds=messageid)))
+        if len(rows) == 10000 or messageid == messages:
+            cursor.executemany("INSERT INTO messages (messageid, roomid, friendid, author, content, created_at) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+            rows = []
+    session.conn.commit()
+    if session.dialect == 'mysql':
+        cursor.execute("ANALYZE TABLE users, rooms, room_members, friends, messages")
+        cursor.fetchall()
+    else:
+        cursor.execute("ANALYZE")
+
+
+def throwaway_database(backend, folder):
+    "Creates an empty database, returns its name and a function dropping it"
+    if backend == 'sqlite':
+        path = os.path.join(folder, f'{uuid.uuid4().hex[:8]}.sqlite3')
+        return path, lambda: None # Removed with the folder
+    database = f'chat_bench_{uuid.uuid4().hex[:8]}'
+    execute(f'CREATE DATABASE {database}')
+    return database, lambda: execute(f'DROP DATABASE IF EXISTS {database}')
+
+
+def db_cases(folder):
+    "Seeds a database per backend and size, returns the functions dropping them again"
+    import migrations
+    from main import db_config
+    from pool import ConnectionPool
+
+    backends = list(DB_BACKENDS)
+    if 'mysql' in backends:
+        try:
+            execute('SELECT 1')
+        except Exception as e:
+            print(f'Skipping MySQL database cases, it is not available: {e}')
+            backends.remove('mysql')
+
+    drops = []
+    for backend in backends:
+        for size in DATASET_SIZES:
+            database, drop = throwaway_database(backend, folder)
+            drops.append(drop)
+
+            pool = ConnectionPool(1, backend=backend, **db_config(backend, database))
+            with pool.session() as session:
+                migrations.migrate(session)
+                seed(session, size)
+
+            for func, args, kwargs in db.HOT_QUERIES:
+                name = func.__name__ + (f'_{args[1]}' if func.__name__ == 'fetch_history' else '')
+                register_query(pool, f'{backend}.{name}[{size}]', func, args, kwargs)
+    return drops
+
+
+def register_query(pool, name, func, args, kwargs):
+    @case('db', name)
+    def query(number):
+        "The query alone, in one transaction, as a database thread runs it"
+        with pool.session() as session:
+            start = time.perf_counter()
+            for _ in range(number):
+                func(session, *args, **kwargs)
+            return time.perf_counter() - start
+
+
+# Running and comparing
+
+async def call(run, number):
+    elapsed = run(number)
+    if inspect.isawaitable(elapsed):
+        elapsed = await elapsed
+    return elapsed
+
+
+async def measure(run):
+    "Seconds per operation as the median of REPEATS runs long enough to time reliably, and their spread around it"
+    number = 1
+    while True:
+        elapsed = await call(run, number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 10 if elapsed < MIN_TIME / 10 else 2
+    times = sorted([elapsed] + [await call(run, number) for _ in range(REPEATS - 1)])
+    median = statistics.median(times)
+    # Half the interquartile range, relative to the median, outliers from other processes do not count
+    spread = (percentile(times, 0.75) - percentile(times, 0.25)) / 2
+    return {'median': median / number, 'spread': spread / median}
+
+
+def percentile(values, fraction):
+    "Interpolated percentile of sorted values, statistics.quantiles needs python 3.8"
+    position = (len(values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def load_baseline():
+    "The saved results, or none when there are none for this machine and python"
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print('No baseline yet, record one with --save before making a change\n')
+        return {'results': {}}
+    if baseline.get('environment') != environment():
+        print(f"Ignoring the baseline recorded with {baseline.get('environment')}, record one here with --save\n")
+        return {'results': {}}
+    # Results saved by older versions were a bare best time, without the spread to compare them with
+    baseline['results'] = {name: result for name, result in baseline['results'].items() if isinstance(result, dict)}
+    return baseline
+
+
+def environment():
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor() or None}
+
+
+async def run(args):
+    groups = set(args.only.split(',')) if args.only else {'framing', 'codec', 'fanout', 'db'}
+    if 'framing' in groups:
+        framing_cases()
+    if 'codec' in groups:
+        codec_cases()
+    if 'fanout' in groups:
+        fanout_cases()
+    folder = tempfile.mkdtemp(prefix='chat-bench-')
+    drops = db_cases(folder) if 'db' in groups else []
+
+    baseline = load_baseline()
+    results = {}
+    regressions = []
+    try:
+        print(f"{'case':<40} {'baseline (us)':>14} {'now (us)':>12} {'change':>8} {'allowed':>8}")
+        for group, name, run_case in CASES:
+            now = results[name] = await measure(run_case)
+            before = baseline['results'].get(name)
+            if before is None:
+                print(f'{name:<40} {"-":>14} {now["median"] * 1e6:>12.2f} {"new":>8}')
+                continue
+
+            change = now['median'] / before['median'] - 1
+            threshold = THRESHOLDS.get(group, THRESHOLD) if args.threshold is None else args.threshold
+            allowed = max(threshold, NOISE_MARGIN * (before['spread'] + now['spread']))
+            regressed = change > allowed
+            if regressed:
+                regressions.append(name)
+            print(f'{name:<40} {before["median"] * 1e6:>14.2f} {now["median"] * 1e6:>12.2f} {change:>+7.0%} {allowed:>7.0%}{" SLOWER" if regressed else ""}')
+    finally:
+        for drop in drops:
+            drop()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.save:
+        baseline = {'environment': environment(), 'results': {**baseline['results'], **results}}
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nSaved {len(results)} results to {BASELINE}')
+    elif regressions:
+        print(f'\n{len(regressions)} cases regressed: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--only', help='Comma separated groups to run: framing, codec, fanout, db')
+    parser.add_argument('--threshold', type=float, help=f'Allowed slowdown for every group, {THRESHOLD} and {THRESHOLDS} by default')
+    parser.add_argument('--save', action='store_true', help='Record the results as the new baseline')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
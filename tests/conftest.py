@@ -0,0 +1,67 @@
+"""
+Fixtures shared by the tests, run them from the repository root: python -m pytest
+
+The server modules import each other by name, so Server is put on the path
+as running main.py from that folder does. Tests taking a session run once
+for every backend in backends.BACKENDS, each against a new migrated
+database. SQLite always runs, MySQL is skipped when the server in
+main.DB_CONFIG cannot be reached.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+import migrations
+from backends import BACKENDS
+from main import DB_CONFIG, db_config
+from pool import ConnectionPool
+
+
+def mysql_execute(statement):
+    "Runs a statement outside of any database, for creating and dropping the throwaway ones"
+    import mysql.connector
+    conn = mysql.connector.connect(**{key: value for key, value in DB_CONFIG.items() if key != 'database'})
+    try:
+        conn.cursor().execute(statement)
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=list(BACKENDS))
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def database(backend, tmp_path):
+    "An empty database of the backend, dropped after the test"
+    if backend == 'sqlite':
+        yield str(tmp_path / 'chat.sqlite3')
+        return
+
+    name = f'chat_test_{uuid.uuid4().hex[:8]}'
+    try:
+        mysql_execute(f'CREATE DATABASE {name}')
+    except Exception as e:
+        pytest.skip(f'MySQL is not available: {e}')
+    try:
+        yield name
+    finally:
+        mysql_execute(f'DROP DATABASE IF EXISTS {name}')
+
+
+@pytest.fixture
+def pool(backend, database):
+    return ConnectionPool(2, 5, backend, **db_config(backend, database))
+
+
+@pytest.fixture
+def session(pool):
+    "A session of the migrated database, closed before the database is dropped"
+    session = pool.checkout()
+    migrations.migrate(session)
+    yield session
+    session.conn.close()
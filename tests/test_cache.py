@@ -0,0 +1,82 @@
+"""
+Cache expiry, eviction and invalidation, with a clock the tests move
+"""
+import asyncio
+import types
+
+import pytest
+
+import cache
+from cache import Cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    "Seconds on the cache's clock, tests add to now[0]"
+    now = [100.0]
+    monkeypatch.setattr(cache, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def fetch(entries, key, load):
+    return asyncio.run(entries.fetch(key, load, key))
+
+
+def test_entries_expire_after_the_ttl(clock):
+    entries = Cache('test', ttl=10)
+    entries.put('a', 1)
+    clock[0] += 9
+    assert entries.get('a') == (True, 1)
+    clock[0] += 2
+    assert entries.get('a') == (False, None)
+    assert (entries.hits, entries.misses, entries.expirations) == (1, 1, 1)
+
+
+def test_least_recently_used_is_evicted(clock):
+    entries = Cache('test', max_size=2)
+    entries.put('a', 1)
+    entries.put('b', 2)
+    entries.get('a')
+    entries.put('c', 3)
+    assert [key for key in ('a', 'b', 'c') if entries.get(key)[0]] == ['a', 'c']
+    assert entries.evictions == 1
+
+
+def test_fetch_loads_once(clock):
+    loads = []
+    async def load(key):
+        loads.append(key)
+        return key.upper()
+
+    entries = Cache('test')
+    assert fetch(entries, 'a', load) == fetch(entries, 'a', load) == 'A'
+    assert loads == ['a']
+
+
+def test_missing_rows_are_not_cached(clock):
+    async def load(key):
+        return None
+
+    entries = Cache('test')
+    assert fetch(entries, 'a', load) is None
+    assert entries.get('a') == (False, None)
+
+
+def test_invalidate(clock):
+    entries = Cache('test')
+    for key in 'abc':
+        entries.put(key, key.upper())
+    entries.invalidate('a')
+    entries.invalidate_where(lambda key, value: value == 'B')
+    assert [key for key in 'abc' if entries.get(key)[0]] == ['c']
+    assert entries.invalidations == 2
+
+
+def test_load_racing_an_invalidation_is_not_cached(clock):
+    entries = Cache('test')
+    async def load(key):
+        entries.invalidate(key) # Written while the old row was being read
+        return 'old'
+
+    assert fetch(entries, 'a', load) == 'old'
+    assert entries.get('a') == (False, None)
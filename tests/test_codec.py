@@ -0,0 +1,63 @@
+"""
+Frame encoding, compression and the size compressed frames may expand to
+"""
+from datetime import datetime
+
+import pytest
+
+import codec
+
+
+MESSAGE = {'header': 'MESSAGE', 'body': ['public', 1, 'hello', datetime(2024, 1, 2, 3, 4, 5, 6), b'\x00\xff']}
+AVAILABLE = list(codec.COMPRESSORS.values())
+
+
+def frame_of(data):
+    "(size, data) as read back from a packed frame"
+    return int.from_bytes(data[:4], 'big'), data[4:]
+
+
+@pytest.mark.parametrize('wire', list(codec.CODECS.values()), ids=list(codec.CODECS))
+def test_codecs_round_trip(wire):
+    decoded = wire.decode(wire.encode(MESSAGE))
+    assert decoded['body'][4] == b'\x00\xff'
+    assert str(decoded['body'][3]) == str(MESSAGE['body'][3])
+
+
+def test_negotiate_falls_back_to_json():
+    assert codec.negotiate(['unknown']) is codec.JSON
+    assert codec.negotiate_compressor(['unknown']) is None
+
+
+@pytest.mark.parametrize('compressor', AVAILABLE, ids=[c.name for c in AVAILABLE])
+def test_large_frames_are_compressed(compressor):
+    data = b'x' * codec.COMPRESS_THRESHOLD
+    size, payload = frame_of(codec.pack(data, compressor))
+    assert size & codec.COMPRESSED and len(payload) < len(data)
+    assert codec.unpack(size, payload, compressor) == data
+
+
+@pytest.mark.parametrize('compressor', AVAILABLE, ids=[c.name for c in AVAILABLE])
+def test_small_frames_are_sent_as_they_are(compressor):
+    data = b'x' * (codec.COMPRESS_THRESHOLD - 1)
+    assert codec.pack(data, compressor) == len(data).to_bytes(4, 'big') + data
+
+
+@pytest.mark.parametrize('compressor', AVAILABLE, ids=[c.name for c in AVAILABLE])
+def test_frames_that_do_not_shrink_are_sent_as_they_are(compressor):
+    data = bytes(range(256))
+    assert codec.pack(data, compressor, threshold=0) == len(data).to_bytes(4, 'big') + data
+
+
+@pytest.mark.parametrize('compressor', AVAILABLE, ids=[c.name for c in AVAILABLE])
+def test_compressed_frame_may_not_expand_beyond_the_limit(compressor):
+    size, payload = frame_of(codec.pack(b'\x00' * 10001, compressor, threshold=0))
+    assert len(codec.unpack(size, payload, compressor, limit=10001)) == 10001
+    with pytest.raises(ValueError):
+        codec.unpack(size, payload, compressor, limit=10000)
+
+
+def test_compressed_frame_needs_a_negotiated_compressor():
+    size, payload = frame_of(codec.pack(b'x' * 100, codec.COMPRESSORS['zlib'], threshold=0))
+    with pytest.raises(ValueError):
+        codec.unpack(size, payload, None)
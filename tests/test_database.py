@@ -0,0 +1,201 @@
+"""
+database.py and the migrations, on every backend
+
+Functions are called the way server.query calls them, each in its own
+transaction, so a failure rolling back does not take earlier steps with it.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import database as db
+import files
+import migrations
+from backends import BACKENDS
+
+
+UNUSED, USED, RECENT = 'a' * 32, 'b' * 32, 'c' * 32 # Stored file names
+OLD = datetime.now() - timedelta(hours=1)
+
+
+def call(session, func, *args, **kwargs):
+    "Runs a database.py function and commits, as a pooled session does"
+    result = func(session, *args, **kwargs)
+    session.conn.commit()
+    return result
+
+
+def register(session, *names):
+    "Registers users by name, returns their (userid, email, username) rows"
+    users = []
+    for name in names:
+        assert call(session, db.register_user, f'{name}@example.com', name, 'hash')
+        users.append(call(session, db.fetch_user, f'{name}@example.com'))
+    return users
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    "Stored attachments go to a temporary folder"
+    monkeypatch.setattr(files, 'UPLOAD_DIR', str(tmp_path))
+    return tmp_path
+
+
+def attachment(session, filename):
+    "The (size, refs) of an attachment row, None once it is collected"
+    session.cursor.execute("SELECT size, refs FROM attachments WHERE filename=%s", (filename,))
+    return session.cursor.fetchone()
+
+
+def test_every_backend_has_its_statements():
+    assert set(db.UPSERT_ATTACHMENT) == set(BACKENDS)
+    for version, description, statements in migrations.MIGRATIONS:
+        if isinstance(statements, dict):
+            assert set(statements) == set(BACKENDS), description
+
+
+def test_migrate_twice(session):
+    latest = migrations.MIGRATIONS[-1][0]
+    assert migrations.schema_version(session) == latest
+    assert migrations.migrate(session) == latest
+    session.cursor.execute("SELECT COUNT(*) FROM schema_version")
+    assert session.cursor.fetchone()[0] == len(migrations.MIGRATIONS)
+
+
+def test_register_and_login(session):
+    alice, = register(session, 'alice')
+    assert alice[1:] == ('alice@example.com', 'alice')
+    assert not call(session, db.register_user, 'ALICE@example.com', 'other', 'hash') # Emails ignore case
+    assert not call(session, db.register_user, 'other@example.com', 'Alice', 'hash') # So do usernames
+
+    assert call(session, db.fetch_login, 'alice@example.com')[-1] == 'hash'
+    call(session, db.set_password, alice[0], 'rehashed')
+    assert call(session, db.fetch_password, alice[0]) == 'rehashed'
+    assert call(session, db.fetch_password, alice[0] + 100) is None
+    assert call(session, db.fetch_user, 'nobody@example.com') is None
+
+
+def test_update_profile(session):
+    alice, bob = register(session, 'alice', 'bob')
+    assert call(session, db.update_profile, alice, 'alicia', 123, 'Street 1')[0] == 'INFO'
+    assert call(session, db.fetch_login, 'alice@example.com')[2:5] == ('alicia', 123, 'Street 1')
+    assert call(session, db.update_profile, alice, 'bob', None, None)[0] == 'ERROR'
+
+
+def test_rooms(session):
+    alice, bob, carol = register(session, 'alice', 'bob', 'carol')
+    roomid, roomname, ownerid = call(session, db.create_room, alice, 'room', [alice[0], bob[0]])
+    assert (roomname, ownerid) == ('room', alice[0])
+    assert call(session, db.fetch_rooms, bob) == [(roomid, 'room', alice[0])]
+    assert call(session, db.fetch_single_room, roomid) == (roomid, 'room', alice[0])
+    assert call(session, db.fetch_members, alice, {}) == [(roomid, *bob)]
+
+    assert call(session, db.invite_member, alice, roomid, carol) == ('MEMBER_JOIN', carol)
+    assert call(session, db.invite_member, alice, roomid, carol)[0] == 'ERROR'
+    assert call(session, db.leave_member, alice, bob[0], roomid)
+    assert call(session, db.fetch_rooms, bob) == []
+
+    call(session, db.delete_room, carol, roomid) # Only the owner can
+    assert call(session, db.fetch_single_room, roomid)
+    call(session, db.delete_room, alice, roomid)
+    assert call(session, db.fetch_single_room, roomid) is None
+    assert call(session, db.fetch_rooms, carol) == []
+
+
+def test_friends(session):
+    alice, bob, carol = register(session, 'alice', 'bob', 'carol')
+    h, (fid, *friend) = call(session, db.add_friend, bob, alice)
+    assert h == 'ADD_FRIEND' and friend == list(alice)
+    assert call(session, db.add_friend, alice, bob)[0] == 'ERROR'
+    assert call(session, db.fetch_friends, alice) == [(fid, *bob)]
+    assert call(session, db.fetch_friends, bob) == [(fid, *alice)]
+
+    assert call(session, db.remove_friend, carol, fid, bob[0])[0] == 'ERROR' # Not carol's friendship
+    assert call(session, db.fetch_friends, alice) == [(fid, *bob)]
+    assert call(session, db.remove_friend, alice, fid, bob[0]) == ('REMOVE_FRIEND', fid)
+    assert call(session, db.fetch_friends, bob) == []
+
+
+def test_history_pages(session):
+    alice, bob, carol = register(session, 'alice', 'bob', 'carol')
+    roomid = call(session, db.create_room, alice, 'room', [alice[0], bob[0]])[0]
+    sent = call(session, db.add_messages, [(alice, {'_id': roomid, 'content': f'message {i}'}) for i in range(5)])
+    assert [m[1] for m in sent] == [f'message {i}' for i in range(5)]
+
+    page, more = call(session, db.fetch_history, bob, 'public', roomid, limit=3)
+    assert [m[0] for m in page] == ['message 4', 'message 3', 'message 2'] and more
+    page, more = call(session, db.fetch_history, bob, 'public', roomid, before=page[-1][-1], limit=3)
+    assert [m[0] for m in page] == ['message 1', 'message 0'] and not more
+    assert isinstance(page[0][5], datetime)
+    assert call(session, db.fetch_history, carol, 'public', roomid) == ([], False) # Not a member
+
+    fid = call(session, db.add_friend, alice, carol)[1][0]
+    call(session, db.add_message, carol, _id=fid, content='hi', private=True)
+    assert [m[0] for m in call(session, db.fetch_history, alice, 'private', fid)[0]] == ['hi']
+    assert call(session, db.fetch_history, bob, 'private', fid) == ([], False)
+
+    recent = call(session, db.fetch_recent_chats, alice, {})
+    assert sorted((r[0], r[2]) for r in recent) == sorted([('private', 'hi')] + [('public', f'message {i}') for i in range(5)])
+
+
+def test_delete_account_cascades(session):
+    alice, bob = register(session, 'alice', 'bob')
+    roomid = call(session, db.create_room, bob, 'room', [alice[0], bob[0]])[0]
+    call(session, db.add_message, alice, _id=roomid, content='bye')
+    call(session, db.add_friend, alice, bob)
+
+    call(session, db.delete_account, alice)
+    assert call(session, db.fetch_user, 'alice@example.com') is None
+    assert call(session, db.fetch_history, bob, 'public', roomid) == ([], False)
+    assert call(session, db.fetch_friends, bob) == []
+    assert call(session, db.fetch_members, bob, {}) == []
+
+
+def test_upsert_attachment(session):
+    alice, = register(session, 'alice')
+    roomid = call(session, db.create_room, alice, 'room', [alice[0]])[0]
+
+    call(session, db.add_attachment, USED, 10)
+    call(session, db.add_attachment, USED, 10) # Uploaded again
+    assert attachment(session, USED) == (10, 0)
+    assert call(session, db.has_attachment, USED, 10)
+    assert not call(session, db.has_attachment, USED, 11)
+
+    stored = ('file.txt', USED, 10)
+    call(session, db.add_messages, [(alice, {'_id': roomid, 'content': '', 'stored': stored})] * 2)
+    assert attachment(session, USED) == (10, 2)
+
+
+def test_collect_attachments(session, uploads):
+    alice, = register(session, 'alice')
+    roomid = call(session, db.create_room, alice, 'room', [alice[0]])[0]
+    for filename in (UNUSED, USED, RECENT):
+        (uploads / filename).write_bytes(b'x' * 10)
+        session.cursor.execute(db.UPSERT_ATTACHMENT[session.dialect], (filename, 10, 0, OLD))
+    call(session, db.add_attachment, RECENT, 10)
+    call(session, db.add_message, alice, _id=roomid, content='', stored=('file.txt', USED, 10))
+
+    assert call(session, db.collect_attachments, 60) == [UNUSED]
+    assert call(session, db.delete_attachment, UNUSED, 60)
+    assert attachment(session, UNUSED) is None and not (uploads / UNUSED).exists()
+    assert attachment(session, RECENT) == (10, 0) # Still in its grace period
+    assert attachment(session, USED) == (10, 1)
+
+    # Messages deleted by a cascade leave their counts behind, the next collection recounts them
+    call(session, db.delete_room, alice, roomid)
+    session.cursor.execute("UPDATE attachments SET last_used=%s", (OLD,))
+    assert sorted(call(session, db.collect_attachments, 60)) == sorted([RECENT, USED])
+
+
+def test_collector_skips_attachments_claimed_since(session, uploads):
+    for filename in (UNUSED, USED):
+        (uploads / filename).write_bytes(b'x' * 10)
+        session.cursor.execute(db.UPSERT_ATTACHMENT[session.dialect], (filename, 10, 0, OLD))
+    assert sorted(call(session, db.collect_attachments, 60)) == sorted([UNUSED, USED])
+
+    # Between collecting and deleting, one is offered to a sender and the other uploaded again
+    assert call(session, db.has_attachment, UNUSED, 10)
+    call(session, db.add_attachment, USED, 10)
+    for filename in (UNUSED, USED):
+        assert not call(session, db.delete_attachment, filename, 60)
+        assert attachment(session, filename) == (10, 0) and (uploads / filename).exists()
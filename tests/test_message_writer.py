@@ -0,0 +1,91 @@
+"""
+MessageWriter batching, and what a sender gets back when a batch fails
+
+The writer is built before asyncio.run, as Server does, so a loop bound
+object created in __init__ would show up here as a hang. Every send is
+awaited with a timeout instead of forever.
+"""
+import asyncio
+
+import database as db
+from message_writer import MessageWriter
+
+
+USER = [1, 'user@example.com', 'user']
+TIMEOUT = 5
+
+
+class FakeServer:
+    "Answers the writer's queries without a database, after yielding to the loop like the executor does"
+    def __init__(self, bad=()):
+        self.bad = bad # Contents of messages that fail to insert
+        self.calls = []
+
+    async def query(self, func, *args, **kwargs):
+        self.calls.append(func)
+        await asyncio.sleep(0.01)
+        if func is db.add_messages:
+            messages = args[0]
+            if any(message['content'] in self.bad for _, message in messages):
+                raise RuntimeError('Batch rolled back')
+            return [message['content'] for _, message in messages]
+        if kwargs['content'] in self.bad:
+            raise RuntimeError('Insert failed')
+        return kwargs['content']
+
+
+class BrokenLock:
+    "A lock that cannot be taken, like one bound to another loop"
+    async def __aenter__(self):
+        raise RuntimeError('is bound to a different event loop')
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def send(writer, *contents, delay=0):
+    "Sends every message at once, or delay seconds apart, returns what each sender got"
+    async def one(content, after):
+        await asyncio.sleep(after)
+        return await writer.add(USER, _id=1, content=content)
+
+    async def main():
+        sends = [one(content, i * delay) for i, content in enumerate(contents)]
+        return await asyncio.wait_for(asyncio.gather(*sends), TIMEOUT)
+    return asyncio.run(main())
+
+
+def test_messages_sent_together_share_a_batch():
+    server = FakeServer()
+    writer = MessageWriter(server, max_size=64, max_delay=0.005)
+    assert send(writer, 'a', 'b', 'c') == ['a', 'b', 'c']
+    assert server.calls == [db.add_messages]
+    assert (writer.batches, writer.messages) == (1, 3)
+
+
+def test_full_batch_is_written_without_waiting():
+    server = FakeServer()
+    writer = MessageWriter(server, max_size=2, max_delay=60)
+    assert send(writer, 'a', 'b', 'c', 'd') == ['a', 'b', 'c', 'd']
+    assert writer.batches == 2
+
+
+def test_batches_written_one_after_another():
+    # The second batch waits on the lock while the first is written, the hang on 3.8 and 3.9
+    writer = MessageWriter(FakeServer(), max_size=64, max_delay=0.001)
+    assert send(writer, 'a', 'b', 'c', delay=0.005) == ['a', 'b', 'c']
+    assert writer.batches == 3
+
+
+def test_failed_batch_is_retried_one_message_at_a_time():
+    server = FakeServer(bad={'b'})
+    writer = MessageWriter(server)
+    assert send(writer, 'a', 'b', 'c') == ['a', False, 'c']
+    assert server.calls == [db.add_messages] + [db.add_message] * 3
+    assert writer.fallbacks == 1
+
+
+def test_senders_get_false_when_the_batch_cannot_be_written():
+    writer = MessageWriter(FakeServer())
+    writer.lock = BrokenLock()
+    assert send(writer, 'a', 'b') == [False, False]
@@ -0,0 +1,74 @@
+"""
+Password hashes, and the upgrade of older ones when their user logs in
+"""
+import asyncio
+import base64
+import hashlib
+import os
+
+import pytest
+
+import database as db
+import passwords
+import routes
+
+
+def legacy_hash(password):
+    "A hash in the format used before scrypt, base64(salt + sha512(password + salt))"
+    salt = os.urandom(16)
+    return base64.b64encode(salt + hashlib.sha512(password.encode() + salt).digest()).decode()
+
+
+class Server:
+    "Runs computations inline and keeps the queries it was asked to run"
+    def __init__(self):
+        self.queries = []
+
+    async def compute(self, func, *args):
+        return func(*args)
+
+    async def query(self, func, *args):
+        self.queries.append((func, *args))
+
+
+@pytest.mark.parametrize('kdf', ['scrypt', 'pbkdf2'])
+def test_hash_and_verify(kdf, monkeypatch):
+    monkeypatch.setitem(passwords.PBKDF2_PARAMS, 'i', 1000) # Keeps the test fast
+    hashed = passwords.hash_password('secret', kdf)
+    assert passwords.verify_password('secret', hashed)
+    assert passwords.verify_password('secret', hashed.encode()) # As MySQL may return it
+    assert not passwords.verify_password('wrong', hashed)
+    assert not passwords.needs_rehash(hashed, kdf)
+    assert passwords.needs_rehash(hashed, 'scrypt' if kdf == 'pbkdf2' else 'pbkdf2')
+
+
+def test_changed_parameters_need_a_rehash(monkeypatch):
+    hashed = passwords.hash_password('secret')
+    monkeypatch.setitem(passwords.SCRYPT_PARAMS, 'n', 2**15)
+    assert passwords.needs_rehash(hashed)
+    assert passwords.verify_password('secret', hashed) # The parameters are stored with it
+
+
+def test_legacy_hash():
+    hashed = legacy_hash('secret')
+    assert passwords.verify_password('secret', hashed)
+    assert not passwords.verify_password('wrong', hashed)
+    assert passwords.needs_rehash(hashed)
+    assert not passwords.verify_password('secret', 'not base64 at all')
+
+
+def test_login_upgrades_a_legacy_hash():
+    server = Server()
+    assert asyncio.run(routes.verify_password(server, 7, 'secret', legacy_hash('secret')))
+    (func, userid, hashed), = server.queries
+    assert (func, userid) == (db.set_password, 7)
+    assert passwords.verify_password('secret', hashed) and not passwords.needs_rehash(hashed)
+
+
+def test_failed_login_keeps_the_hash():
+    server = Server()
+    assert not asyncio.run(routes.verify_password(server, 7, 'wrong', legacy_hash('secret')))
+    assert not asyncio.run(routes.verify_password(server, 7, 'secret', None))
+    current = passwords.hash_password('secret')
+    assert asyncio.run(routes.verify_password(server, 7, 'secret', current))
+    assert server.queries == []
@@ -0,0 +1,107 @@
+"""
+Query plans of the hot database.py reads
+
+Each read is recorded instead of run and its statements are explained. A
+plan fails when it scans a whole table or sorts rows in a temporary b-tree.
+SQLite plans an empty database as if every table were large, while it has
+no statistics. MySQL plans tiny tables as scans, so it is seeded first.
+"""
+import pytest
+
+import database as db
+from backends import Session
+
+
+USER = db.HOT_USER
+HOT_QUERIES = [
+    pytest.param(func, args, kwargs, id=func.__name__ + (f'[{args[1]}]' if func is db.fetch_history else ''))
+    for func, args, kwargs in db.HOT_QUERIES
+]
+# Merges every conversation of the user by created_at, no single index has that order
+SORTS = {'fetch_recent_chats'}
+
+
+class RecordingCursor:
+    "Stands in for a cursor, records every statement instead of running it"
+    lastrowid = None
+    rowcount = 0
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=()):
+        self.statements.append((query, params))
+
+    def executemany(self, query, params):
+        pass
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+def statements(func, args, kwargs, dialect):
+    session = Session(None, RecordingCursor(), dialect)
+    func(session, *args, **kwargs)
+    return session.cursor.statements
+
+
+def sqlite_problems(session, query, params, sorts):
+    plan = session.conn.execute('EXPLAIN QUERY PLAN ' + query.replace('%s', '?'), params).fetchall()
+    return [detail for _, _, _, detail in plan
+            if (detail.startswith('SCAN ') and 'CONSTANT ROW' not in detail) or ('TEMP B-TREE' in detail and not sorts)]
+
+
+def mysql_problems(session, query, params, sorts):
+    cursor = session.conn.cursor(dictionary=True)
+    cursor.execute('EXPLAIN ' + query, params)
+    problems = []
+    for row in cursor.fetchall():
+        extra = row['Extra'] or ''
+        if row['type'] == 'ALL' and not row['table'].startswith('<'): # Not a union or derived result
+            problems.append(f"scans all of {row['table']}")
+        if ('Using filesort' in extra or 'Using temporary' in extra) and not sorts:
+            problems.append(f"{row['table']}: {extra}")
+    return problems
+
+
+def seed(session, users=1000, rooms=100, messages=20000):
+    "Enough rows for MySQL to plan as it would on a busy server"
+    cursor = session.conn.cursor() # The prepared cursor would insert row by row
+    cursor.executemany("INSERT INTO users (userid, username, email, password) VALUES (%s, %s, %s, %s)", [
+        (userid, f'user{userid}', USER[1] if userid == 1 else f'user{userid}@example.com', 'x') for userid in range(1, users + 1)
+    ])
+    cursor.executemany("INSERT INTO rooms (roomid, roomname, ownerid) VALUES (%s, %s, %s)", [
+        (roomid, f'room{roomid}', roomid) for roomid in range(1, rooms + 1)
+    ])
+    cursor.executemany("INSERT INTO room_members (userid, roomid) VALUES (%s, %s)", [
+        (userid, (userid + i) % rooms + 1) for userid in range(1, users + 1) for i in range(3)
+    ])
+    cursor.executemany("INSERT INTO friends (id, userid1, userid2) VALUES (%s, %s, %s)", [
+        (userid, userid, userid + 1) for userid in range(1, users)
+    ])
+    rows = []
+    for messageid in range(1, messages + 1):
+        if messageid % 5: # A fifth of the messages are private
+            roomid, friendid = messageid % rooms + 1, None
+        else:
+            roomid, friendid = None, messageid % (users - 1) + 1
+        rows.append((messageid, roomid, friendid, messageid % users + 1, 'Hello'))
+    cursor.executemany("INSERT INTO messages (messageid, roomid, friendid, author, content) VALUES (%s, %s, %s, %s, %s)", rows)
+    session.conn.commit()
+    cursor.execute("ANALYZE TABLE users, rooms, room_members, friends, messages")
+    cursor.fetchall()
+
+
+@pytest.mark.parametrize('func, args, kwargs', HOT_QUERIES)
+def test_hot_query_uses_indexes(session, func, args, kwargs):
+    if session.dialect == 'mysql':
+        seed(session)
+    problems_of = sqlite_problems if session.dialect == 'sqlite' else mysql_problems
+
+    problems = []
+    for query, params in statements(func, args, kwargs, session.dialect):
+        problems += problems_of(session, query, params, func.__name__ in SORTS)
+    assert not problems, '\n'.join(problems)
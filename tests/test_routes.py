@@ -0,0 +1,80 @@
+"""
+Routes, called directly with a socket that keeps its replies
+"""
+import asyncio
+import base64
+
+import files
+import routes
+from socket_server import SocketServer
+
+
+class FakeSocket:
+    "Keeps every reply instead of queueing it"
+    def __init__(self, user=None):
+        self.user = user
+        self.sent = []
+
+    async def send(self, header, body):
+        self.sent.append((header, body))
+
+    def enqueue(self, frame):
+        self.sent.append((frame.header, frame.body))
+
+
+class FakeWriter:
+    "Stores messages the way MessageWriter does, without a database"
+    async def add(self, user, _id, content, private=False):
+        return [_id, content, user[1], user[2], None, None, None, 1]
+
+
+def logged_in(server, user):
+    "A socket the user is logged in on"
+    socket = FakeSocket()
+    server.add_user(socket, list(user))
+    return socket
+
+
+def call(route, socket, server, body):
+    asyncio.run(route(socket, server, body))
+    return socket.sent
+
+
+def test_download_file_sends_a_stored_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(files, 'UPLOAD_DIR', str(tmp_path))
+    (tmp_path / ('a' * 32)).write_bytes(b'attached')
+    sent = call(routes.download_file, FakeSocket(), None, {'filename': 'a' * 32, 'actualname': 'file.txt'})
+    assert sent == [('DOWNLOAD_FILE', ['file.txt', base64.b64encode(b'attached').decode()])]
+
+
+def test_download_file_only_reads_stored_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # The server runs with uploads in its working directory
+    (tmp_path / files.UPLOAD_DIR).mkdir()
+    (tmp_path / 'secret').write_bytes(b'secret')
+    for filename in ('../secret', 'b' * 32, None):
+        header, body = call(routes.download_file, FakeSocket(), None, {'filename': filename, 'actualname': 'file.txt'})[0]
+        assert header == 'ERROR' and 'does not exist' in body['message']
+
+
+def test_private_message_reaches_every_device_of_both_users():
+    server = SocketServer('localhost', 0)
+    server.writer = FakeWriter()
+    alice, bob = [1, 'alice@example.com', 'alice', None, None], [2, 'bob@example.com', 'bob', None, None]
+    phone, laptop, friend = logged_in(server, alice), logged_in(server, alice), logged_in(server, bob)
+    server.add_friendship(5, 1, 2)
+
+    call(routes.send_private_message, phone, server, {'_id': 5, 'content': 'hi'})
+    for socket in (phone, laptop, friend):
+        assert socket.sent == [('MESSAGE', ['private', 5, 'hi', 'alice@example.com', 'alice', None, None, None, 1])]
+
+
+def test_profile_update_reaches_every_device():
+    class Server(SocketServer):
+        async def query(self, func, *args, **kwargs):
+            return 'INFO', {'message': 'Profile Successfully Updated!'}
+
+    server = Server('localhost', 0)
+    alice = [1, 'alice@example.com', 'alice', None, None]
+    phone, laptop = logged_in(server, alice), logged_in(server, alice)
+    call(routes.update_profile, phone, server, {'username': 'alicia', 'phone': 123, 'address': 'Street 1'})
+    assert phone.user == laptop.user == [1, 'alice@example.com', 'alicia', 123, 'Street 1']
@@ -0,0 +1,307 @@
+"""
+The server side of a connection, without a network
+
+Sockets read from a StreamReader fed by the test and write to a FakeWriter
+that keeps every frame, each test runs in its own event loop.
+"""
+import asyncio
+import json
+import zlib
+
+import codec
+import metrics
+import socket_server
+from socket_server import (FRAME_TIMEOUT, HANDSHAKE_TIMEOUT, HEARTBEAT_TIMEOUT, IDLE_TIMEOUT, WRITE_TIMEOUT,
+                           SocketServer, Socket)
+
+
+TIMEOUT = 5
+
+
+class FakeWriter:
+    "Keeps what the socket writes instead of sending it"
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+        self.transport = self
+        self.error = None # Raised by the next drain
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 50000)
+
+    def writelines(self, frames):
+        for frame in frames:
+            self.data += frame
+
+    async def drain(self):
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeUser:
+    "Stands in for a socket a user logs in on"
+    user = None
+
+
+def run(test, **options):
+    "Runs test(server, socket, reader, writer) in a new loop"
+    async def main():
+        server = SocketServer('localhost', 0, **options)
+        reader, writer = asyncio.StreamReader(), FakeWriter()
+        socket = Socket(server, reader, writer)
+        server.sockets.add(socket)
+        try:
+            return await asyncio.wait_for(test(server, socket, reader, writer), TIMEOUT)
+        finally:
+            socket.close()
+    return asyncio.run(main())
+
+
+def frame(header, body=None, id=None, compress=False):
+    "A frame as a client sends it"
+    message = {'header': header, 'body': body or {}}
+    if id is not None:
+        message['id'] = id
+    data = json.dumps(message).encode()
+    if compress:
+        data = zlib.compress(data)
+        return (len(data) | codec.COMPRESSED).to_bytes(4, 'big') + data
+    return len(data).to_bytes(4, 'big') + data
+
+
+def written(writer):
+    "(header, body, id) of every frame written so far"
+    frames, data = [], bytes(writer.data)
+    while data:
+        size = int.from_bytes(data[:4], 'big')
+        message = json.loads(data[4:4 + size])
+        frames.append((message['header'], message['body'], message.get('id')))
+        data = data[4 + size:]
+    return frames
+
+
+async def settle(socket):
+    "Lets the writer task write everything queued"
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_legacy_attachment_larger_than_the_compressed_limit():
+    # SEND_MESSAGE with a 3.5 MB attachment base64 encoded, the way older clients send it
+    body = {'_id': 1, 'content': '', 'attachment': ['file.bin', 'A' * (3 * 2**20 * 4 // 3 + 4)]}
+
+    async def test(server, socket, reader, writer):
+        reader.feed_data(frame('SEND_MESSAGE', body))
+        assert len(frame('SEND_MESSAGE', body)) > socket_server.MAX_REQUEST_SIZE
+        assert await socket.read() == (None, 'SEND_MESSAGE', body)
+    run(test)
+
+
+def test_frame_too_large_is_skipped(monkeypatch):
+    monkeypatch.setattr(socket_server, 'MAX_FRAME_LENGTH', 1000)
+    monkeypatch.setattr(socket_server, 'SKIP_CHUNK_SIZE', 300)
+
+    async def test(server, socket, reader, writer):
+        reader.feed_data(frame('SEND_MESSAGE', {'content': 'x' * 2000}) + frame('PING', id=7))
+        assert await socket.read() == (7, 'PING', {})
+        await settle(socket)
+        (header, body, id), = written(writer)
+        assert header == 'ERROR' and 'too large' in body['message']
+        assert not writer.closed and socket.frames_in == 2
+    run(test)
+
+
+def test_compressed_frame_may_not_expand_beyond_the_limit():
+    async def test(server, socket, reader, writer):
+        socket.compressor = codec.COMPRESSORS['zlib']
+        bomb = frame('SEND_MESSAGE', {'content': ' ' * (socket_server.MAX_REQUEST_SIZE + 1)}, compress=True)
+        assert len(bomb) < 100 * 1024
+        reader.feed_data(bomb + frame('PING', {'small': 'x' * 100}, compress=True))
+        assert await socket.read() == (None, 'PING', {'small': 'x' * 100})
+        await settle(socket)
+        assert [header for header, _, _ in written(writer)] == ['ERROR']
+    run(test)
+
+
+def test_compressed_frame_before_compression_was_negotiated():
+    async def test(server, socket, reader, writer):
+        reader.feed_data(frame('PING', compress=True) + frame('PING'))
+        assert await socket.read() == (None, 'PING', {})
+        await settle(socket)
+        assert [header for header, _, _ in written(writer)] == ['ERROR']
+    run(test)
+
+
+def test_replies_queued_before_quit_are_written():
+    async def test(server, socket, reader, writer):
+        for i in range(3):
+            socket.post('MESSAGE', i)
+        reader.feed_data(frame('QUIT'))
+        await socket.listen()
+        assert [body for _, body, _ in written(writer)] == [0, 1, 2]
+        assert writer.closed and socket not in server.sockets
+    run(test)
+
+
+def test_writer_error_closes_the_socket():
+    async def test(server, socket, reader, writer):
+        writer.error = RuntimeError('Encoder broke')
+        socket.post('MESSAGE', 0)
+        await asyncio.wait([socket.writer_task])
+        assert socket.closed and writer.closed
+        socket.post('MESSAGE', 1)
+        assert socket.queued() == 0
+    run(test)
+
+
+def test_friendships_are_kept_while_either_friend_is_logged_in():
+    server = SocketServer('localhost', 0)
+    alice, bob = FakeUser(), FakeUser()
+    server.add_user(alice, [1])
+    server.add_user(bob, [2])
+    server.add_friendship(10, 1, 2)
+    server.add_friendship(11, 1, 3)
+
+    server.remove_user(alice)
+    assert server.friendships == {10: (1, 2)} # Bob may still message alice
+    server.on_friendship(12, 3, 4) # Between users on other workers
+    assert 12 not in server.friendships
+    server.remove_user(bob)
+    assert server.friendships == {} and server.user_friendships == {}
+
+
+class Routes(dict):
+    "Stand in routes that log when each request starts and ends, sleeping for body['delay'] in between"
+    def __init__(self, *headers):
+        super().__init__((header, self.route) for header in headers)
+        self.log = []
+
+    async def route(self, socket, server, body):
+        self.log.append(('start', body['n']))
+        await asyncio.sleep(body.get('delay', 0))
+        self.log.append(('end', body['n']))
+        if body.get('reply'):
+            await socket.send('REPLY', body['n'])
+
+
+def dispatch(monkeypatch, requests, **options):
+    "Dispatches (id, header, body) requests as they would be read, returns the route log and the frames written"
+    routes = Routes(*{header for _, header, _ in requests})
+    monkeypatch.setattr(socket_server, 'ROUTES', routes)
+
+    async def test(server, socket, reader, writer):
+        socket.user = [1, 'user@example.com', 'user']
+        for request_id, header, body in requests:
+            await socket.dispatch(request_id, header, body)
+        while socket.tasks:
+            await asyncio.wait(socket.tasks)
+        await settle(socket)
+        return routes.log, written(writer)
+    return run(test, **options)
+
+
+def test_messages_to_one_room_keep_their_order(monkeypatch):
+    log, _ = dispatch(monkeypatch, [
+        (1, 'SEND_MESSAGE', {'_id': 1, 'n': 1, 'delay': 0.02}),
+        (2, 'SEND_MESSAGE', {'_id': 1, 'n': 2})
+    ])
+    assert log == [('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+
+
+def test_messages_to_different_rooms_run_concurrently(monkeypatch):
+    log, _ = dispatch(monkeypatch, [
+        (1, 'SEND_MESSAGE', {'_id': 1, 'n': 1, 'delay': 0.02}),
+        (2, 'SEND_MESSAGE', {'_id': 2, 'n': 2})
+    ])
+    assert log == [('start', 1), ('start', 2), ('end', 2), ('end', 1)]
+
+
+def test_message_waits_for_the_upload_it_attaches(monkeypatch):
+    log, _ = dispatch(monkeypatch, [
+        (1, 'UPLOAD_END', {'uploadid': 'u', 'n': 1, 'delay': 0.02}),
+        (2, 'SEND_PRIVATE_MESSAGE', {'_id': 5, 'upload': 'u', 'n': 2}),
+        (3, 'SEND_PRIVATE_MESSAGE', {'_id': 6, 'n': 3})
+    ])
+    assert log == [('start', 1), ('start', 3), ('end', 3), ('end', 1), ('start', 2), ('end', 2)]
+
+
+def test_barrier_waits_for_every_request_before_it(monkeypatch):
+    log, _ = dispatch(monkeypatch, [
+        (1, 'SEND_MESSAGE', {'_id': 1, 'n': 1, 'delay': 0.02}),
+        (2, 'FETCH_HISTORY', {'n': 2, 'delay': 0.01}),
+        (3, 'LOGOUT', {'n': 3}),
+        (4, 'FETCH_HISTORY', {'n': 4})
+    ])
+    assert log.index(('start', 3)) == 4 and log[-2:] == [('start', 4), ('end', 4)]
+
+
+def test_request_without_an_id_waits_like_older_clients_expect(monkeypatch):
+    log, _ = dispatch(monkeypatch, [
+        (1, 'FETCH_HISTORY', {'n': 1, 'delay': 0.02}),
+        (None, 'FETCH_ROOMS', {'n': 2})
+    ])
+    assert log == [('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+
+
+def test_requests_in_flight_are_limited(monkeypatch):
+    log, _ = dispatch(monkeypatch, [(n, 'FETCH_HISTORY', {'n': n, 'delay': 0.01 * (3 - n)}) for n in range(3)], max_in_flight=2)
+    assert log[:3] == [('start', 0), ('start', 1), ('end', 1)] # The third is read once the second is done
+    assert log.index(('start', 2)) == 3
+
+
+def test_every_request_with_an_id_is_answered(monkeypatch):
+    _, frames = dispatch(monkeypatch, [
+        (1, 'FETCH_HISTORY', {'n': 1, 'reply': True}),
+        (2, 'FETCH_ROOMS', {'n': 2})
+    ])
+    assert sorted(frames, key=lambda frame: frame[2]) == [('REPLY', 1, 1), ('ACK', {}, 2)]
+
+
+def check(**state):
+    "What the reaper makes of a socket with the given state, 1000 seconds into the loop"
+    async def test(server, socket, reader, writer):
+        for name, value in state.items():
+            setattr(socket, name, value)
+        return socket.check(1000)
+    return run(test)
+
+
+def test_reaper_reasons():
+    assert check(idle_since=1000 - HANDSHAKE_TIMEOUT - 1) == 'handshake'
+    assert check(idle_since=1000 - HANDSHAKE_TIMEOUT + 1) is None
+    assert check(frame_started=1000 - FRAME_TIMEOUT - 1) == 'frame'
+    assert check(write_started=1000 - WRITE_TIMEOUT - 1) == 'write'
+    assert check(frames_in=1, idle_since=1000 - IDLE_TIMEOUT - 1) == 'idle'
+    assert check(frames_in=1, idle_since=0, heartbeat=True, pinged=1000 - HEARTBEAT_TIMEOUT - 1) == 'heartbeat'
+    assert check(frames_in=1, idle_since=0, heartbeat=True, pinged=1000 - HEARTBEAT_TIMEOUT + 1) is None
+    assert check(frames_in=1, idle_since=0, tasks={'busy'}) is None # Handling a request, not silent
+
+
+def test_silent_client_is_pinged():
+    async def test(server, socket, reader, writer):
+        socket.frames_in, socket.heartbeat = 1, True
+        socket.idle_since = 1000 - server.heartbeat_interval - 1
+        assert socket.check(1000) is None and socket.pinged == 1000
+        assert socket.check(1001) is None # Pinged once
+        await settle(socket)
+        assert [header for header, _, _ in written(writer)] == ['PING']
+    run(test)
+
+
+def test_reaped_socket_is_counted_and_closed():
+    async def test(server, socket, reader, writer):
+        before = metrics.REAPED.values[('frame',)]
+        socket.reap('frame')
+        assert socket.closed and writer.closed
+        assert metrics.REAPED.values[('frame',)] == before + 1
+    run(test)